@@ -0,0 +1,264 @@
+#!/usr/bin/python
+
+"""
+  balltree.py: a ball tree, as an alternative to a kd-tree for clustered
+  points.
+
+  A kd-tree splits every node at the median of its widest axis, with a
+  line parallel to an axis, so a node of a cluster that's long and thin on
+  a slant, or a node holding parts of two clusters and the empty space
+  between them, covers a lot of ground that holds no points. Its cell
+  can't be pruned unless the query is far from all of that ground.
+
+  A ball tree instead bounds the points of each node by the smallest ball
+  around their centroid, and splits them along the line through two points
+  far apart, the direction they're most spread along whatever its slant.
+  The smallest possible distance from a query to a point of a node is its
+  distance to the center less the radius, which only depends on where the
+  points actually are.
+"""
+
+import math
+import heapq
+import itertools
+from array import array
+import kdtree
+
+# The smallest distance to a ball is worked out from the distance to its 
+# center and its radius, which are both rounded, so it can come out a hair
+# above the distance to a point on the edge of the ball. It's lowered by 
+# this fraction of the two, which is far more than the rounding, so a ball
+# is never taken for farther than its points (which would put them after 
+# points as far away with a higher index).
+BALL_KEY_SLACK = 1e-12
+
+class BallTree(kdtree.PointArrayIndex):
+  """ A ball tree stored in flat arrays, with the same query methods as
+      KDTree.
+
+      Like a FlatKDTree, each node is an index into parallel arrays holding
+      the center (center_xs, center_ys) and radius of its ball and its
+      children, numbered in pre-order so the root is node 0. Every node
+      but a leaf has two children, and a leaf has a left child of -1 and
+      covers positions bucket_starts[node] up to bucket_ends[node] in the
+      point arrays, which are stored in the order their leaves were created.
+  """
+
+  # The most points in a leaf, unless a larger leaf size is given.
+  bucket_points = 8
+
+  snapshot_engine = 'ball'
+
+  def __init__(self, data, dimensions, leaf_size=1, linked_key=None,
+               workers=1, split_rule='median'):
+    """ Same arguments as KDTree. leaf_size is the most points in a leaf if
+        it's more than bucket_points, and workers and
+        split_rule are ignored. """
+
+    self.dimensions = dimensions
+    self.leaf_size = leaf_size
+    self.bucket_size = max(leaf_size, self.bucket_points)
+    self.set_points(data)
+    columns = kdtree.point_columns(data, dimensions)
+
+    self.number_points = len(data)
+
+    # Per node arrays
+    self.center_xs = array('d')
+    self.center_ys = array('d')
+    self.radii = array('d')
+    self.left_children = array('l')
+    self.right_children = array('l')
+    self.bucket_starts = array('l')
+    self.bucket_ends = array('l')
+
+    self.leaf_points = array('l')
+    self.coordinates = [array('d') for dimension in dimensions]
+
+    self.build(columns)
+
+    if linked_key is not None:
+      self.linked_key = linked_key
+      self.count_linked_records()
+
+    self.version += 1
+
+  def build(self, columns):
+    """ Builds the tree over the points in columns (a sequence of x and one
+        of y coordinates), splitting nodes until they hold bucket_size points
+        or fewer. """
+
+    xs, ys = columns
+
+    # Entries are (parent, is_left, indexes), with the right child pushed
+    # first so the left one is created first, in pre-order.
+    stack = [(-1, True, range(self.number_points))]
+    while stack:
+
+      parent, is_left, indexes = stack.pop()
+      node = self.add_ball(xs, ys, indexes)
+      self.number_nodes += 1
+      if parent >= 0:
+        if is_left:
+          self.left_children[parent] = node
+        else:
+          self.right_children[parent] = node
+
+      if len(indexes) <= self.bucket_size or self.radii[node] == 0:
+        self.bucket_starts[node] = len(self.leaf_points)
+        self.leaf_points.extend(indexes)
+        self.coordinates[0].extend(xs[index] for index in indexes)
+        self.coordinates[1].extend(ys[index] for index in indexes)
+        self.bucket_ends[node] = len(self.leaf_points)
+        self.leaf_nodes += 1
+        continue
+
+      indexes = self.split_order(xs, ys, indexes, node)
+      middle = len(indexes) // 2
+      stack.append((node, False, indexes[middle:]))
+      stack.append((node, True, indexes[:middle]))
+
+  def add_ball(self, xs, ys, indexes):
+    """ Adds a node with the ball around the centroid of the points with
+        the given indexes, returning its number. Children and buckets are
+        filled in later. """
+
+    center_x = math.fsum(xs[index] for index in indexes) / len(indexes)
+    center_y = math.fsum(ys[index] for index in indexes) / len(indexes)
+    radius_key = max(kdtree.bucket_keys([xs[index] for index in indexes],
+                                        [ys[index] for index in indexes],
+                                        center_x, center_y))
+
+    self.center_xs.append(center_x)
+    self.center_ys.append(center_y)
+    self.radii.append(math.sqrt(radius_key))
+    self.left_children.append(-1)
+    self.right_children.append(-1)
+    self.bucket_starts.append(0)
+    self.bucket_ends.append(0)
+
+    return len(self.radii) - 1
+
+  def split_order(self, xs, ys, indexes, node):
+    """ Returns the indexes sorted along the line from the point farthest
+        from the center of the node to the point farthest from that one, so
+        the first and second halves are the two children. """
+
+    def farthest_from(x, y):
+      keys = kdtree.bucket_keys([xs[index] for index in indexes],
+                                [ys[index] for index in indexes], x, y)
+      return indexes[max(range(len(keys)), key=keys.__getitem__)]
+
+    first = farthest_from(self.center_xs[node], self.center_ys[node])
+    second = farthest_from(xs[first], ys[first])
+
+    x_step = xs[second] - xs[first]
+    y_step = ys[second] - ys[first]
+    return sorted(indexes, key=lambda index: (xs[index] * x_step +
+                                              ys[index] * y_step))
+
+  def ball_keys(self, node, query):
+    """ Returns the key (see KDTreeNode.distance_key) of the smallest
+        possible distance from the query to a point in the ball of the node,
+        and the key of the distance to its center. """
+
+    x_diff = self.center_xs[node] - query[0]
+    y_diff = self.center_ys[node] - query[1]
+    center_key = (x_diff * x_diff) + (y_diff * y_diff)
+    center_distance = math.sqrt(center_key)
+    gap = (center_distance - self.radii[node] - 
+           (center_distance + self.radii[node]) * BALL_KEY_SLACK)
+    if gap <= 0:
+      return 0, center_key
+
+    key = gap * gap
+    return (key if key > kdtree.ZERO_KEY else 0), center_key
+
+  def find_k_nearest(self, node, query, mins_so_far, stats):
+    """ Same as FlatKDTree.find_k_nearest, starting at the given node. Nodes
+        are searched depth first, and skipped if their ball is no closer 
+        than the farthest candidate. Balls overlap, so a query is often 
+        inside both children; the one with the nearer center is searched
+        first. """
+
+    stack = [(0, node)]
+    while stack:
+
+      key, node = stack.pop()
+      if key >= mins_so_far.key_radius():
+        continue
+
+      stats['nodes'] += 1
+
+      left = self.left_children[node]
+      if left < 0:
+        self.compare_range(self.bucket_starts[node], self.bucket_ends[node],
+                           query, mins_so_far)
+        continue
+
+      right = self.right_children[node]
+      left_key, left_center_key = self.ball_keys(left, query)
+      right_key, right_center_key = self.ball_keys(right, query)
+
+      # Push the nearer child last so it's searched first.
+      if left_center_key <= right_center_key:
+        stack.append((right_key, right))
+        stack.append((left_key, left))
+      else:
+        stack.append((left_key, left))
+        stack.append((right_key, right))
+
+    return mins_so_far
+
+  def nearest_positions_iter(self, query, stats, linked_only=False):
+    """ Same as FlatKDTree.nearest_positions_iter, taking nodes in order of
+        the distance to their balls. """
+
+    order = itertools.count()
+    leaf_points = self.leaf_points
+
+    # Entries are (key, is_point, order for a node or index for a point,
+    # node or position), as in kdtree.KDTreeNode.nearest_iter.
+    queue = [(0, False, next(order), self.root)]
+    while queue:
+
+      key, is_point, rank, node = heapq.heappop(queue)
+
+      if is_point:
+        yield node, kdtree.key_distance(key)
+        continue
+
+      stats['nodes'] += 1
+
+      if self.left_children[node] < 0:
+        start = self.bucket_starts[node]
+        end = self.bucket_ends[node]
+        keys = kdtree.bucket_keys(self.coordinates[0][start:end],
+                                  self.coordinates[1][start:end],
+                                  query[0], query[1])
+        for position, key in enumerate(keys, start):
+          if linked_only and not self.point_records[position]:
+            continue
+          heapq.heappush(queue, (key if key > kdtree.ZERO_KEY else 0, True,
+                                 leaf_points[position], position))
+        continue
+
+      for child in (self.left_children[node], self.right_children[node]):
+        if linked_only and not self.linked_points[child]:
+          continue
+        heapq.heappush(queue, (self.ball_keys(child, query)[0], False,
+                               next(order), child))
+
+  def snapshot_sections(self):
+    """ Same as PointArrayIndex.snapshot_sections, with the node arrays
+        first. """
+    return ([(name, typecode, 'nodes') for name, typecode in
+             (('center_xs', 'd'), ('center_ys', 'd'), ('radii', 'd'),
+              ('left_children', 'l'), ('right_children', 'l'),
+              ('bucket_starts', 'l'), ('bucket_ends', 'l'),
+              ('linked_points', 'l'), ('linked_records', 'l'))] +
+            kdtree.PointArrayIndex.snapshot_sections(self))
+
+class SnapshotBallTree(kdtree.SnapshotIndex, BallTree):
+  """ A BallTree loaded from a file written by its save_snapshot (see
+      kdtree.SnapshotIndex). """
@@ -0,0 +1,243 @@
+#!/usr/bin/python
+
+"""
+  gridindex.py: a uniform grid of buckets, as an alternative to a kd-tree.
+
+  When points are spread fairly evenly over a rectangle, there's no need for
+  a tree to find the ones near a query: a grid of equal square cells, sized
+  so each holds a few points on average, puts them all at a known cell. A
+  search looks at the query's cell, then at the rings of cells around it
+  one at a time, and stops when the next ring is farther away than the k-th
+  nearest point found so far. Finding a cell is arithmetic, so there are no
+  nodes to walk down, and each cell is compared with the query all at once
+  like a bucket of a kd-tree.
+
+  The grid is built with a single sort of the points by cell.
+"""
+
+import math
+import heapq
+import itertools
+from array import array
+import kdtree
+
+class GridIndex(kdtree.PointArrayIndex):
+  """ A uniform grid over the bounding box of the points, with the same
+      query methods as KDTree.
+
+      Points are stored in arrays ordered by cell (row by row), and the
+      points of cell c are at positions cell_starts[c] up to 
+      cell_starts[c + 1]. Cells play the part of nodes in the stats, and 
+      number_nodes is the number of cells.
+  """
+
+  # The average number of points per cell the cell size is chosen for,
+  # unless a larger leaf size is given.
+  cell_points = 2
+
+  snapshot_engine = 'grid'
+  snapshot_attributes = kdtree.PointArrayIndex.snapshot_attributes + (
+    'min_x', 'min_y', 'cell_size', 'columns', 'rows')
+
+  def __init__(self, data, dimensions, leaf_size=1, linked_key=None,
+               workers=1, split_rule='median'):
+    """ Same arguments as KDTree. leaf_size is the average number of points
+        per cell if it's more than cell_points, and workers and
+        split_rule are ignored. """
+
+    self.dimensions = dimensions
+    self.leaf_size = leaf_size
+    self.set_points(data)
+    columns = kdtree.point_columns(data, dimensions)
+
+    self.number_points = len(data)
+    self.choose_cells(columns, max(leaf_size, self.cell_points))
+
+    # Sort the points by cell, keeping the original order within each one.
+    cells = [self.cell(columns[0][index], columns[1][index])
+             for index in range(self.number_points)]
+    order = sorted(range(self.number_points), key=cells.__getitem__)
+
+    self.leaf_points = array('l', order)
+    self.coordinates = [array('d', (column[index] for index in order))
+                        for column in columns]
+
+    self.cell_starts = array('l', [0]) * (self.number_nodes + 1)
+    for cell in cells:
+      self.cell_starts[cell + 1] += 1
+    for cell in range(self.number_nodes):
+      self.cell_starts[cell + 1] += self.cell_starts[cell]
+
+    if linked_key is not None:
+      self.linked_key = linked_key
+      self.count_linked_records()
+
+    self.version += 1
+
+  def choose_cells(self, columns, points_per_cell):
+    """ Sets the origin, cell size and number of columns and rows of the
+        grid, so that it covers the points in columns (a sequence of x and
+        one of y coordinates) with about points_per_cell in each cell if
+        they're spread evenly.
+
+        Cells are never smaller than the longer side of the box split into
+        one cell per points_per_cell points, so points spread along a line
+        or in a thin strip don't get a huge grid of mostly empty cells:
+        there are at most about three times as many cells as needed for the
+        points. """
+
+    if self.number_points:
+      self.min_x = min(columns[0])
+      self.min_y = min(columns[1])
+      width = max(columns[0]) - self.min_x
+      height = max(columns[1]) - self.min_y
+    else:
+      self.min_x = self.min_y = width = height = 0
+
+    # Points per cell is density times cell area.
+    area = width * height
+    self.cell_size = 0
+    if area > 0:
+      self.cell_size = math.sqrt(area * points_per_cell / self.number_points)
+    self.cell_size = max(self.cell_size, max(width, height) * points_per_cell
+                         / max(1, self.number_points)) or 1.0
+
+    self.columns = int(width / self.cell_size) + 1
+    self.rows = int(height / self.cell_size) + 1
+    self.number_nodes = self.leaf_nodes = self.columns * self.rows
+
+  def column_row(self, x, y):
+    """ Returns the column and row of the cell nearest to (x, y). """
+    column = int((x - self.min_x) / self.cell_size)
+    row = int((y - self.min_y) / self.cell_size)
+    return (min(max(column, 0), self.columns - 1),
+            min(max(row, 0), self.rows - 1))
+
+  def cell(self, x, y):
+    """ Returns the index of the cell nearest to (x, y). """
+    column, row = self.column_row(x, y)
+    return row * self.columns + column
+
+  def depth(self):
+    """ Same as KDTree.depth: the cells are a single level. """
+    return 1 if self.number_points else 0
+
+  def count_node_records(self):
+    """ Same as PointArrayIndex.count_node_records, counting the linked
+        records of each cell (cell_records). """
+
+    self.cell_records = array('l', (sum(self.point_records[
+                                      self.cell_starts[cell]:
+                                      self.cell_starts[cell + 1]])
+                                    for cell in range(self.number_nodes)))
+
+  def rings(self, query):
+    """ Generator which yields the cells around the query a ring at a time,
+        closest first, as a list of cells and the key (see
+        KDTreeNode.distance_key) of the smallest possible distance from the
+        query to a point outside the rings so far. That's infinite for the
+        last ring, once the rings cover the whole grid. """
+
+    x, y = query
+    column, row = self.column_row(x, y)
+    size = self.cell_size
+
+    for ring in itertools.count():
+      first_column = max(column - ring, 0)
+      last_column = min(column + ring, self.columns - 1)
+      first_row = max(row - ring, 0)
+      last_row = min(row + ring, self.rows - 1)
+
+      # Only the sides of the ring inside the grid are walked, so rings
+      # that reach past the grid in some directions cost no more than
+      # the cells they have.
+      cells = []
+      for side_row in sorted(set((row - ring, row + ring))):
+        if 0 <= side_row < self.rows:
+          start = side_row * self.columns
+          cells.extend(range(start + first_column, start + last_column + 1))
+      inner_first = max(row - ring + 1, 0)
+      inner_last = min(row + ring - 1, self.rows - 1)
+      for side_column in sorted(set((column - ring, column + ring))):
+        if ring and 0 <= side_column < self.columns:
+          cells.extend(range(inner_first * self.columns + side_column,
+                             inner_last * self.columns + side_column + 1,
+                             self.columns))
+
+      # The nearest any point outside the rings can be is the nearest side
+      # of the rings that isn't at the edge of the grid.
+      gaps = []
+      if first_column > 0:
+        gaps.append(x - (self.min_x + first_column * size))
+      if last_column < self.columns - 1:
+        gaps.append(self.min_x + (last_column + 1) * size - x)
+      if first_row > 0:
+        gaps.append(y - (self.min_y + first_row * size))
+      if last_row < self.rows - 1:
+        gaps.append(self.min_y + (last_row + 1) * size - y)
+
+      if not gaps:
+        yield cells, float('inf')
+        return
+
+      gap = max(0, min(gaps))
+      key = gap * gap
+      yield cells, key if key > kdtree.ZERO_KEY else 0
+
+  def find_k_nearest(self, node, query, mins_so_far, stats):
+    """ Same as FlatKDTree.find_k_nearest, searching the whole grid ring by
+        ring (node is ignored). Rings stop once the rest of the grid is no
+        closer than the farthest candidate. """
+
+    for cells, outside_key in self.rings(query):
+
+      for cell in cells:
+        start = self.cell_starts[cell]
+        end = self.cell_starts[cell + 1]
+        stats['nodes'] += 1
+        if start < end:
+          self.compare_range(start, end, query, mins_so_far)
+
+      if mins_so_far.is_full() and outside_key >= mins_so_far.key_radius():
+        break
+
+  def nearest_positions_iter(self, query, stats, linked_only=False):
+    """ Same as FlatKDTree.nearest_positions_iter. Points found in the rings
+        so far are queued by key and index, and taken from the queue once
+        they're closer than anything outside the rings. """
+
+    xs = self.coordinates[0]
+    ys = self.coordinates[1]
+    leaf_points = self.leaf_points
+    queue = []
+    for cells, outside_key in self.rings(query):
+
+      for cell in cells:
+        stats['nodes'] += 1
+        if linked_only and not self.cell_records[cell]:
+          continue
+
+        start = self.cell_starts[cell]
+        end = self.cell_starts[cell + 1]
+        keys = kdtree.bucket_keys(xs[start:end], ys[start:end],
+                                  query[0], query[1])
+        for position, key in enumerate(keys, start):
+          if linked_only and not self.point_records[position]:
+            continue
+          heapq.heappush(queue, (key if key > kdtree.ZERO_KEY else 0,
+                                 leaf_points[position], position))
+
+      while queue and queue[0][0] < outside_key:
+        key, index, position = heapq.heappop(queue)
+        yield position, kdtree.key_distance(key)
+
+  def snapshot_sections(self):
+    """ Same as PointArrayIndex.snapshot_sections, with the cell arrays
+        first. """
+    return ([('cell_starts', 'l', 'node_offsets'),
+             ('cell_records', 'l', 'nodes')] +
+            kdtree.PointArrayIndex.snapshot_sections(self))
+
+class SnapshotGridIndex(kdtree.SnapshotIndex, GridIndex):
+  """ A GridIndex loaded from a file written by its save_snapshot (see
+      kdtree.SnapshotIndex). """
@@ -11,7 +11,8 @@
   
   To build the tree, I use a sublist partitioning approach where two copies of
   the initial input list are made and each sorted on a different dimension.
-  Then at each step the dimension with the greatest spread is picked as the splitting
+  Then at each step the dimension with the greatest spread (of the node's box, 
+  cut from its parent's, see KDTree.split_box) is picked as the splitting
   plane and the two lists are each split into two sub-lists above and below the
   splitting value. This can be done in O(n) time because the list corresponding to 
   the splitting dimension is already sorted and the other dimension can be partitioned
@@ -22,7 +23,98 @@
 
 import math
 import sys
+import heapq
+import itertools
+import json
+import mmap
+import ctypes
+import struct
+import multiprocessing
+import cPickle
+import cStringIO
+from array import array
 from operator import itemgetter
+from pointstore import PointStore, VisitedSet
+
+# Distances closer than this are treated as zero.
+EPSILON = .001
+
+# Searches compare squared distances, or keys, and only take the square root
+# of the ones they report. A distance is max(0, sqrt(key) - EPSILON), which
+# only ever moves keys together when it makes them 0, so keys up to ZERO_KEY
+# are clamped to 0 wherever they're stored and equal keys are then exactly
+# equal distances. Comparing an unclamped key against a stored one gives the
+# same answer as comparing the distances, so bucket keys are only clamped 
+# when they're kept. EPSILON * EPSILON is a rounding step short of the 
+# largest key to clamp.
+def adjacent_float(value, steps):
+  """ Returns the float the given number of steps above (or below, for a
+      negative number) a positive float. """
+  bits = struct.unpack('<q', struct.pack('<d', value))[0]
+  return struct.unpack('<d', struct.pack('<q', bits + steps))[0]
+
+def zero_key():
+  """ Returns the largest squared distance whose distance is 0. """
+  key = EPSILON * EPSILON
+  while math.sqrt(adjacent_float(key, 1)) <= EPSILON:
+    key = adjacent_float(key, 1)
+  return key
+
+ZERO_KEY = zero_key()
+
+def key_distance(key):
+  """ Returns the distance (as calculated by KDTreeNode.distance) for a key. """
+  return max(0, math.sqrt(key) - EPSILON)
+
+def key_bound(distance):
+  """ Returns the smallest key whose distance is at least the given 
+      distance, so a key is below it exactly when its distance is. """
+  if distance <= 0 or distance == float('inf'):
+    return max(0, distance)
+  
+  # Squaring is only close, so walk to the exact bound from there.
+  key = (distance + EPSILON) * (distance + EPSILON)
+  while key_distance(key) >= distance:
+    key = adjacent_float(key, -1)
+  while key_distance(key) < distance:
+    key = adjacent_float(key, 1)
+  return key
+
+def bucket_keys(xs, ys, query_x, query_y):
+  """ Returns the unclamped keys (see KDTreeNode.distance_key) from the 
+      query location to each point in a bucket, where xs and ys are
+      sequences of the bucket's coordinates. The whole bucket is done in a
+      single comprehension rather than a function call per point. """
+  
+  return [(x - query_x) * (x - query_x) + (y - query_y) * (y - query_y)
+          for x, y in zip(xs, ys)]
+
+def box_key(first_box, second_box):
+  """ Returns the key (see KDTreeNode.distance_key) of the smallest possible
+      distance between points in two boxes, each given as (min x, min y,
+      max x, max y). A point is a box with no area. """
+  
+  x_gap = max(0, first_box[0] - second_box[2], second_box[0] - first_box[2])
+  y_gap = max(0, first_box[1] - second_box[3], second_box[1] - first_box[3])
+  key = (x_gap * x_gap) + (y_gap * y_gap)
+  
+  return key if key > ZERO_KEY else 0
+
+def point_box_key(box, x, y):
+  """ Same as box_key, for a box and the point (x, y). """
+  
+  x_gap = max(0, box[0] - x, x - box[2])
+  y_gap = max(0, box[1] - y, y - box[3])
+  key = (x_gap * x_gap) + (y_gap * y_gap)
+  
+  return key if key > ZERO_KEY else 0
+
+# The rules KDTree can split nodes with (see KDTree.choose_split).
+SPLIT_RULES = ('median', 'midpoint', 'cost')
+
+# The number of evenly spaced positions the cost rule tries splitting a node
+# at, along each dimension.
+COST_SPLIT_CANDIDATES = 16
 
 class KDTreeNode():
   
@@ -40,22 +132,74 @@ class KDTreeNode():
   # 'x', 'y', and 'value', which is where any non-location data should go.
   point = None
   
-  def __init__(self, axis=None, value=None, point=None):
+  # The position of a leaf's point in the data the tree was built from.
+  # Searches break ties between points as far away on it, so equally near
+  # points are always listed in the order of the data, however the tree is
+  # laid out or searched.
+  index = None
+  
+  # A leaf can instead hold a bucket of several data points, as a list of
+  # single-point leaf nodes (which are what searches report as results).
+  # The coordinates of the bucket are also kept in two tuples so distances
+  # to the whole bucket can be computed in one go.
+  bucket = None
+  bucket_xs = None
+  bucket_ys = None
+  
+  # If the tree was built with a linked records key, every node also knows
+  # how many points under it have at least one linked record, and the total
+  # number of records they link to (an upper bound on the unique records).
+  linked_points = None
+  linked_records = None
+  
+  # With the counts, a node that isn't a single point's leaf also gets the
+  # bounding box of just its points with linked records (linked_box, laid 
+  # out like box without the index), and a node with linked points under
+  # only one child gets the node below it where they first split, or their
+  # leaf (linked_node). Searches for linked records go straight to that
+  # node and prune on the linked boxes, so they see the same tree as one 
+  # built from the points with linked records alone.
+  linked_box = None
+  linked_node = None
+  
+  # The bounding box of the points under the node, as (min x, min y, max x,
+  # max y), set by KDTree.set_boxes once the tree is built. Searches prune
+  # a node when the box is no closer to the query than the best candidates,
+  # which rules out the empty space in its cell as well. A box only as near
+  # as the farthest candidate can still hold a point that gets in on its 
+  # index, so the lowest index of the points under the node follows the
+  # coordinates, as box[4], and the box is searched if that's lower. (It's
+  # kept in the box as one more attribute would make nodes much bigger.)
+  box = None
+  
+  def __init__(self, axis=None, value=None, point=None, bucket=None, 
+               index=None, indexes=None):
     """ Constructor for a kd-tree node, which can be either an internal node
-        with a splitting axis and value or a leaf node with a data point.
+        with a splitting axis and value, a leaf node with a data point, or
+        a leaf node with a bucket of data points.
         
         You must specify either axis and value (for an internal node),
-        or point (for a leaf node).
+        point (for a leaf node), or bucket (a list of data points).
+        index is the position of the point in the data, and indexes those
+        of the points in a bucket (see index).
         
         You have to use named arguments to create a leaf node.
     """
-    if axis and value and not point:
+    if axis and value is not None and not point:
       self.axis = axis
       self.value = value
     elif point:
       self.point = point
+      self.index = index
+    elif bucket:
+      if indexes is None:
+        indexes = [None] * len(bucket)
+      self.bucket = [KDTreeNode(point=member, index=index) 
+                     for member, index in zip(bucket, indexes)]
+      self.bucket_xs = tuple(member['x'] for member in bucket)
+      self.bucket_ys = tuple(member['y'] for member in bucket)
     else:
-      msg = "You must specify either axis and value or point."
+      msg = "You must specify either axis and value, point or bucket."
       raise ValueError(msg)
         
   def nearest(self, query, stats):
@@ -70,306 +214,310 @@ class KDTreeNode():
   
     # Find the node where the key would be inserted and take that as the starting point
     target = self.search(query)
-    distance = self.distance(target.point, query)
+    key = self.distance_key(target.point, query)
           
     stats['nodes'] = 0
     min_so_far = {'point': target,
-                  'distance': distance}
+                  'distance': key_distance(key),
+                  'key': key}
     # Then search the kd-tree refining the minimum distance, and 
     # using the normal distance along each axis to choose which branch to expand.
     self.find_nearest(query, min_so_far, stats)
-
+    
+    del min_so_far['key']
     return min_so_far
   
   def find_nearest(self, query, min_so_far, stats):
-    """ Recursively find the single nearest point to the query point
+    """ Find the single nearest point to the query point
         by refining an intial estimate of the nearest neighbor. 
         Prune branches by checking if the partition overlaps the area
         defined by the current minimum distance (min_so_far['distance')
-        around the query point. """
-    
-    stats['nodes'] += 1
-    
-    # Base case: node is a leaf so just compare it.
-    if self.is_leaf():
-      distance = self.distance(self.point, query)
-      
-      # Adjust running minimum  if necessary
-      if distance < min_so_far['distance']:
-        min_so_far['point'] = self
-        min_so_far['distance'] = distance
-       
-    # If there's only a right child, search that branch 
-    elif not self.left_child:
-      if (query[self.axis] + min_so_far['distance']) > self.value:
-        self.right_child.find_nearest(query, min_so_far, stats)
-      #self.right_child.find_nearest(query, min_so_far, stats)
-      
-    # If there's only a left child, search that branch
-    elif not self.right_child:
-      
-      if (query[self.axis] - min_so_far['distance']) <= self.value:
-            self.left_child.find_nearest(query, min_so_far, stats)
-      #self.left_child.find_nearest(query, min_so_far, stats)
-      
-    # If the node has both branches, determine which to prioritize and 
-    # seach them.
-    else:
-        # Determine which branch to prioritize
-        if query[self.axis] <= self.value:
-            first = 'left'
-        else:
-            first = 'right'
-
-        if first == 'left':
-          if (query[self.axis] - min_so_far['distance']) <= self.value:
-            self.left_child.find_nearest(query, min_so_far, stats)
-          
-          if (query[self.axis] + min_so_far['distance']) > self.value:
-            self.right_child.find_nearest(query, min_so_far, stats)
-  
-        else:
-          if (query[self.axis] + min_so_far['distance']) > self.value:
-            self.right_child.find_nearest(query, min_so_far, stats)   
+        around the query point. Points are compared on their keys, which
+        are kept in min_so_far['key'], and then on their index.
+        
+        Branches still to be searched are kept on a stack instead of 
+        recursing, so there is no limit on the depth of the tree. Rather
+        than the splitting line, each node's bounding box (see box) is 
+        checked against the minimum distance, when it comes off the stack,
+        and of two children the one with the nearer box is searched first.
+        So fewer nodes are visited than by pruning on splitting lines.
+        A box as far away as the minimum is still searched if it has a
+        point with a lower index (see box).
+    """
+    
+    x = query['x']
+    y = query['y']
+    
+    # Entries are (node, key of the distance to its box).
+    stack = [(self, point_box_key(self.box, x, y))]
+    while stack:
+      
+      node, box_key = stack.pop()
+      if box_key > min_so_far['key'] or (
+          box_key == min_so_far['key'] and 
+          node.box[4] > min_so_far['point'].index):
+        continue
+      
+      stats['nodes'] += 1
+      
+      left = node.left_child
+      right = node.right_child
+      
+      if node.bucket:
+        for member, key in node.bucket_keys(query):
+          if key <= ZERO_KEY:
+            key = 0
+          if key < min_so_far['key'] or (
+              key == min_so_far['key'] and 
+              member.index < min_so_far['point'].index):
+            min_so_far['point'] = member
+            min_so_far['key'] = key
+            min_so_far['distance'] = key_distance(key)
             
-          if (query[self.axis] - min_so_far['distance']) <= self.value:
-            self.left_child.find_nearest(query, min_so_far, stats)
-
+      elif not left and not right:
+        key = node.distance_key(node.point, query)
+        if key < min_so_far['key'] or (
+            key == min_so_far['key'] and 
+            node.index < min_so_far['point'].index):
+          min_so_far['point'] = node
+          min_so_far['key'] = key
+          min_so_far['distance'] = key_distance(key)
+      
+      else:
+        stack.extend(node.children_by_box(x, y))
+  
   def k_nearest(self, query, k, stats):
     """ Find the k nearest points to the key. """
     
     # Short-circuit
     if k == 1:
       result = self.nearest(query, stats)
+      stats['passes'] = 1
       return {'list': [result]}
     
     # Find the node where the key would be inserted and take that as the starting point
     target = self.search(query)
-    distance = self.distance(target.point, query)
+    key = self.distance_key(target.point, query)
     
-    # Change this to a hash table by id later if lists are too slow.
-    mins_so_far = {'min_distance': distance,
-                   'max_distance': distance,
-                   'list': [{'point': target,
-                             'distance': distance}]
-                   }
+    mins_so_far = KNearestHeap(k, key_distance(key))
+    mins_so_far.insert(target, key, target.index)
     
     # We increase search radius until
     # we find k nearest neighbors
     passes = 0
-    stat_list = []
-    while len(mins_so_far['list']) < k:
-      
-      stats['nodes'] = 0
+    stats['nodes'] = 0
+    while not mins_so_far.is_full():
       
       # Catch the case where a query point is exactly on a point in the 
       # tree and no other candidates were found.
-      mins_so_far['max_distance'] = max(1, mins_so_far['max_distance'])
-      mins_so_far['max_distance'] *=  2
+      mins_so_far.search_radius = max(1, mins_so_far.search_radius) * 2
       
       # Then search the kd-tree refining the minimum distance, and 
       # using the normal distance along each axis to choose which branch to expand.
-      self.find_k_nearest(query, mins_so_far, k, stats)
+      self.find_k_nearest(query, mins_so_far, stats)
 
       passes += 1
     
     stats['passes'] = passes
     
-    mins_so_far['list'].sort(key=itemgetter('distance'))
-    
-    return mins_so_far
-  
-  def k_nearest_linked_records(self, query, k, key_name, stats):
-    
-    # Short-circuit to nearest if k is 1
-    if k == 1:
-      result = self.nearest(query, stats)
-      records = result['point'].point['value'][key_name]
-      return {key_name: [{'id': records[0],
-                          'distance': result['distance']}]}
-    
-    
-    # Instead of the number of nodes found, what we care about is
-    # the number of unique linked records found
-    
-    # Find the node where the key would be inserted and take that as the starting point
-    target = self.search(query)
-    distance = self.distance(target.point, query)
+    return mins_so_far.results()
+
+  def k_nearest_single_pass(self, query, k, stats):
+    """ Find the k nearest points to the key with a single traversal.
+
+        Instead of guessing a search radius and doubling it until k points
+        turn up, candidates are kept in a max-heap bounded at k items. Until
+        the heap is full nothing can be pruned, and once it is full the
+        search radius is the distance of the farthest candidate, so it
+        shrinks as soon as a closer point is found.
+
+        Returns the same structure as k_nearest.
+    """
+
+    stats['nodes'] = 0
+
+    # With no starting radius the heap doesn't prune anything until it's full.
+    mins_so_far = KNearestHeap(k)
+    self.find_k_nearest(query, mins_so_far, stats)
+
+    stats['passes'] = 1
+
+    return mins_so_far.results()
+
+  def nearest_iter(self, query, stats, linked_only=False):
+    """ Generator which yields (leaf node, distance) for every point under
+        this node, closest first, so a caller can take neighbors one at a
+        time until it has what it needs, without guessing k up front.
+        
+        This is the incremental nearest neighbor search of Hjaltason and 
+        Samet: a priority queue holds both nodes, keyed by the distance from
+        the query to their box, and points, keyed by their own distance. 
+        Whatever comes off the queue first is the closest thing left, so a 
+        point is only yielded once everything closer has been. Nodes are
+        only expanded as far as the caller keeps asking.
+        
+        Of a node and a point as far away, the node comes off first, so 
+        every point as near as the one yielded is already queued, and
+        points as near come off in order of their index. So ties come out
+        in the order of the data, as from find_k_nearest.
+        
+        If linked_only is True, subtrees and points without any linked 
+        records (according to linked_points) are skipped, nodes with 
+        linked points under only one child are passed over for their 
+        linked_node, and nodes are queued by their linked_box.
+    """
     
-    # Change this to a hash table by id later if lists are too slow.
-    mins_so_far = {'min_distance': distance,
-                   'max_distance': distance,
-                   'list': [{'point': target,
-                             'distance': distance}]
-                   }
+    x = query['x']
+    y = query['y']
+    order = itertools.count()
     
-    # Set up a dictionary to track unique linked record results.
-    record_table = {}
-    linked_records = []
+    start = self
+    if linked_only:
+      start = self.linked_node or self
     
-    # We increase search radius until
-    # we find k nearest linked records
-    stats['nodes'] = 0
-    stats['passes'] = 0
-    stat_list = []
-    num_results = k
-    while len(linked_records) < num_results:
-      
-      # Make passes over the tree, widening the search radius until we
-      # get the number of neighbors we wanted
-      while len(mins_so_far['list']) < k:
-        
-        # Catch the case where a query point is exactly on a point in the 
-        # tree and no other candidates were found.
-        mins_so_far['max_distance'] = max(1, mins_so_far['max_distance'])
-        # Double the search radius
-        mins_so_far['max_distance'] *=  2
-        
-        # Then search the kd-tree refining the minimum distance, and 
-        # using the normal distance along each axis to choose which branch to expand.
-        self.find_k_nearest(query, mins_so_far, k, stats)
-        stats['passes'] += 1
-      
-      # Now go through the list of nearest neighbors and process the linked records.
-      num_linked = len(linked_records)
-      mins_so_far['list'].sort(key=itemgetter('distance'))
-      for result in mins_so_far['list']:
-      
-        # Get the lists of linked records (might be length zero)
-        records = result['point'].point['value'][key_name]
-        records.sort()
-          
-        # Put question id's in dictionary to eliminate duplicate id's
-        for record_id in records:
-          if record_id not in record_table:
-            record_table[record_id] = result['distance']
-            linked_records.append(record_id)
-      
-      # Check if any more unique records were found.
-      if num_linked < len(linked_records):
-        k += (num_results - len(linked_records))
-        #print("  Bumping up k to {}".format(k))
-    
-    # Reformat dictionary into a list for sorting.
-    record_list = []
-    for record_id in linked_records:
-      record_list.append({'id': record_id,
-                          'distance': record_table[record_id]})    
+    # Entries are (key, is_point, order for a node or index for a point,
+    # node).
+    queue = [(0, False, next(order), start)]
+    while queue:
       
-    mins_so_far[key_name] = record_list
-    return mins_so_far
-  
-  def insert_min(self, new_min, mins_so_far, k):
-    """ Function which inserts a new nearest neighbor into the list of 
-        nearest neighbors, ejecting the maximum value if necessary
-        to keep the list size at k.
-    """    
-    # First make sure it's not already in the list.
-    if new_min not in mins_so_far['list']:   
+      key, is_point, rank, node = heapq.heappop(queue)
       
-      # Adjust the cached minimum distance. We only have to compare against
-      # the newly inserted item because items are evicted largest first.
-      if new_min['distance'] < mins_so_far['min_distance']:
-         mins_so_far['min_distance'] = new_min['distance']     
-    
-      # If adding the new item to the list will result in k items or less,
-      # just append it.
-      if len(mins_so_far['list']) < k:
-        
-        mins_so_far['list'].append(new_min)
+      if is_point:
+        yield node, key_distance(key)
+        continue
+      
+      stats['nodes'] += 1
+      
+      if node.is_leaf() and node.bucket:
+        for leaf, key in node.bucket_keys(query):
+          if linked_only and not leaf.linked_points:
+            continue
+          heapq.heappush(queue, (key if key > ZERO_KEY else 0, 
+                                 True, leaf.index, leaf))
           
-        # Since nothing is being evicted from the list, we only have to check against
-        # the newly inserted item.
-        if new_min['distance'] > mins_so_far['max_distance']:
-          mins_so_far['max_distance'] = new_min['distance']
-
+      elif node.is_leaf():
+        key = self.distance_key(node.point, query)
+        heapq.heappush(queue, (key, True, node.index, node))
+        
+      elif linked_only:
+        for child in (node.left_child, node.right_child):
+          if not child or not child.linked_points:
+            continue
+          child = child.linked_node or child
+          heapq.heappush(queue, (point_box_key(child.linked_box or child.box,
+                                               x, y), 
+                                 False, next(order), child))
+        
       else:
-         
-        # Find the index of the item with the maximum distance
-        max_index = max(range(len(mins_so_far['list'])), 
-                        key=lambda k: mins_so_far['list'][k]['distance'])
-        
-        # Only replace the item with maximum distance if our new item has 
-        # a lower distance than it. Because the maximum distance is not necessarily
-        # the distance of the maximum point in the list, but is more like a search radius.
-        if new_min['distance'] < mins_so_far['list'][max_index]['distance']: 
-        
-          # And replace it with the new minimum item
-          mins_so_far['list'][max_index] = new_min
+        for child in (node.left_child, node.right_child):
+          if not child:
+            continue
+          heapq.heappush(queue, (point_box_key(child.box, x, y), 
+                                 False, next(order), child))
+
+  def k_nearest_linked_records(self, query, k, key_name, stats,
+                               linked_only=False):
+    """ Find the k nearest unique linked records to the key, by taking the
+        nearest points from nearest_iter until they link to enough records.
+        
+        Records are listed in order of the distance to the point they were
+        first found through, and in increasing order for each point. Points
+        as near are taken in order of their index (see nearest_iter), so 
+        this is the same as going through the points with linked records 
+        sorted on their distance and index.
+        
+        linked_only is passed on to nearest_iter, and should only be True 
+        if the linked record counts of the nodes are for key_name.
+    """
+    
+    stats['nodes'] = 0
+    stats['passes'] = 1
+    
+    # Records are listed as they're found, with a set of their ids to skip
+    # duplicates.
+    seen = set()
+    record_list = []
+    
+    for leaf, distance in self.nearest_iter(query, stats, linked_only):
+      
+      for record_id in sorted(leaf.point['value'][key_name]):
+        if record_id not in seen:
+          seen.add(record_id)
+          record_list.append({'id': record_id, 'distance': distance})
           
-          # Since we kicked out the maximum element max has to be
-          # be recalculated at this point.
-          max_point = max(mins_so_far['list'],key=itemgetter('distance'))
-          mins_so_far['max_distance'] =  max_point['distance']    
+      if len(record_list) >= k:
+        break
       
-  def find_k_nearest(self, query, mins_so_far, k, stats):
+    return {key_name: record_list}
+      
+  def find_k_nearest(self, query, mins_so_far, stats):
     """ This is a function to find the k nearest neighbors to the
         query point. It does this by keeping track of old minima
-        encountered during the nearest neighbor search in a list
-        (mins_so_far), which boots out the maximum value when it 
-        gets to be of size higher than k.
+        encountered during the nearest neighbor search in a bounded
+        heap (mins_so_far, a KNearestHeap), which boots out the maximum 
+        value when it gets to be of size higher than k.
         
         This function only visits partitions which intersect with
-        the highest distance in the current set of minima, so
-        it is fast but not guaranteed to find k minima.
+        the current search radius of the heap, so if the heap was
+        given a starting radius it is fast but not guaranteed to find 
+        k minima.
         
         However, all of the points it finds are guaranteed to be 
         the nearest ones to the query.
+        
+        Like find_nearest, this uses a stack instead of recursing, and 
+        prunes nodes on their bounding boxes, nearer box first.
     """
     
-    stats['nodes'] += 1
+    x = query['x']
+    y = query['y']
     
-    # Set the search radius to the maximum distance in the ongoing k nearest neighbors.
-    radius = mins_so_far['max_distance']
-    
-    # Base case: node is a leaf so just compare it.
-    if self.is_leaf():
-      distance = self.distance(self.point, query)
-      
-      # Adjust running minimum and add to k nearest neighbors if necessary
-      if (distance < mins_so_far['max_distance']):
-        
-        self.insert_min({'point': self,
-                         'distance': distance},
-                         mins_so_far, 
-                         k)
-
-    # If there's only a right child, search that branch 
-    elif not self.left_child:
+    # Entries are (node, key of the distance to its box).
+    stack = [(self, point_box_key(self.box, x, y))]
+    while stack:
       
-      if (query[self.axis] + radius) > self.value:
-        self.right_child.find_k_nearest(query, mins_so_far, k, stats)
+      node, box_key = stack.pop()
+      if mins_so_far.excludes(box_key, node.box[4]):
+        continue
       
-    # If there's only a left child, search that branch
-    elif not self.right_child:
+      stats['nodes'] += 1
       
-      if (query[self.axis] - radius) <= self.value:
-            self.left_child.find_k_nearest(query, mins_so_far, k, stats)
-
+      left = node.left_child
+      right = node.right_child
       
-    # If the node has both branches, determine which to prioritize and 
-    # seach them.
-    else:
-        # Determine which branch to prioritize
-        if query[self.axis] <= self.value:
-            first = 'left'
-        else:
-            first = 'right'
-
-        if first == 'left':
-          if (query[self.axis] - radius) <= self.value:
-            self.left_child.find_k_nearest(query, mins_so_far, k, stats)
+      if node.bucket:
+        key_radius = mins_so_far.key_radius()
+        for member, key in node.bucket_keys(query):
+          if key < key_radius:
+            mins_so_far.insert(member, key, member.index)
+            key_radius = mins_so_far.key_radius()
+            
+      elif not left and not right:
+        key = node.distance_key(node.point, query)
+        if key < mins_so_far.key_radius():
+          mins_so_far.insert(node, key, node.index)
           
-          if (query[self.axis] + radius) > self.value:
-            self.right_child.find_k_nearest(query, mins_so_far, k, stats)
+      else:
+        stack.extend(node.children_by_box(x, y))
+  
+  def children_by_box(self, x, y):
+    """ Returns (child, key of the distance from (x, y) to its box) for the
+        children of this node, the nearer box last so it's searched first 
+        when they're put on a stack. If the keys are equal, the child with
+        the lowest index is last, so ties are settled as soon as they can 
+        be (see box). """
+    
+    children = [(child, point_box_key(child.box, x, y)) 
+                for child in (self.left_child, self.right_child) if child]
+    if len(children) == 2:
+      (left, left_key), (right, right_key) = children
+      if (left_key < right_key or 
+          (left_key == right_key and 
+           left.box[4] < right.box[4])):
+        children.reverse()
+    
+    return children
   
-        else:
-          if (query[self.axis] + radius) > self.value:
-            self.right_child.find_k_nearest(query, mins_so_far, k, stats)   
-            
-          if (query[self.axis] - radius) <= self.value:
-            self.left_child.find_k_nearest(query, mins_so_far, k, stats)
- 
   def is_leaf(self):
     """ Function to test if current node is a leaf, with no children. """
     test = not self.left_child and not self.right_child 
@@ -379,29 +527,32 @@ class KDTreeNode():
     """ Searches the tree to find either the node with the same key or
         or the node that would be the key's parent if it were inserted. 
         Returns a reference to a KDTreeNode. """
-        
-    # When we reach a leaf it's either equal to the target or
-    # equal to the place the target would go.
-    if self.is_leaf():
-      return self
-
-    # Otherwise the current node defines a splitting line
-    # and it's got to have at least one child
-    if query[self.axis] <= self.value:
-      
-      if self.left_child:
-        return self.left_child.search(query)
-      else:
-        # If no left sub-tree, try the right sub-tree
-        return self.right_child.search(query)
-      
-    else:
-      
-      if self.right_child:
-        return self.right_child.search(query)
+    
+    # Go down the side of each splitting line the query is on, or the 
+    # other side if there's no subtree there.
+    node = self
+    while not node.is_leaf():
+      if query[node.axis] <= node.value:
+        node = node.left_child or node.right_child
       else:
-        # If no right sub-tree, try the left sub-tree
-        return self.left_child.search(query)
+        node = node.right_child or node.left_child
+    
+    # For a bucket, return the closest point in it.
+    if node.bucket:
+      closest = min(((member, key if key > ZERO_KEY else 0) 
+                     for member, key in node.bucket_keys(query)), 
+                    key=itemgetter(1))
+      return closest[0]
+    
+    return node
+  
+  def bucket_keys(self, query):
+    """ Returns a list of (leaf node, key) pairs for every point in this
+        node's bucket, with the same keys as KDTreeNode.distance_key before
+        they're clamped. """
+    
+    keys = bucket_keys(self.bucket_xs, self.bucket_ys, query['x'], query['y'])
+    return zip(self.bucket, keys)
   
   @staticmethod  
   def distance(first_point, second_point):
@@ -413,11 +564,23 @@ class KDTreeNode():
     distance = math.sqrt((x_diff * x_diff) + (y_diff * y_diff))
     
     # If distance is < epsilon, just return 0
-    epsilon = .001
-    distance = max(0, distance - epsilon)
+    distance = max(0, distance - EPSILON)
 
     return distance
   
+  @staticmethod
+  def distance_key(first_point, second_point):
+    """ Calculates the key of the distance between two points: the squared
+        distance, or 0 if the distance is. Keys are ordered the same way as
+        distances, so searches compare them instead.
+    """
+    
+    x_diff = first_point['x'] - second_point['x']
+    y_diff = first_point['y'] - second_point['y']
+    key = (x_diff * x_diff) + (y_diff * y_diff)
+    
+    return key if key > ZERO_KEY else 0
+  
   def __str__(self):
     """ Returns a string representation of the node. """
     return self.__repr__()
@@ -425,7 +588,9 @@ class KDTreeNode():
   def __repr__(self):
     """ Returns a text representation of the node. """
     
-    if self.is_leaf(): 
+    if self.is_leaf() and self.bucket:
+      return "(bucket): {} points".format(len(self.bucket))
+    elif self.is_leaf(): 
       return "(leaf): ({0[x]:0.2f}, {0[y]:0.2f}) -> {0[value]}".format(self.point)
     else:
       return "({axis}): {value:0.2f}".format(axis=self.axis, value=self.value)
@@ -506,15 +671,406 @@ class KDTreeNode():
       if self.right_child:
         self.right_child.draw_tree(right_min, max, output_file)        
       
-class KDTree:
+class KNearestHeap():
+  """ A container for the k best candidates found so far in a k-nearest
+      neighbor search.
+      
+      Candidates live in a max-heap keyed on their distance keys (see 
+      KDTreeNode.distance_key), so the farthest one can be read in O(1) and
+      evicted in O(log k). Pruning compares keys too (see key_radius), so
+      distances are only worked out for the results, or when a caller asks
+      for the radius. A set of the leaves in the heap makes duplicate
+      checks O(1) as well, since the multi-pass search visits the same 
+      leaves again on every pass.
+      
+      Candidates as far away are ranked on their index in the data (see
+      KDTreeNode.index), so the heap ends up with the same points in the 
+      same order whichever order they're found in. A candidate as far away
+      as the farthest one can still get in on a lower index, so once the
+      heap is full its radius includes the farthest candidate's key.
+  """
   
-  root = None
+  def __init__(self, k, search_radius=float('inf')):
+    """ k is the number of candidates to keep. search_radius is the radius
+        used for pruning until the heap fills up; after that the radius is
+        the distance of the farthest candidate.
+    """
+    self.k = k
+    self.search_radius = search_radius
+    self.min_key = float('inf')
+    
+    # The key of the last search radius used before the heap is full.
+    self.bound_radius = None
+    self.bound_key = None
+    
+    # The key of the farthest candidate of a full heap, and the key just 
+    # above it, the radius a candidate has to be inside of.
+    self.farthest_key = None
+    self.farthest_bound = None
+    
+    # Heap entries are (-key, -index, node) so the farthest candidate is on
+    # top, and among equal distances the one with the highest index is 
+    # evicted first.
+    self.heap = []
+    self.members = set()
+    
+  def __len__(self):
+    return len(self.heap)
+    
+  def is_full(self):
+    """ Returns True once k candidates have been found. """
+    return len(self.heap) >= self.k
+  
+  @property
+  def min_distance(self):
+    """ The distance of the nearest candidate. """
+    return key_distance(self.min_key)
+  
+  def radius(self):
+    """ Returns the current search radius. """
+    if len(self.heap) >= self.k:
+      return key_distance(-self.heap[0][0])
+    return self.search_radius
+  
+  def key_radius(self):
+    """ Returns the key of the current search radius, that is the largest 
+        key a candidate can have and still be inside the radius, exclusive.
+        Once the heap is full, that's the key just above the farthest 
+        candidate's, so candidates as far away are offered too. Keys up
+        to ZERO_KEY are all as far away as a key of 0.
+    """
+    if len(self.heap) >= self.k:
+      key = -self.heap[0][0]
+      if key != self.farthest_key:
+        self.farthest_key = key
+        self.farthest_bound = adjacent_float(max(key, ZERO_KEY), 1)
+      return self.farthest_bound
+    
+    if self.search_radius != self.bound_radius:
+      self.bound_radius = self.search_radius
+      self.bound_key = key_bound(self.search_radius)
+    return self.bound_key
+    
+  def excludes(self, key, index):
+    """ Returns True if no candidate with at least the given clamped key
+        and index (or no point in a box that far away, with that as its 
+        lowest index) can get into the heap. """
+    if len(self.heap) < self.k:
+      return key >= self.key_radius()
+    
+    farthest_key, farthest_index, node = self.heap[0]
+    return (key > -farthest_key or 
+            (key == -farthest_key and index >= -farthest_index))
+  
+  def insert(self, node, key, index):
+    """ Adds the leaf node with the given distance key, clamped or not, 
+        and index (see KDTreeNode.index), evicting the farthest candidate
+        if the heap is already full. Leaves that are already in the heap
+        are ignored.
+    """
+    if node in self.members:
+      return
+    
+    if key <= ZERO_KEY:
+      key = 0
+    
+    if len(self.heap) < self.k:
+      heapq.heappush(self.heap, (-key, -index, node))
+      
+    # Only replace the farthest candidate if the new one is closer, or as
+    # close with a lower index.
+    elif (-key, -index) > self.heap[0][:2]:
+      evicted = heapq.heapreplace(self.heap, (-key, -index, node))
+      self.members.discard(evicted[2])
+      
+    else:
+      return
+    
+    self.members.add(node)
+    if key < self.min_key:
+      self.min_key = key
+      
+  def sorted_list(self):
+    """ Returns the candidates closest first as a list of dictionaries with
+        'point' (the leaf node) and 'distance' keys. Ties are broken by
+        index.
+    """
+    entries = sorted(self.heap, reverse=True)
+    return [{'point': node, 'distance': key_distance(-key)} 
+            for key, index, node in entries]
+  
+  def results(self):
+    """ Returns the candidates in the format returned by k_nearest. """
+    nearest = self.sorted_list()
+    
+    results = {'min_distance': self.min_distance,
+               'max_distance': self.radius(),
+               'list': nearest}
+    return results
+      
+class DualTreeSearch():
+  """ The state of a dual-tree k-nearest neighbor search, which finds the
+      k nearest reference points for every point in a tree of query points.
+      
+      Instead of searching the reference tree once per query, the two trees
+      are walked together a pair of nodes at a time. Each query node keeps a
+      bound, the largest search radius of any query under it as a key (see
+      KNearestHeap.key_radius), and a pair is pruned when the key of the 
+      distance between the bounding boxes of the two nodes is no smaller 
+      than the bound. So one comparison of two boxes can rule
+      out a reference subtree for a whole group of nearby queries.
+  """
+  
+  def __init__(self, query_tree, reference_tree, ks):
+    """ query_tree is a KDTree whose points have their query number as
+        their value, reference_tree is the KDTree being searched, and ks is
+        the number of neighbors wanted for each query. Either can be a 
+        FlatKDTree instead, as nodes are only looked at through the methods
+        of their tree (bounding_boxes, node_children, leaf_values and 
+        leaf_keys). """
+    self.query_tree = query_tree
+    self.reference_tree = reference_tree
+    self.query_boxes = query_tree.bounding_boxes()
+    self.reference_boxes = reference_tree.bounding_boxes()
+    
+    self.heaps = [KNearestHeap(min(k, reference_tree.number_points)) 
+                  for k in ks]
+    self.bounds = {}
+    self.node_counts = [0] * len(ks)
+    self.pairs = 0
+    
+  @staticmethod
+  def center_distance(first_box, second_box):
+    """ Returns the squared distance between the centers of two boxes. """
+    x_diff = (first_box[0] + first_box[2]) - (second_box[0] + second_box[2])
+    y_diff = (first_box[1] + first_box[3]) - (second_box[1] + second_box[3])
+    return (x_diff * x_diff + y_diff * y_diff) / 4
+  
+  def search(self, query_node, reference_node):
+    """ Finds candidates for every query under query_node among the points
+        under reference_node, and updates the bound of query_node.
+        
+        Pairs still to be searched are kept on a stack instead of recursing,
+        so neither tree's depth is limited, in the order recursing would
+        search them. A query node that is split goes on the stack under its
+        pairs, to update its bound from its children once they're done.
+    """
+    
+    # Entries are (query node, reference node), or (query node, None) to
+    # update the bound of the query node.
+    stack = [(query_node, reference_node)]
+    while stack:
+      
+      query_node, reference_node = stack.pop()
+      query_children = self.query_tree.node_children(query_node)
+      
+      if reference_node is None:
+        self.bounds[query_node] = max(self.bounds.get(child, float('inf'))
+                                      for child in query_children)
+        continue
+      
+      self.pairs += 1
+      
+      query_box = self.query_boxes[query_node]
+      key = box_key(query_box, self.reference_boxes[reference_node])
+      if key >= self.bounds.get(query_node, float('inf')):
+        continue
+      
+      reference_children = self.reference_tree.node_children(reference_node)
+      
+      if not query_children and not reference_children:
+        self.compare_leaves(query_node, reference_node)
+        
+      elif not query_children:
+        stack.extend(reversed(self.children_pairs(query_node, 
+                                                  reference_children)))
+        
+      else:
+        # Split the query node, and the reference node too if it isn't a 
+        # leaf.
+        stack.append((query_node, None))
+        for query_child in reversed(query_children):
+          if not reference_children:
+            stack.append((query_child, reference_node))
+          else:
+            stack.extend(reversed(self.children_pairs(query_child, 
+                                                      reference_children)))
+      
+  def children_pairs(self, query_node, reference_children):
+    """ Returns the pairs of query_node and each of the given children of a
+        reference node, the child with the closer bounding box first. """
+    
+    query_box = self.query_boxes[query_node]
+    children = sorted(reference_children, key=lambda child: 
+                      self.center_distance(query_box, 
+                                           self.reference_boxes[child]))
+    return [(query_node, child) for child in children]
+  
+  def compare_leaves(self, query_node, reference_node):
+    """ Compares every query in one leaf with every point in another. """
+    
+    reference_box = self.reference_boxes[reference_node]
+    
+    bound = 0
+    for value, x, y in self.query_tree.leaf_values(query_node):
+      
+      mins_so_far = self.heaps[value]
+      
+      # Skip the leaf for queries whose own radius already rules it out.
+      if point_box_key(reference_box, x, y) >= mins_so_far.key_radius():
+        bound = max(bound, mins_so_far.key_radius())
+        continue
+      
+      for candidate, key, index in self.reference_tree.leaf_keys(
+          reference_node, x, y):
+        if key < mins_so_far.key_radius():
+          mins_so_far.insert(candidate, key, index)
+          
+      self.node_counts[value] += 1
+      bound = max(bound, mins_so_far.key_radius())
+      
+    self.bounds[query_node] = bound
+
+# What the worker processes of KDTree.build_in_parallel need to build their
+# subtrees. It's filled in before the workers are forked, so they can read
+# the data without it being sent to them.
+parallel_build_state = {}
+
+def build_subtree(task):
+  """ Builds the subtree for the range of the given task (an index into 
+      parallel_build_state['tasks']) in a worker process, and returns it in
+      the form the tree's add_subtree takes (see KDTree.build_subtree). """
+  
+  return parallel_build_state['tree'].build_subtree(
+    parallel_build_state['data'], parallel_build_state['indexes'],
+    parallel_build_state['columns'], *parallel_build_state['tasks'][task])
+
+def point_columns(data, dimensions):
+  """ Returns an array of the coordinates of the points in data (a list of
+      points or a PointStore) for each of the dimensions. """
+  
+  if isinstance(data, PointStore):
+    return [array('d', data.coordinates[dimension]) 
+            for dimension in dimensions]
+  return [array('d', (data[index][dimension] for index in range(len(data))))
+          for dimension in dimensions]
+
+class SpatialIndex:
+  """ What KDTree and the other indexes of points (see PointArrayIndex) 
+      have in common: their sizes and settings, and the batch searches, 
+      which only need make_query, search_k_nearest and candidate_point 
+      from the index. """
   
   dimensions = None
   number_nodes = 0
   leaf_nodes = 0
+  number_points = 0
+  
+  # The most points a leaf can hold before it's split.
+  leaf_size = 1
+  
+  # The key of the linked records that the nodes keep counts of, if any.
+  linked_key = None
+  
+  # Increased whenever the index changes, so cached answers (see 
+  # main.QueryCache) can tell they're out of date.
+  version = 0
+  
+  def k_nearest_batch(self, xs, ys, ks, stats, id_name='id'):
+    """ Finds the k nearest points for many queries at once. xs and ys are
+        sequences of query coordinates and ks the number of results wanted
+        for each query.
+        
+        Returns a dictionary with 'ids', a list holding the list of result
+        ids for each query (the id_name field of each point's value), and 
+        'distances', holding the matching distances, both in query order. 
+        stats gets the total 'nodes' visited, and 'node_counts' and 
+        'pass_counts' with the number of nodes and passes for each query.
+        
+        Each query is one single-pass search, so the answers are those of
+        k_nearest, ties included.
+    """
+    
+    number_queries = len(xs)
+    ids = [None] * number_queries
+    distances = [None] * number_queries
+    node_counts = [0] * number_queries
+    pass_counts = [0] * number_queries
+    
+    for index in range(number_queries):
+      
+      query = self.make_query(xs[index], ys[index])
+      k = min(ks[index], self.number_points)
+      query_stats = {'nodes': 0}
+      
+      mins_so_far = KNearestHeap(k)
+      self.search_k_nearest(query, mins_so_far, query_stats)
+      
+      nearest = mins_so_far.sorted_list()
+      ids[index] = [self.candidate_point(result['point'])['value'][id_name]
+                    for result in nearest]
+      distances[index] = [result['distance'] for result in nearest]
+      node_counts[index] = query_stats['nodes']
+      pass_counts[index] = 1
+      
+    stats['nodes'] = sum(node_counts)
+    stats['node_counts'] = node_counts
+    stats['pass_counts'] = pass_counts
+      
+    return {'ids': ids,
+            'distances': distances}
   
-  def __init__(self, data, dimensions):
+  def k_nearest_linked_records_batch(self, xs, ys, ks, 
+                                     key_name, max_possible_records,
+                                     stats):
+    """ Finds the k nearest unique linked records for many queries at once,
+        with the same arguments as k_nearest_batch and 
+        k_nearest_linked_records. 
+        
+        Returns a dictionary with 'ids', a list holding the list of record
+        ids for each query, and 'distances', holding the distance to the 
+        point each record was found through. stats is filled in the same
+        way as k_nearest_batch.
+    """
+    
+    number_queries = len(xs)
+    ids = [None] * number_queries
+    distances = [None] * number_queries
+    node_counts = [0] * number_queries
+    pass_counts = [0] * number_queries
+    
+    query_stats = {}
+    for index in range(number_queries):
+      
+      query = {'x': xs[index], 'y': ys[index]}
+      nearest = self.k_nearest_linked_records(query, ks[index], key_name,
+                                              max_possible_records, query_stats)
+      
+      # Due to clustering of multiple records per point, there could be
+      # more results than we wanted.
+      records = nearest[key_name][:ks[index]]
+      ids[index] = [record['id'] for record in records]
+      distances[index] = [record['distance'] for record in records]
+      node_counts[index] = query_stats['nodes']
+      pass_counts[index] = query_stats['passes']
+      
+    stats['nodes'] = sum(node_counts)
+    stats['node_counts'] = node_counts
+    stats['pass_counts'] = pass_counts
+      
+    return {'ids': ids,
+            'distances': distances}
+
+
+class KDTree(SpatialIndex):
+  
+  root = None
+  
+  # How nodes are split, one of SPLIT_RULES.
+  split_rule = 'median'
+  
+  def __init__(self, data, dimensions, leaf_size=1, linked_key=None, 
+               workers=1, split_rule='median'):
     """ Initializes the kd-tree structure using input data, which is expected to
         be any list. 
         
@@ -524,9 +1080,44 @@ class KDTree:
         We build the tree by making a list sorted on each dimension,
         choosing the median as current splitting plane, and then creating sublists
         based around it. This uses O(n) space and O(nlog n) time.
+        
+        leaf_size is the most points a leaf can hold. With more than one,
+        splitting stops early and leaves hold buckets of points that are
+        compared to the query all at once.
+        
+        If linked_key is given, each point is expected to have a list of 
+        linked records under that key in its value dictionary, and every 
+        node counts the records under it. Searches for the nearest linked
+        records can then skip whole subtrees without any, so one tree can
+        serve both nearest point and nearest linked record queries.
+        
+        The tree is built by build_by_partition, which with more than one
+        worker has the subtrees below the top few levels built by worker
+        processes (see build_in_parallel). The tree is the same whatever 
+        the number of workers.
+        
+        split_rule is how nodes are split (see choose_split). With the 
+        median rule, the tree is the same as the sublist method's (see
+        build_by_sublists).
+        
+        Once built, every node gets the bounding box of the points under 
+        it (see set_boxes) for the searches to prune on.
     """
+    if split_rule not in SPLIT_RULES:
+      raise ValueError("Unknown split rule {}, expected one of {}.".
+                       format(split_rule, ', '.join(SPLIT_RULES)))
+    
     self.dimensions = dimensions
-    self.build_by_sublists(data)
+    self.leaf_size = leaf_size
+    self.split_rule = split_rule
+    self.build_by_partition(data, workers)
+    self.set_boxes()
+    
+    if linked_key is not None:
+      self.linked_key = linked_key
+      self.count_linked_records()
+    
+    self.version += 1
  
   def build_by_sublists(self, data):
     """ Function that starts the split/partition process. """
@@ -536,57 +1127,457 @@ class KDTree:
     sorted_by.append(sorted(range(len(data)), key=lambda k: data[k]['x']))
     sorted_by.append(sorted(range(len(data)), key=lambda k: data[k]['y']))
     
-    self.root = self.split_and_add(data, sorted_by)
+    # The bounding box of the points, from the ends of the sorted lists.
+    box = ([data[indexes[0]][dimension] if indexes else 0 
+            for dimension, indexes in zip(self.dimensions, sorted_by)],
+           [data[indexes[-1]][dimension] if indexes else 0 
+            for dimension, indexes in zip(self.dimensions, sorted_by)])
     
-  def get_splitting_dimension(self, data, sublists):
-    """ Given d lists of n items (sublists),
-        this function returns the dimension which has the highest spread.
-        The dimension is returned as an index into the sublists list. """
+    self.root = self.split_and_add(data, sorted_by, box)
     
-    # Find which dimension has the widest spread
-    spreads = []
-    for axis, sublist in enumerate(sublists):
-      
-      # Find the maximum and minimum data value present in the sublist
-      max_index = max(sublist, key=lambda k: data[k][self.dimensions[axis]]) 
-      max_value = data[max_index][self.dimensions[axis]]
-      
-      min_index = min(sublist, key=lambda k: data[k][self.dimensions[axis]]) 
-      min_value = data[min_index][self.dimensions[axis]]
-      
-      # Use the max and min coordinates on the current axis to calculate the 
-      # spread amount for each sublist
-      spread = max_value - min_value
-      spreads.append(spread)
-
-    # Pull out the index of the dimension with the max spread,
-    # which is the dimension we want to partition on.
-    dimension = max(range(len(spreads)), key=lambda k: spreads[k])
+  def build_by_partition(self, data, workers=1):
+    """ Builds the same tree as build_by_sublists, but instead of copying 
+        sublists for every node, one array of indexes into data is permuted
+        in place, so that the points under each node are always a range of 
+        it (see partition_range). With more than one worker, the ranges
+        below the top levels are built by build_in_parallel. """
     
-    return dimension    
+    indexes = range(len(data))
+    columns = point_columns(data, self.dimensions)
+    box = ([min(column) if column else 0 for column in columns],
+           [max(column) if column else 0 for column in columns])
     
-  def split_and_add(self, data, sublists):
-    """ Inputs: 
-          data - the list of points in dimensional space
-          sublists - a k-length list (k = #dimensions) of the data points
-                     sorted by dimension k, as indexes into data.
-                     All are equal length.
-          dimension - the dimension which the node added by this invocation
-                      will split on. Alternates for each level of the tree.
-    """ 
-        
-    # Base case: none or 1 item in the sublists.
-    size = len(sublists[0])
-    if size == 0:
-      return None;
-    elif size == 1:
-      # If there's 1 item in the sublists then create a leaf node and return it.
-      self.number_nodes += 1
-      self.leaf_nodes += 1
-      return KDTreeNode(point=data[sublists[0][0]])
+    if workers > 1:
+      self.root = self.build_in_parallel(data, indexes, columns, box, workers)
+    else:
+      self.root = self.partition_and_add(data, indexes, columns, 
+                                         0, len(indexes), box)
+    
+  def partition_range(self, indexes, columns, start, end, box):
+    """ Same as partition_sublists, for the points at indexes[start:end].
+        columns holds the coordinates of every point in data, one array per
+        dimension, and box is a box around the points in the range, as a 
+        list of the lowest and a list of the highest coordinates (see 
+        split_box).
+        
+        The range is rearranged in place so the points that go to the left
+        come first (see choose_split).
+        
+        Returns a tuple of (dimension, splitting_value, middle, left_box,
+        right_box), where middle is the start of the right part.
+    """
+    
+    dimension, middle, splitting_value = \
+      self.choose_split(indexes, columns, start, end, box)
+    left_box, right_box = self.split_box(box, dimension, splitting_value)
+    
+    return dimension, splitting_value, middle, left_box, right_box
+  
+  def split_box(self, box, dimension, splitting_value):
+    """ Returns the boxes of the left and the right side of a split of
+        box, by cutting it at the splitting value on the dimension.
+        
+        Only the root's box is the bounding box of its points. Below it, 
+        each node gets the part of its parent's box on its side of the
+        split, so the points never have to be scanned for it. The bounding
+        boxes searches prune on are set once the tree is built (see 
+        set_boxes). """
+    
+    lows, highs = box
+    left_highs = list(highs)
+    left_highs[dimension] = splitting_value
+    right_lows = list(lows)
+    right_lows[dimension] = splitting_value
+    return (lows, left_highs), (right_lows, highs)
+  
+  def range_box(self, indexes, columns, start, end):
+    """ Returns the bounding box of the points at indexes[start:end], in
+        the same form as partition_range takes it. """
+    
+    positions = xrange(start, end)
+    return ([min(column[indexes[position]] for position in positions) 
+             for column in columns],
+            [max(column[indexes[position]] for position in positions) 
+             for column in columns])
+  
+  def sorted_members(self, indexes, column, start, end):
+    """ Returns indexes[start:end] sorted on the given column, with ties 
+        broken by index. That keeps the points in the same order as the
+        sorted sublists would have them. """
+    
+    members = sorted(indexes[start:end])
+    members.sort(key=column.__getitem__)
+    return members
+  
+  def select(self, indexes, column, start, end, nth):
+    """ Rearranges indexes[start:end] in place so that the index at nth is
+        the one sorted_members would put there, with the ones it would put
+        before it in front and the rest behind, in no particular order.
+        
+        This is quickselect: the range is partitioned around its middle 
+        index, and only the side holding nth is partitioned again. It takes
+        linear time on average and makes no copies of the range. """
+    
+    while end - start > 1:
+      
+      # Move the pivot out of the way to the end, partition the rest, then
+      # put the pivot between the two sides.
+      pivot = indexes[(start + end) / 2]
+      pivot_value = column[pivot]
+      indexes[(start + end) / 2] = indexes[end - 1]
+      
+      store = start
+      for position in xrange(start, end - 1):
+        index = indexes[position]
+        value = column[index]
+        if value < pivot_value or (value == pivot_value and index < pivot):
+          indexes[position] = indexes[store]
+          indexes[store] = index
+          store += 1
+      indexes[end - 1] = indexes[store]
+      indexes[store] = pivot
+      
+      if nth < store:
+        end = store
+      elif nth > store:
+        start = store + 1
+      else:
+        return
+  
+  def partition_at(self, indexes, column, start, end, value):
+    """ Rearranges indexes[start:end] in place so that the ones whose 
+        coordinate in column is at most value come first, and returns the
+        position of the first one that isn't. """
+    
+    middle = start
+    for position in xrange(start, end):
+      index = indexes[position]
+      if column[index] <= value:
+        indexes[position] = indexes[middle]
+        indexes[middle] = index
+        middle += 1
+    return middle
+  
+  def choose_split(self, indexes, columns, start, end, box):
+    """ Chooses the splitting plane for the points at indexes[start:end] 
+        (see partition_range) with the tree's split_rule:
+        
+          median    splits the dimension with the widest spread in half, 
+                    like partition_sublists, so the tree is balanced.
+          midpoint  splits the dimension with the widest spread at the 
+                    middle of the box, which keeps cells from getting long
+                    and thin where points are clustered. If every point is
+                    on one side, the box is shrunk to the points' own 
+                    bounding box and the split chosen again. Then there are
+                    points on both sides, unless rounding puts the middle
+                    at the highest point; then the plane slides down to 
+                    that point, which goes right on its own.
+          cost      tries COST_SPLIT_CANDIDATES evenly spaced splits along
+                    each dimension, and takes the one with the lowest cost:
+                    the number of points on each side times the perimeter 
+                    of their bounding box, summed. A search is about as 
+                    likely to enter a box as the box is big, so this cuts 
+                    empty space off clusters.
+        
+        If the box has no spread on any dimension, the points are all 
+        duplicates, and any rule splits them in half so they can't make a
+        long chain of nodes.
+        
+        The points that go to the left are the ones that come first when
+        the range is sorted on the dimension with ties broken by index (see
+        sorted_members), as they would in the sorted sublists. The median 
+        and midpoint rules only select them in place (see select and 
+        partition_at), while the cost rule sorts the range.
+        
+        Returns a tuple of (dimension, middle, splitting_value), where 
+        indexes[start:middle] go to the left.
+    """
+    lows, highs = box
+    size = end - start
     
     # Choose the dimension with the largest spread to split on
-    dimension = self.get_splitting_dimension(data, sublists)
+    dimension = self.get_splitting_dimension(box)
+    spread = highs[dimension] - lows[dimension]
+    
+    # The cost rule sorts the range anyway, so it can afford to check the
+    # points' own box for duplicates.
+    if self.split_rule == 'cost' and spread > 0:
+      points_lows, points_highs = self.range_box(indexes, columns, start, end)
+      if points_lows != points_highs:
+        return self.choose_cost_split(indexes, columns, start, end)
+    
+    column = columns[dimension]
+    
+    if self.split_rule == 'midpoint' and spread > 0:
+      midpoint = (lows[dimension] + highs[dimension]) / 2
+      middle = self.partition_at(indexes, column, start, end, midpoint)
+      if start < middle < end:
+        return dimension, middle, midpoint
+      
+      # The box is only the part of the parent's box on this side (see 
+      # split_box), so the points can all be on one side of its middle.
+      points_box = self.range_box(indexes, columns, start, end)
+      if points_box != (lows, highs):
+        return self.choose_split(indexes, columns, start, end, points_box)
+      
+      self.select(indexes, column, start, end, end - 1)
+      return dimension, end - 1, column[indexes[end - 1]]
+    
+    # Split at the median, at the average of the two middle coordinates.
+    middle = start + size/2
+    self.select(indexes, column, start, end, middle)
+    below = max(column[indexes[position]] 
+                for position in xrange(start, middle))
+    splitting_value = (column[indexes[middle]] + below) / 2
+    return dimension, middle, splitting_value
+  
+  def choose_cost_split(self, indexes, columns, start, end):
+    """ Returns the split the cost rule of choose_split picks for the points
+        at indexes[start:end], in the same form, sorting the range on the 
+        dimension it splits.
+        
+        The range is sorted once per dimension. The candidates cut it into
+        chunks, and the lowest and highest coordinates of each chunk are 
+        taken once. Running them from either end gives the box of both 
+        sides of every candidate, so each cost is worked out in O(1) 
+        instead of scanning its sides again.
+    """
+    
+    size = end - start
+    step = max(1, size / COST_SPLIT_CANDIDATES)
+    halves = range(step, size, step)
+    bounds = [0] + halves + [size]
+    
+    best = None
+    for dimension, column in enumerate(columns):
+      members = self.sorted_members(indexes, column, start, end)
+      
+      # The perimeters of the boxes on the left and the right of each 
+      # candidate, summed over the axes in order.
+      left_perimeters = [0] * len(halves)
+      right_perimeters = [0] * len(halves)
+      for other_column in columns:
+        values = map(other_column.__getitem__, members)
+        chunks = [(min(values[chunk_start:chunk_end]), 
+                   max(values[chunk_start:chunk_end]))
+                  for chunk_start, chunk_end in zip(bounds, bounds[1:])]
+        
+        low, high = chunks[0]
+        for candidate in range(len(halves)):
+          low = min(low, chunks[candidate][0])
+          high = max(high, chunks[candidate][1])
+          left_perimeters[candidate] += high - low
+        
+        low, high = chunks[-1]
+        for candidate in reversed(range(len(halves))):
+          low = min(low, chunks[candidate + 1][0])
+          high = max(high, chunks[candidate + 1][1])
+          right_perimeters[candidate] += high - low
+      
+      for candidate, half in enumerate(halves):
+        cost = (half * left_perimeters[candidate] + 
+                (size - half) * right_perimeters[candidate])
+        
+        if best is None or cost < best[0]:
+          splitting_value = (column[members[half]] + 
+                             column[members[half - 1]]) / 2
+          best = (cost, members, (dimension, start + half, splitting_value))
+    
+    cost, members, split = best
+    indexes[start:end] = members
+    return split
+  
+  def leaf_indexes(self, indexes, columns, start, end):
+    """ Returns the indexes of the points for a leaf holding 
+        indexes[start:end], in the order the first sorted sublist would 
+        have them (by the first coordinate, then by index). """
+    
+    members = sorted(indexes[start:end])
+    members.sort(key=columns[0].__getitem__)
+    return members
+  
+  def partition_and_add(self, data, indexes, columns, start, end, box):
+    """ Same as split_and_add, for the points at indexes[start:end] (see 
+        partition_range). 
+        
+        Ranges still to be split are kept on a stack instead of recursing,
+        as the midpoint and cost rules can make trees far deeper than the 
+        recursion limit. Each range comes off the stack with the node its 
+        own node hangs from, and the left range is split before the right
+        one, so nodes are made in the same order as by recursing.
+    """
+    
+    root = None
+    
+    # Entries are (start, end, box, parent node, child attribute).
+    stack = [(start, end, box, None, None)]
+    while stack:
+      
+      start, end, box, parent, side = stack.pop()
+      size = end - start
+      if size == 0:
+        continue
+      elif size == 1:
+        self.number_nodes += 1
+        self.leaf_nodes += 1
+        self.number_points += 1
+        node = KDTreeNode(point=data[indexes[start]], index=indexes[start])
+      elif size <= self.leaf_size:
+        self.number_nodes += 1
+        self.leaf_nodes += 1
+        self.number_points += size
+        members = self.leaf_indexes(indexes, columns, start, end)
+        node = KDTreeNode(bucket=[data[index] for index in members],
+                          indexes=members)
+      else:
+        dimension, splitting_value, middle, left_box, right_box = \
+          self.partition_range(indexes, columns, start, end, box)
+        
+        self.number_nodes += 1
+        node = KDTreeNode(axis=self.dimensions[dimension],
+                          value=splitting_value)
+        stack.append((middle, end, right_box, node, 'right_child'))
+        stack.append((start, middle, left_box, node, 'left_child'))
+      
+      if parent is None:
+        root = node
+      else:
+        setattr(parent, side, node)
+    
+    return root
+    
+  def build_in_parallel(self, data, indexes, columns, box, workers):
+    """ Same as partition_and_add for the whole of indexes, but only the top
+        few levels of the tree are split here. The ranges below them are 
+        built into subtrees by a pool of worker processes, nodes and all 
+        (see build_subtree), then added to the tree in the same order 
+        partition_and_add would have made them, so the tree comes out the 
+        same.
+        
+        About four subtrees are made per worker, so the work evens out when
+        some of them take longer. Splitting the top levels and stitching the
+        subtrees onto them (see add_plan) is serial, in this process.
+    """
+    
+    levels = int(math.ceil(math.log(workers * 4, 2)))
+    
+    # Split the top levels, keeping a plan of the splits, with the index of
+    # the subtree task in place of each subtree.
+    tasks = []
+    def plan_splits(start, end, box, depth):
+      if depth == levels or end - start <= self.leaf_size:
+        tasks.append((start, end, box))
+        return len(tasks) - 1
+      
+      dimension, splitting_value, middle, left_box, right_box = \
+        self.partition_range(indexes, columns, start, end, box)
+      
+      return (dimension, splitting_value, 
+              plan_splits(start, middle, left_box, depth + 1),
+              plan_splits(middle, end, right_box, depth + 1))
+    
+    plan = plan_splits(0, len(indexes), box, 0)
+    
+    parallel_build_state.update(tree=self, data=data, indexes=indexes, 
+                                columns=columns, tasks=tasks)
+    pool = multiprocessing.Pool(workers)
+    try:
+      subtrees = pool.map(build_subtree, range(len(tasks)))
+    finally:
+      pool.close()
+      pool.join()
+      parallel_build_state.clear()
+    
+    return self.add_plan(data, plan, subtrees)
+  
+  def build_subtree(self, data, indexes, columns, start, end, box):
+    """ Builds the subtree for the points at indexes[start:end] in a worker
+        process of build_in_parallel, and returns it as a tuple of its 
+        number of nodes, leaves and points, and its nodes pickled as a list,
+        for add_subtree.
+        
+        The nodes are listed in reverse pre-order, so every node's children
+        are pickled before it and the pickler never recurses down the tree,
+        however deep it is. The data points are pickled as their index into
+        data, so they're unpickled as the very same objects.
+    """
+    
+    builder = KDTree([], self.dimensions, self.leaf_size, 
+                     split_rule=self.split_rule)
+    builder.root = builder.partition_and_add(data, indexes, columns, 
+                                             start, end, box)
+    nodes = builder.preorder_nodes()
+    nodes.reverse()
+    
+    stream = cStringIO.StringIO()
+    pickler = cPickle.Pickler(stream, cPickle.HIGHEST_PROTOCOL)
+    if not isinstance(data, PointStore):
+      point_indexes = dict((id(data[index]), index) 
+                           for index in indexes[start:end])
+      pickler.persistent_id = lambda item: point_indexes.get(id(item))
+    pickler.dump(nodes)
+    
+    return (builder.number_nodes, builder.leaf_nodes, builder.number_points,
+            stream.getvalue())
+  
+  def add_plan(self, data, plan, subtrees):
+    """ Makes the nodes for a plan of splits from build_in_parallel, adding
+        the subtrees that were built for it, and returns the top one. """
+    
+    if not isinstance(plan, tuple):
+      return self.add_subtree(data, subtrees[plan])
+    
+    dimension, splitting_value, left_plan, right_plan = plan
+    
+    self.number_nodes += 1
+    node = KDTreeNode(axis=self.dimensions[dimension],
+                      value=splitting_value)
+    node.left_child = self.add_plan(data, left_plan, subtrees)
+    node.right_child = self.add_plan(data, right_plan, subtrees)
+    
+    return node
+  
+  def add_subtree(self, data, subtree):
+    """ Unpickles the nodes of a subtree from build_subtree, and returns the
+        top one (or None for an empty subtree). """
+    
+    number_nodes, leaf_nodes, number_points, pickled = subtree
+    self.number_nodes += number_nodes
+    self.leaf_nodes += leaf_nodes
+    self.number_points += number_points
+    
+    unpickler = cPickle.Unpickler(cStringIO.StringIO(pickled))
+    unpickler.persistent_load = data.__getitem__
+    nodes = unpickler.load()
+    
+    return nodes[-1] if nodes else None
+    
+  def get_splitting_dimension(self, box):
+    """ Given the box of a node (see split_box),
+        this function returns the dimension which has the highest spread.
+        The dimension is returned as an index into self.dimensions. """
+    
+    # Find which dimension has the widest spread
+    lows, highs = box
+    spreads = [high - low for low, high in zip(lows, highs)]
+
+    # Pull out the index of the dimension with the max spread,
+    # which is the dimension we want to partition on.
+    dimension = max(range(len(spreads)), key=lambda k: spreads[k])
+    
+    return dimension    
+    
+  def partition_sublists(self, data, sublists, box):
+    """ Chooses the splitting plane for the points in sublists, within
+        box (see split_box), and partitions them around it.
+        
+        Returns a tuple of (dimension, splitting_value, left_sublists, 
+        right_sublists), where dimension is an index into self.dimensions.
+    """
+    size = len(sublists[0])
+    
+    # Choose the dimension with the largest spread to split on
+    dimension = self.get_splitting_dimension(box)
     
     # We are indexing into the sublist sorted by this dimension so we know
     # where the median is and can then index into the original data list with it.
@@ -597,11 +1588,6 @@ class KDTree:
     splitting_value = (data[median_index][self.dimensions[dimension]] +
                        data[before_median_index][self.dimensions[dimension]]) / 2                      
     
-    # Now create the internal node that defines this splitting line.
-    self.number_nodes += 1
-    node = KDTreeNode(axis=self.dimensions[dimension],
-                      value=splitting_value)
-    
     # Create 2 sets of k sublists so we can recurse on each branch. 
     left_sublists = range(len(self.dimensions))
     right_sublists = range(len(self.dimensions))
@@ -612,6 +1598,10 @@ class KDTree:
      
     # Now do a linear traversal of the other dimensions' lists
     # to partition them based on the splitting axis of the newly created node.
+    # Points go to the same side they went to in the sorted list, rather than
+    # being compared to the splitting value, so that points lying exactly on
+    # the splitting value (duplicates) can't end up on both sides or neither.
+    left_members = set(left_sublists[dimension])
     for axis, value in enumerate(self.dimensions):
       
       # Partition all lists but the current dimension
@@ -621,34 +1611,73 @@ class KDTree:
         right_sublists[axis] = []
         for index in sublists[axis]:
           
-          # Index into the points list to compare 
-          if data[index][self.dimensions[dimension]] <= splitting_value:
-             # If the 'x' coordinate of the y-sorted list is less than the x splitting coordinate
-             # it should go in the left subtree.
+          if index in left_members:
              left_sublists[axis].append(index)
-             
-          # We ignore values equal to the splitting value because those are already in the tree.
-          elif data[index][self.dimensions[dimension]] > splitting_value:
-              
-              right_sublists[axis].append(index)
+          else:
+             right_sublists[axis].append(index)
+    
+    return dimension, splitting_value, left_sublists, right_sublists
+    
+  def split_and_add(self, data, sublists, box):
+    """ Inputs: 
+          data - the list of points in dimensional space
+          sublists - a k-length list (k = #dimensions) of the data points
+                     sorted by dimension k, as indexes into data.
+                     All are equal length.
+          box - the box of the node, as a list of the lowest and a list of
+                the highest coordinates (see split_box).
+    """ 
+        
+    # Base case: none or 1 item in the sublists.
+    size = len(sublists[0])
+    if size == 0:
+      return None;
+    elif size == 1:
+      # If there's 1 item in the sublists then create a leaf node and return it.
+      self.number_nodes += 1
+      self.leaf_nodes += 1
+      self.number_points += 1
+      return KDTreeNode(point=data[sublists[0][0]], index=sublists[0][0])
+    elif size <= self.leaf_size:
+      # Few enough items to put them all in a bucket leaf.
+      self.number_nodes += 1
+      self.leaf_nodes += 1
+      self.number_points += size
+      return KDTreeNode(bucket=[data[index] for index in sublists[0]],
+                        indexes=sublists[0])
+    
+    dimension, splitting_value, left_sublists, right_sublists = \
+      self.partition_sublists(data, sublists, box)
+    left_box, right_box = self.split_box(box, dimension, splitting_value)
+    
+    # Now create the internal node that defines this splitting line.
+    self.number_nodes += 1
+    node = KDTreeNode(axis=self.dimensions[dimension],
+                      value=splitting_value)
                  
     # Recurse on the left and right subtrees using the newly created sublists.)
-    node.left_child = self.split_and_add(data, left_sublists)
-    node.right_child = self.split_and_add(data, right_sublists)
+    node.left_child = self.split_and_add(data, left_sublists, left_box)
+    node.right_child = self.split_and_add(data, right_sublists, right_box)
     
     # Return the reference to the created node/subtree
     return node  
   
-  def k_nearest(self, query, k, stats):
+  def k_nearest(self, query, k, stats, single_pass=False):
     """ This is a function to return the k nearest points to the query.
         query must be a dictionary which contains a point location.
         stats should be an empty initialized dictionary, it will be passed
         back with diagnostic information.
         
         k is clipped to the number of data points in the tree.
+        
+        If single_pass is True the search is done in one traversal with a
+        bounded heap instead of widening the search radius over several passes.
     """
     # Make sure k is no higher than the total number of points in the tree
-    max_possible_results = min(k, self.leaf_nodes)
+    max_possible_results = min(k, self.number_points)
+    
+    if single_pass:
+      return self.root.k_nearest_single_pass(query, max_possible_results, stats)
     
     return self.root.k_nearest(query, max_possible_results, stats)
   
@@ -663,6 +1692,1154 @@ class KDTree:
     """
     # Make sure k is no higher than the number of unique linked records in the tree.
     max_possible_results = min(k, max_possible_records)
+    
+    linked_only = key_name == self.linked_key
+    if linked_only:
+      max_possible_results = min(max_possible_results, 
+                                 self.root.linked_records)
+      
     return self.root.k_nearest_linked_records(query, max_possible_results, 
-                                             key_name, stats)
-  
\ No newline at end of file
+                                             key_name, stats, linked_only)
+  
+  def count_linked_records(self):
+    """ Sets linked_points and linked_records on every node, for the 
+        records under the linked_key of each point. Leaves in a bucket get
+        their own counts too, so searches can skip them one by one. Nodes
+        get their linked_box and linked_node as well.
+        
+        The nodes are counted from the last one in pre-order back, so every
+        node's children are counted before it without recursing. """
+    
+    linked_key = self.linked_key
+    for node in reversed(self.preorder_nodes()):
+      left = node.left_child
+      right = node.right_child
+      
+      if not left and not right and not node.bucket:
+        records = len(node.point['value'][linked_key])
+        node.linked_points = 1 if records else 0
+        node.linked_records = records
+        continue
+      
+      node.linked_node = None
+      node.linked_box = None
+      if left or right:
+        node.linked_points = ((left.linked_points if left else 0) + 
+                              (right.linked_points if right else 0))
+        node.linked_records = ((left.linked_records if left else 0) + 
+                               (right.linked_records if right else 0))
+        if left and right and left.linked_points and right.linked_points:
+          left_box = left.linked_box or left.box
+          right_box = right.linked_box or right.box
+          node.linked_box = (min(left_box[0], right_box[0]), 
+                             min(left_box[1], right_box[1]),
+                             max(left_box[2], right_box[2]),
+                             max(left_box[3], right_box[3]))
+        elif node.linked_points:
+          child = left if left and left.linked_points else right
+          node.linked_node = child.linked_node or child
+          node.linked_box = child.linked_box or child.box
+        continue
+      
+      xs = []
+      ys = []
+      node.linked_points = 0
+      node.linked_records = 0
+      for member in node.bucket:
+        records = len(member.point['value'][linked_key])
+        member.linked_points = 1 if records else 0
+        member.linked_records = records
+        if records:
+          node.linked_points += 1
+          node.linked_records += records
+          xs.append(member.point['x'])
+          ys.append(member.point['y'])
+      if xs:
+        node.linked_box = (min(xs), min(ys), max(xs), max(ys))
+  
+  def preorder_nodes(self):
+    """ Returns a list of the nodes of the tree in pre-order, so each node
+        comes before the nodes under it. """
+    
+    nodes = []
+    stack = [self.root] if self.root else []
+    while stack:
+      node = stack.pop()
+      nodes.append(node)
+      stack.extend(child for child in (node.right_child, node.left_child) 
+                   if child)
+    return nodes
+  
+  def depth(self):
+    """ Returns the number of nodes on the longest path from the root down
+        to a leaf (0 for an empty tree). """
+    
+    depth = 0
+    stack = [(self.root, 1)] if self.root else []
+    while stack:
+      node, node_depth = stack.pop()
+      depth = max(depth, node_depth)
+      for child in (node.left_child, node.right_child):
+        if child:
+          stack.append((child, node_depth + 1))
+    
+    return depth
+  
+  def set_boxes(self):
+    """ Sets the box of every node to the bounding box of the points under
+        it, as (min x, min y, max x, max y). A single point's box has no 
+        area, and the points in a bucket don't get one. Like 
+        count_linked_records, this goes backwards through the nodes in 
+        pre-order. The lowest index of the points follows the coordinates 
+        (see KDTreeNode.box). """
+    
+    for node in reversed(self.preorder_nodes()):
+      if node.is_leaf() and node.bucket:
+        node.box = (min(node.bucket_xs), min(node.bucket_ys), 
+                    max(node.bucket_xs), max(node.bucket_ys),
+                    min(member.index for member in node.bucket))
+      elif node.is_leaf():
+        node.box = (node.point['x'], node.point['y'], 
+                    node.point['x'], node.point['y'], node.index)
+      else:
+        child_boxes = [child.box for child in 
+                       (node.left_child, node.right_child) if child]
+        node.box = (min(child[0] for child in child_boxes), 
+                    min(child[1] for child in child_boxes),
+                    max(child[2] for child in child_boxes),
+                    max(child[3] for child in child_boxes),
+                    min(child[4] for child in child_boxes))
+  
+  def bounding_boxes(self):
+    """ Returns a dictionary mapping each node of the tree to its box (see
+        set_boxes). """
+    return dict((node, node.box) for node in self.preorder_nodes())
+  
+  def node_children(self, node):
+    """ Returns the children of a node, none for a leaf. """
+    return [child for child in (node.left_child, node.right_child) if child]
+  
+  def leaf_values(self, node):
+    """ Returns (value, x, y) for every point in a leaf node. """
+    return [(leaf.point['value'], leaf.point['x'], leaf.point['y']) 
+            for leaf in node.bucket or [node]]
+  
+  def leaf_keys(self, node, x, y):
+    """ Returns (leaf, key, index) for every point in a leaf node, with 
+        the keys to (x, y) as given by KDTreeNode.bucket_keys. """
+    query = {'x': x, 'y': y}
+    if node.bucket:
+      return [(leaf, key, leaf.index) 
+              for leaf, key in node.bucket_keys(query)]
+    return [(node, KDTreeNode.distance_key(node.point, query), node.index)]
+  
+  def make_query(self, x, y):
+    """ Returns a query for the given location, in the form taken by 
+        search_k_nearest. """
+    return {'x': x, 'y': y}
+  
+  def search_k_nearest(self, query, mins_so_far, stats):
+    """ Searches the whole tree for the points nearest to the query, in
+        one pass that adds them to the KNearestHeap mins_so_far. """
+    self.root.find_k_nearest(query, mins_so_far, stats)
+  
+  def candidate_point(self, candidate):
+    """ Returns the data point of a candidate in a KNearestHeap. """
+    return candidate.point
+  
+  def k_nearest_dual_tree(self, xs, ys, ks, stats, id_name='id'):
+    """ Same as k_nearest_batch, but builds a second kd-tree over the 
+        query points and searches both trees together with DualTreeSearch.
+        Answers are the same, ties included, but in Python walking pairs
+        of nodes costs more than it saves: it's several times slower than
+        k_nearest_batch (see test_kdtree.check_batch), so main.py doesn't
+        offer it as an engine. 
+        
+        stats gets 'nodes', the number of pairs of nodes visited, and 
+        'node_counts', the number of leaves each query was compared with.
+    """
+    
+    query_points = [{'x': x, 'y': y, 'value': index} 
+                    for index, (x, y) in enumerate(zip(xs, ys))]
+    query_tree = self.make_query_tree(query_points)
+    
+    search = DualTreeSearch(query_tree, self, ks)
+    search.search(query_tree.root, self.root)
+    
+    ids = []
+    distances = []
+    for mins_so_far in search.heaps:
+      nearest = mins_so_far.sorted_list()
+      ids.append([self.candidate_point(result['point'])['value'][id_name] 
+                  for result in nearest])
+      distances.append([result['distance'] for result in nearest])
+      
+    stats['nodes'] = search.pairs
+    stats['node_counts'] = search.node_counts
+    stats['pass_counts'] = [1] * len(ks)
+    
+    return {'ids': ids,
+            'distances': distances}
+  
+  def make_query_tree(self, query_points):
+    """ Builds the tree over the query points for k_nearest_dual_tree. """
+    return KDTree(query_points, self.dimensions, self.leaf_size)
+
+class PointArrayIndex(SpatialIndex):
+  """ The point arrays of FlatKDTree, and the searches built on them, for
+      indexes that store their points that way (see also gridindex, 
+      mortonindex and balltree).
+  
+      Points are stored in the order of the index, with one array of 
+      coordinates per dimension, and leaf_points maps each position back to
+      the index of the point in the original data, which is kept as a list
+      (points) or a PointStore (store). Searches work on positions, and 
+      only turn them into points to report results.
+      
+      An index gives find_k_nearest(node, query, mins_so_far, stats) and 
+      nearest_positions_iter(query, stats, linked_only), which take queries
+      as tuples of coordinates. By default its nodes are a binary tree of
+      left_children and right_children arrays, numbered so that children
+      come after their parent, where a node without children is a leaf 
+      holding positions bucket_starts[node] up to bucket_ends[node]. 
+      Indexes laid out some other way override depth and 
+      count_node_records.
+  """
+  
+  root = 0
+  
+  # The PointStore the index was built from, if it was, and the VisitedSet
+  # of its record numbers used by k_nearest_linked_records, made on first
+  # use (so each worker process makes its own).
+  store = None
+  visited_records = None
+  
+  # The number of linked records of every point, set by 
+  # count_linked_records, and their total.
+  point_records = None
+  linked_total = 0
+  
+  # The name of the engine in snapshots (and main.ENGINES), and the 
+  # attributes a snapshot keeps besides its header and arrays.
+  snapshot_engine = None
+  snapshot_attributes = ('linked_total',)
+  
+  def set_points(self, data):
+    """ Keeps the original data points, a list or a PointStore, for 
+        reporting results. """
+    
+    if isinstance(data, PointStore):
+      self.store = data
+    else:
+      self.points = [data[index] for index in range(len(data))]
+  
+  def point(self, position):
+    """ Returns the original data point stored at the given position. """
+    if self.store is not None:
+      return self.store[self.leaf_points[position]]
+    return self.points[self.leaf_points[position]]
+  
+  def k_nearest(self, query, k, stats, single_pass=True):
+    """ Same as KDTree.k_nearest. The search always takes a single pass, 
+        and the 'point' of each result is a leaf KDTreeNode wrapping the 
+        original data point.
+    """
+    stats['nodes'] = 0
+    stats['passes'] = 0
+    
+    # Make sure k is no higher than the total number of points in the tree
+    max_possible_results = min(k, self.number_points)
+    
+    query = tuple(query[dimension] for dimension in self.dimensions)
+    mins_so_far = self.find_k_nearest_positions(query, max_possible_results, 
+                                                stats)
+    
+    results = mins_so_far.results()
+    for result in results['list']:
+      result['point'] = KDTreeNode(point=self.point(result['point']))
+    
+    return results
+  
+  def make_query(self, x, y):
+    """ Same as KDTree.make_query, but as a tuple of coordinates. """
+    return (x, y)
+  
+  def search_k_nearest(self, query, mins_so_far, stats):
+    """ Same as KDTree.search_k_nearest, with the query given as a tuple. 
+        The candidates are point positions. """
+    self.find_k_nearest(self.root, query, mins_so_far, stats)
+  
+  def candidate_point(self, candidate):
+    """ Returns the data point at the position of a candidate. """
+    return self.point(candidate)
+  
+  def compare_range(self, start, end, query, mins_so_far):
+    """ Offers the points at positions start up to end to mins_so_far. The
+        keys for the whole range are computed at once. """
+    
+    keys = bucket_keys(self.coordinates[0][start:end],
+                       self.coordinates[1][start:end], query[0], query[1])
+    
+    leaf_points = self.leaf_points
+    key_radius = mins_so_far.key_radius()
+    for position, key in enumerate(keys, start):
+      if key < key_radius:
+        mins_so_far.insert(position, key, leaf_points[position])
+        key_radius = mins_so_far.key_radius()
+  
+  def find_k_nearest_positions(self, query, k, stats):
+    """ Returns a KNearestHeap holding the positions of the k points nearest 
+        to the query (a tuple of coordinates), found in a single pass of
+        find_k_nearest over the whole index.
+    """
+    
+    mins_so_far = KNearestHeap(k)
+    self.find_k_nearest(self.root, query, mins_so_far, stats)
+    stats['passes'] += 1
+    
+    return mins_so_far
+  
+  def count_linked_records(self):
+    """ Same as KDTree.count_linked_records: counts the linked records of
+        every point (point_records) and their total (linked_total), then 
+        those of the nodes (see count_node_records). """
+    
+    if self.store is not None and self.linked_key == self.store.linked_key:
+      self.point_records = array('l', (self.store.record_count(index) 
+                                       for index in self.leaf_points))
+    else:
+      self.point_records = array('l', 
+        (len(self.point(position)['value'][self.linked_key]) 
+         for position in range(self.number_points)))
+    self.linked_total = sum(self.point_records)
+    
+    self.count_node_records()
+  
+  def count_node_records(self):
+    """ Sets linked_points and linked_records for every node, the number 
+        of points under it with any linked records and the number of 
+        records they link to. """
+    
+    self.linked_points = array('l', [0]) * self.number_nodes
+    self.linked_records = array('l', [0]) * self.number_nodes
+    
+    # Children are always numbered after their parent, so going backwards
+    # through the nodes counts every subtree before the node above it.
+    for node in reversed(range(self.number_nodes)):
+      children = [child for child in (self.left_children[node], 
+                                      self.right_children[node]) 
+                  if child >= 0]
+      if not children:
+        records = self.point_records[self.bucket_starts[node]:
+                                     self.bucket_ends[node]]
+        self.linked_points[node] = sum(1 for count in records if count)
+        self.linked_records[node] = sum(records)
+        continue
+      
+      for child in children:
+        self.linked_points[node] += self.linked_points[child]
+        self.linked_records[node] += self.linked_records[child]
+  
+  def depth(self):
+    """ Same as KDTree.depth, for the node arrays. """
+    
+    depth = 0
+    stack = [(self.root, 1)] if self.number_nodes else []
+    while stack:
+      node, node_depth = stack.pop()
+      depth = max(depth, node_depth)
+      for child in (self.left_children[node], self.right_children[node]):
+        if child >= 0:
+          stack.append((child, node_depth + 1))
+    
+    return depth
+  
+  def k_nearest_linked_records(self, query, k, 
+                               key_name, max_possible_records,
+                               stats):
+    """ Same as KDTree.k_nearest_linked_records, taking points from 
+        nearest_positions_iter. """
+    
+    stats['nodes'] = 0
+    stats['passes'] = 1
+    
+    # Make sure k is no higher than the number of unique linked records in the tree.
+    num_results = min(k, max_possible_records)
+    
+    linked_only = key_name == self.linked_key
+    if linked_only:
+      num_results = min(num_results, self.linked_total)
+    
+    query = tuple(query[dimension] for dimension in self.dimensions)
+    
+    if self.store is not None and key_name == self.store.linked_key:
+      return {key_name: self.nearest_store_records(query, num_results, 
+                                                   stats, linked_only)}
+    
+    # Take points closest first until they link to enough unique records.
+    seen = set()
+    record_list = []
+    for position, distance in self.nearest_positions_iter(query, stats,
+                                                          linked_only):
+      
+      records = self.point(position)['value'][key_name]
+      for record_id in sorted(records):
+        if record_id not in seen:
+          seen.add(record_id)
+          record_list.append({'id': record_id, 'distance': distance})
+            
+      if len(record_list) >= num_results:
+        break
+    
+    return {key_name: record_list}
+  
+  def nearest_store_records(self, query, k, stats, linked_only=False):
+    """ Same as k_nearest_linked_records for the records of the store, 
+        returning the list of records. 
+        
+        Records in a store are numbered in order of their ids, and each 
+        point's are already sorted, so they're taken straight from the 
+        store's arrays. Duplicates are skipped with a VisitedSet of record
+        numbers, and numbers are only turned into ids at the end.
+    """
+    
+    store = self.store
+    if self.visited_records is None:
+      self.visited_records = VisitedSet(len(store.record_ids))
+    visited = self.visited_records
+    visited.clear()
+    stamps = visited.stamps
+    generation = visited.generation
+    
+    linked_records = []
+    distances = []
+    for position, distance in self.nearest_positions_iter(query, stats,
+                                                          linked_only):
+      
+      index = self.leaf_points[position]
+      for record in store.records[store.record_offsets[index]:
+                                  store.record_offsets[index + 1]]:
+        if stamps[record] != generation:
+          stamps[record] = generation
+          linked_records.append(record)
+          distances.append(distance)
+      
+      if len(linked_records) >= k:
+        break
+    
+    return [{'id': store.record_ids[record], 'distance': distance}
+            for record, distance in zip(linked_records, distances)]
+  
+  def snapshot_sections(self):
+    """ Returns (name, array typecode, size) for the arrays of the index 
+        in a snapshot file, in the order they're stored, each starting at a
+        multiple of 8 bytes. An array per dimension is named (name, axis).
+        size is the kind of length the array has: 'nodes', 'points', 
+        'node_offsets' or 'point_offsets' (one more than the nodes or 
+        points) or 'records'.
+        
+        These are the point arrays. Subclasses add their own arrays ahead 
+        of them. """
+    
+    return ([('leaf_points', 'l', 'points'), ('point_ids', 'l', 'points')] + 
+            [(('coordinates', axis), 'd', 'points') 
+             for axis in range(len(self.dimensions))] +
+            [('point_records', 'l', 'points'), 
+             ('record_offsets', 'l', 'point_offsets'), 
+             ('records', 'l', 'records')])
+  
+  def save_snapshot(self, filename, max_possible_records=0, id_name='id'):
+    """ Writes the index to a binary file that its snapshot class (see 
+        SnapshotIndex) can map back into memory without rebuilding or 
+        deserializing anything. 
+        
+        Along with the arrays of snapshot_sections, the file holds the id 
+        (from id_name in the value dictionary) of every point, and, if the
+        index has a linked_key, the linked records of every point in 
+        compressed sparse row form: record_offsets[position] up to 
+        record_offsets[position + 1] is the range of the records array 
+        holding the records of that point. max_possible_records is kept so
+        linked record queries can be clipped the same way after loading.
+    """
+    
+    number_points = self.number_points
+    sections = {'point_ids': array('l', (self.point(position)['value'][id_name]
+                                         for position in range(number_points)))}
+    
+    records = array('l')
+    record_offsets = array('l', [0])
+    if self.linked_key is not None:
+      for position in range(number_points):
+        records.extend(self.point(position)['value'][self.linked_key])
+        record_offsets.append(len(records))
+    else:
+      record_offsets *= number_points + 1
+    sections['records'] = records
+    sections['record_offsets'] = record_offsets
+    
+    names = json.dumps({'engine': self.snapshot_engine,
+                        'dimensions': self.dimensions,
+                        'linked_key': self.linked_key,
+                        'attributes': dict((name, getattr(self, name)) 
+                                           for name in 
+                                           self.snapshot_attributes)})
+    
+    sizes = {'nodes': self.number_nodes, 
+             'node_offsets': self.number_nodes + 1,
+             'points': number_points, 
+             'point_offsets': number_points + 1,
+             'records': len(records)}
+    
+    with open(filename, 'wb') as snapshot:
+      snapshot.write(struct.pack(SNAPSHOT_HEADER, SNAPSHOT_MAGIC, 
+                                 SNAPSHOT_VERSION, self.leaf_size, 
+                                 self.root, self.number_nodes, 
+                                 self.leaf_nodes, number_points, len(records),
+                                 max_possible_records, len(names)))
+      snapshot.write(names)
+      
+      for name, typecode, size in self.snapshot_sections():
+        snapshot.write('\0' * (-snapshot.tell() % 8))
+        if name in sections:
+          section = sections[name]
+        elif isinstance(name, tuple):
+          section = getattr(self, name[0])[name[1]]
+        else:
+          section = getattr(self, name, None)
+        
+        # Without a linked_key, the linked record counts were never made.
+        if section is None or len(section) != sizes[size]:
+          section = array(typecode, [0]) * sizes[size]
+        elif getattr(section, 'typecode', None) != typecode:
+          section = array(typecode, section)
+        section.tofile(snapshot)
+
+class FlatKDTree(PointArrayIndex, KDTree):
+  """ A kd-tree stored in flat arrays instead of a graph of KDTreeNode's.
+  
+      The tree is built exactly like KDTree, but each node is just an index
+      into a set of parallel arrays holding its splitting axis, splitting 
+      value and children. Nodes are numbered in the order they're created 
+      (pre-order), so the root is node 0 and a missing child is -1. 
+      
+      Leaves have an axis of -1 and cover a range of positions 
+      (bucket_starts[node] up to bucket_ends[node]) in the point arrays. 
+      Points are stored in the order their leaves were created, with one
+      array of coordinates per dimension, and leaf_points maps each position
+      back to the index of the point in the original data (see 
+      PointArrayIndex). So a query only touches contiguous arrays of 
+      numbers until the results are reported.
+      
+      With a linked_key, the counts of linked records are kept in two more
+      per node arrays, and the number of records of each point in 
+      point_records. The linked box of each node is kept in linked_lows 
+      and linked_highs, laid out like its box, and its linked node (see 
+      KDTreeNode.linked_node) in linked_nodes, which is -1 where it has 
+      none.
+      
+      The bounding box of each node (see KDTreeNode.box) is kept in 
+      box_lows and box_highs, which hold an array of the lowest and one of
+      the highest coordinates per dimension, and the lowest index of the
+      points under it (see KDTreeNode.box) in lowest_indexes.
+      
+      If the data is a PointStore, the tree keeps it instead of a list of 
+      the original points. The coordinates are copied straight from its 
+      arrays, and searches for the records it links take them from its
+      sorted ranges of record numbers.
+  """
+  
+  snapshot_engine = 'flat'
+  snapshot_attributes = PointArrayIndex.snapshot_attributes + ('split_rule',)
+  
+  def __init__(self, data, dimensions, leaf_size=1, linked_key=None, 
+               workers=1, split_rule='median'):
+    """ Same arguments as KDTree. """
+    
+    # Per node arrays
+    self.axes = array('b')
+    self.values = array('d')
+    self.left_children = array('l')
+    self.right_children = array('l')
+    self.bucket_starts = array('l')
+    self.bucket_ends = array('l')
+    
+    # Per point arrays, in leaf order, and the original points (for 
+    # reporting results).
+    self.leaf_points = array('l')
+    self.coordinates = [array('d') for dimension in dimensions]
+    self.set_points(data)
+    
+    # Linked record counts, filled in by count_linked_records, and the node
+    # boxes, filled in by set_boxes.
+    self.linked_points = array('l')
+    self.linked_records = array('l')
+    self.point_records = array('l')
+    self.box_lows = [array('d') for dimension in dimensions]
+    self.box_highs = [array('d') for dimension in dimensions]
+    self.lowest_indexes = array('l')
+    self.linked_lows = [array('d') for dimension in dimensions]
+    self.linked_highs = [array('d') for dimension in dimensions]
+    self.linked_nodes = array('l')
+    
+    KDTree.__init__(self, data, dimensions, leaf_size, linked_key, workers,
+                    split_rule)
+    
+  def add_node(self, axis, value):
+    """ Appends a node to the node arrays and returns its index. """
+    self.axes.append(axis)
+    self.values.append(value)
+    self.left_children.append(-1)
+    self.right_children.append(-1)
+    self.bucket_starts.append(-1)
+    self.bucket_ends.append(-1)
+    self.number_nodes += 1
+    
+    return self.number_nodes - 1
+  
+  def add_leaf(self, data, indexes):
+    """ Appends a leaf holding the points at the given indexes into data, 
+        and returns its index. """
+    node = self.add_node(-1, 0)
+    
+    self.bucket_starts[node] = len(self.leaf_points)
+    if isinstance(data, PointStore):
+      self.leaf_points.extend(indexes)
+      for axis, dimension in enumerate(self.dimensions):
+        column = data.coordinates[dimension]
+        self.coordinates[axis].extend(column[index] for index in indexes)
+    else:
+      for index in indexes:
+        self.leaf_points.append(index)
+        for axis, dimension in enumerate(self.dimensions):
+          self.coordinates[axis].append(data[index][dimension])
+    self.bucket_ends[node] = len(self.leaf_points)
+    
+    self.leaf_nodes += 1
+    self.number_points += len(indexes)
+    return node
+    
+  def split_and_add(self, data, sublists, box):
+    """ Same as KDTree.split_and_add, but returns the index of the node
+        instead of a KDTreeNode (or -1 for an empty subtree).
+    """ 
+    size = len(sublists[0])
+    if size == 0:
+      return -1
+    elif size <= self.leaf_size:
+      return self.add_leaf(data, sublists[0])
+    
+    dimension, splitting_value, left_sublists, right_sublists = \
+      self.partition_sublists(data, sublists, box)
+    left_box, right_box = self.split_box(box, dimension, splitting_value)
+    
+    node = self.add_node(dimension, splitting_value)
+    self.left_children[node] = self.split_and_add(data, left_sublists, 
+                                                  left_box)
+    self.right_children[node] = self.split_and_add(data, right_sublists,
+                                                   right_box)
+    
+    return node
+  
+  def partition_and_add(self, data, indexes, columns, start, end, box):
+    """ Same as KDTree.partition_and_add, but returns the index of the node
+        instead of a KDTreeNode (or -1 for an empty subtree). Nodes are 
+        still added in pre-order.
+    """ 
+    root = -1
+    
+    # Entries are (start, end, box, parent node, child array).
+    stack = [(start, end, box, -1, None)]
+    while stack:
+      
+      start, end, box, parent, children = stack.pop()
+      size = end - start
+      if size == 0:
+        continue
+      elif size <= self.leaf_size:
+        node = self.add_leaf(data, 
+                             self.leaf_indexes(indexes, columns, start, end))
+      else:
+        dimension, splitting_value, middle, left_box, right_box = \
+          self.partition_range(indexes, columns, start, end, box)
+        
+        node = self.add_node(dimension, splitting_value)
+        stack.append((middle, end, right_box, node, self.right_children))
+        stack.append((start, middle, left_box, node, self.left_children))
+      
+      if parent < 0:
+        root = node
+      else:
+        children[parent] = node
+    
+    return root
+  
+  def build_subtree(self, data, indexes, columns, start, end, box):
+    """ Same as KDTree.build_subtree, but the subtree is built as a 
+        FlatKDTree and returned as a tuple of its root and arrays. """
+    
+    builder = FlatKDTree([], self.dimensions, self.leaf_size, 
+                         split_rule=self.split_rule)
+    root = builder.partition_and_add(data, indexes, columns, start, end, box)
+    
+    return (root, builder.axes, builder.values, builder.left_children, 
+            builder.right_children, builder.bucket_starts, builder.bucket_ends,
+            builder.leaf_points, builder.coordinates)
+  
+  def add_plan(self, data, plan, subtrees):
+    """ Same as KDTree.add_plan, but returns the index of the node. Each
+        node is added before the nodes under it, to keep them in pre-order.
+    """
+    
+    if not isinstance(plan, tuple):
+      return self.add_subtree(data, subtrees[plan])
+    
+    dimension, splitting_value, left_plan, right_plan = plan
+    
+    node = self.add_node(dimension, splitting_value)
+    self.left_children[node] = self.add_plan(data, left_plan, subtrees)
+    self.right_children[node] = self.add_plan(data, right_plan, subtrees)
+    
+    return node
+  
+  def add_subtree(self, data, subtree):
+    """ Same as KDTree.add_subtree, but appends the arrays of the subtree to
+        the arrays of the tree, shifting its node indexes and positions. """
+    
+    (root, axes, values, left_children, right_children, 
+     bucket_starts, bucket_ends, leaf_points, coordinates) = subtree
+    
+    if root < 0:
+      return -1
+    
+    node_offset = self.number_nodes
+    position_offset = len(self.leaf_points)
+    
+    def shift(indexes, offset):
+      return array('l', (index + offset if index >= 0 else -1 
+                         for index in indexes))
+    
+    self.axes.extend(axes)
+    self.values.extend(values)
+    self.left_children.extend(shift(left_children, node_offset))
+    self.right_children.extend(shift(right_children, node_offset))
+    self.bucket_starts.extend(shift(bucket_starts, position_offset))
+    self.bucket_ends.extend(shift(bucket_ends, position_offset))
+    self.leaf_points.extend(leaf_points)
+    for axis, axis_coordinates in enumerate(coordinates):
+      self.coordinates[axis].extend(axis_coordinates)
+    
+    self.number_nodes += len(axes)
+    self.leaf_nodes += sum(1 for axis in axes if axis < 0)
+    self.number_points += len(leaf_points)
+    
+    return root + node_offset
+  
+  def search(self, query):
+    """ Returns the index of the leaf node where the query point would be 
+        inserted, with the query given as a tuple of coordinates. """
+    
+    node = self.root
+    while self.axes[node] >= 0:
+      
+      if query[self.axes[node]] <= self.values[node]:
+        first = self.left_children[node]
+        second = self.right_children[node]
+      else:
+        first = self.right_children[node]
+        second = self.left_children[node]
+        
+      # If the preferred child is missing, the other one has to be there.
+      if first >= 0:
+        node = first
+      else:
+        node = second
+        
+    return node
+  
+  def compare_bucket(self, node, query, mins_so_far):
+    """ Offers every point in the bucket of the leaf node to mins_so_far
+        (see compare_range). """
+    self.compare_range(self.bucket_starts[node], self.bucket_ends[node], 
+                       query, mins_so_far)
+  
+  def set_boxes(self):
+    """ Same as KDTree.set_boxes, for the node arrays. """
+    
+    dimensions = range(len(self.dimensions))
+    self.box_lows = [array('d', [0]) * self.number_nodes 
+                     for dimension in dimensions]
+    self.box_highs = [array('d', [0]) * self.number_nodes 
+                      for dimension in dimensions]
+    self.lowest_indexes = array('l', [0]) * self.number_nodes
+    
+    # Children are always created after their parent, so going backwards
+    # through the nodes boxes every subtree before the node above it.
+    for node in reversed(range(self.number_nodes)):
+      if self.axes[node] < 0:
+        start = self.bucket_starts[node]
+        end = self.bucket_ends[node]
+        for axis in dimensions:
+          coordinates = self.coordinates[axis][start:end]
+          self.box_lows[axis][node] = min(coordinates)
+          self.box_highs[axis][node] = max(coordinates)
+        self.lowest_indexes[node] = min(self.leaf_points[start:end])
+        continue
+      
+      children = [child for child in (self.left_children[node], 
+                                      self.right_children[node]) 
+                  if child >= 0]
+      self.lowest_indexes[node] = min(self.lowest_indexes[child] 
+                                      for child in children)
+      for axis in dimensions:
+        self.box_lows[axis][node] = min(self.box_lows[axis][child] 
+                                        for child in children)
+        self.box_highs[axis][node] = max(self.box_highs[axis][child] 
+                                         for child in children)
+  
+  def count_node_records(self):
+    """ Same as PointArrayIndex.count_node_records, also setting the 
+        linked box and linked node of every node (see 
+        KDTree.count_linked_records). """
+    
+    PointArrayIndex.count_node_records(self)
+    
+    dimensions = range(len(self.dimensions))
+    self.linked_lows = [array('d', [0]) * self.number_nodes 
+                        for dimension in dimensions]
+    self.linked_highs = [array('d', [0]) * self.number_nodes 
+                         for dimension in dimensions]
+    self.linked_nodes = array('l', [-1]) * self.number_nodes
+    
+    for node in reversed(range(self.number_nodes)):
+      if not self.linked_points[node]:
+        continue
+      
+      if self.axes[node] < 0:
+        positions = [position for position in 
+                     range(self.bucket_starts[node], self.bucket_ends[node])
+                     if self.point_records[position]]
+        for axis in dimensions:
+          coordinates = [self.coordinates[axis][position] 
+                         for position in positions]
+          self.linked_lows[axis][node] = min(coordinates)
+          self.linked_highs[axis][node] = max(coordinates)
+        continue
+      
+      linked = [child for child in (self.left_children[node], 
+                                    self.right_children[node]) 
+                if child >= 0 and self.linked_points[child]]
+      if len(linked) == 1:
+        below = self.linked_nodes[linked[0]]
+        self.linked_nodes[node] = below if below >= 0 else linked[0]
+      for axis in dimensions:
+        self.linked_lows[axis][node] = min(self.linked_lows[axis][child] 
+                                           for child in linked)
+        self.linked_highs[axis][node] = max(self.linked_highs[axis][child] 
+                                            for child in linked)
+  
+  def node_key(self, node, query, boxes=None):
+    """ Same as point_box_key, for the box of the node and a query given as
+        a tuple of coordinates. The box is taken from boxes, the lows and 
+        the highs per dimension, if given (e.g. the linked boxes). """
+    
+    lows, highs = boxes or (self.box_lows, self.box_highs)
+    x_gap = max(0, lows[0][node] - query[0], query[0] - highs[0][node])
+    y_gap = max(0, lows[1][node] - query[1], query[1] - highs[1][node])
+    key = (x_gap * x_gap) + (y_gap * y_gap)
+    
+    return key if key > ZERO_KEY else 0
+  
+  def find_k_nearest(self, node, query, mins_so_far, stats):
+    """ Same as KDTreeNode.find_k_nearest, starting at the given node. 
+        The candidates in mins_so_far are point positions. """
+    
+    # node_key is inlined for the children below, as this is the hottest
+    # loop of a query.
+    x, y = query
+    lows_x, lows_y = self.box_lows
+    highs_x, highs_y = self.box_highs
+    lowest_indexes = self.lowest_indexes
+    
+    # Entries are (node, key of the distance to its box), as in 
+    # KDTreeNode.find_nearest.
+    stack = [(node, self.node_key(node, query))]
+    while stack:
+      
+      node, box_key = stack.pop()
+      if mins_so_far.excludes(box_key, lowest_indexes[node]):
+        continue
+      
+      stats['nodes'] += 1
+      
+      axis = self.axes[node]
+      if axis < 0:
+        self.compare_bucket(node, query, mins_so_far)
+        continue
+      
+      children = []
+      for child in (self.left_children[node], self.right_children[node]):
+        if child < 0:
+          continue
+        
+        if x < lows_x[child]:
+          x_gap = lows_x[child] - x
+        elif x > highs_x[child]:
+          x_gap = x - highs_x[child]
+        else:
+          x_gap = 0
+        if y < lows_y[child]:
+          y_gap = lows_y[child] - y
+        elif y > highs_y[child]:
+          y_gap = y - highs_y[child]
+        else:
+          y_gap = 0
+        
+        key = (x_gap * x_gap) + (y_gap * y_gap)
+        children.append((child, key if key > ZERO_KEY else 0))
+      
+      # The nearer box goes on the stack last, so it's searched first, or
+      # the one with the lowest index if they're as near (see 
+      # KDTreeNode.children_by_box).
+      if len(children) == 2 and (
+          children[1][1] < children[0][1] or 
+          (children[1][1] == children[0][1] and 
+           lowest_indexes[children[1][0]] < 
+           lowest_indexes[children[0][0]])):
+        children.reverse()
+      stack.extend(reversed(children))
+  
+  def bounding_boxes(self):
+    """ Same as KDTree.bounding_boxes, as a list indexed by node. """
+    return zip(*(self.box_lows + self.box_highs))
+  
+  def node_children(self, node):
+    """ Same as KDTree.node_children, for the node arrays. """
+    return [child for child in (self.left_children[node], 
+                                self.right_children[node]) if child >= 0]
+  
+  def leaf_values(self, node):
+    """ Same as KDTree.leaf_values, for the node arrays. """
+    return [(self.point(position)['value'], self.coordinates[0][position], 
+             self.coordinates[1][position]) 
+            for position in range(self.bucket_starts[node], 
+                                  self.bucket_ends[node])]
+  
+  def leaf_keys(self, node, x, y):
+    """ Same as KDTree.leaf_keys, giving point positions instead of leaves. 
+        The keys for the whole bucket are computed at once. """
+    start = self.bucket_starts[node]
+    end = self.bucket_ends[node]
+    keys = bucket_keys(self.coordinates[0][start:end],
+                       self.coordinates[1][start:end], x, y)
+    return zip(range(start, end), keys, self.leaf_points[start:end])
+  
+  def make_query_tree(self, query_points):
+    """ Same as KDTree.make_query_tree, building a flat tree. """
+    return FlatKDTree(query_points, self.dimensions, self.leaf_size)
+  
+  def find_k_nearest_positions(self, query, k, stats):
+    """ Same as PointArrayIndex.find_k_nearest_positions, but seeded with
+        the leaf where the query would be inserted. """
+    
+    # Seed the search with the leaf where the query would be inserted,
+    # like KDTreeNode.nearest does.
+    mins_so_far = KNearestHeap(k)
+    self.compare_bucket(self.search(query), query, mins_so_far)
+    
+    self.find_k_nearest(self.root, query, mins_so_far, stats)
+    stats['passes'] += 1
+    
+    return mins_so_far
+  
+  def nearest_positions_iter(self, query, stats, linked_only=False):
+    """ Same as KDTreeNode.nearest_iter, yielding (position, distance) for 
+        every point in the tree, closest first, with the query given as a
+        tuple of coordinates. 
+        
+        If linked_only is True, nodes and points without any linked records
+        are skipped, and the linked nodes and boxes are used as in 
+        KDTreeNode.nearest_iter. """
+    
+    order = itertools.count()
+    leaf_points = self.leaf_points
+    
+    start = self.root
+    boxes = None
+    if linked_only:
+      if self.linked_nodes[start] >= 0:
+        start = self.linked_nodes[start]
+      boxes = (self.linked_lows, self.linked_highs)
+    
+    # Entries are (key, is_point, order for a node or index for a point,
+    # node or position), as in KDTreeNode.nearest_iter.
+    queue = [(0, False, next(order), start)]
+    while queue:
+      
+      key, is_point, rank, node = heapq.heappop(queue)
+      
+      if is_point:
+        yield node, key_distance(key)
+        continue
+      
+      stats['nodes'] += 1
+      
+      axis = self.axes[node]
+      if axis < 0:
+        start = self.bucket_starts[node]
+        end = self.bucket_ends[node]
+        keys = bucket_keys(self.coordinates[0][start:end],
+                           self.coordinates[1][start:end], query[0], query[1])
+        for position, key in enumerate(keys, start):
+          if linked_only and not self.point_records[position]:
+            continue
+          heapq.heappush(queue, (key if key > ZERO_KEY else 0, True,
+                                 leaf_points[position], position))
+        continue
+      
+      for child in (self.left_children[node], self.right_children[node]):
+        if child < 0 or (linked_only and not self.linked_points[child]):
+          continue
+        if linked_only and self.linked_nodes[child] >= 0:
+          child = self.linked_nodes[child]
+        heapq.heappush(queue, (self.node_key(child, query, boxes), False, 
+                               next(order), child))
+  
+  def snapshot_sections(self):
+    """ Same as PointArrayIndex.snapshot_sections, with the node arrays and
+        boxes first. """
+    
+    nodes = [(name, typecode, 'nodes') for name, typecode in 
+             (('axes', 'b'), ('values', 'd'), ('left_children', 'l'), 
+              ('right_children', 'l'), ('bucket_starts', 'l'), 
+              ('bucket_ends', 'l'), ('linked_points', 'l'), 
+              ('linked_records', 'l'), ('lowest_indexes', 'l'),
+              ('linked_nodes', 'l'))]
+    boxes = [((name, axis), 'd', 'nodes') 
+             for name in ('box_lows', 'box_highs', 'linked_lows', 
+                          'linked_highs')
+             for axis in range(len(self.dimensions))]
+    
+    return nodes + boxes + PointArrayIndex.snapshot_sections(self)
+
+# Snapshot files start with a header (see PointArrayIndex.save_snapshot) of 
+# the magic string, version, leaf size, root, number of nodes, leaves, 
+# points and records, max_possible_records and the length of a JSON string
+# naming the engine, dimensions and linked_key and holding the 
+# snapshot_attributes of the index, which follows it.
+SNAPSHOT_MAGIC = 'QNKDTREE'
+SNAPSHOT_VERSION = 6
+SNAPSHOT_HEADER = '<8sIIqqqqqqI'
+
+# ctypes types for the array typecodes used in snapshots.
+SNAPSHOT_CTYPES = {'b': ctypes.c_byte,
+                   'd': ctypes.c_double,
+                   'l': ctypes.c_long}
+
+def read_snapshot_header(filename, mapping):
+  """ Returns the header fields after the version (see SNAPSHOT_HEADER), 
+      the names dictionary and the offset just past them, from the mapping
+      of the snapshot in the given file. """
+  
+  header = struct.unpack_from(SNAPSHOT_HEADER, mapping)
+  if header[0] != SNAPSHOT_MAGIC or header[1] != SNAPSHOT_VERSION:
+    raise ValueError("{} is not a version {} snapshot.".
+                     format(filename, SNAPSHOT_VERSION))
+  
+  offset = struct.calcsize(SNAPSHOT_HEADER)
+  names_length = header[-1]
+  names = json.loads(mapping[offset:offset + names_length])
+  
+  return header[2:-1], names, offset + names_length
+
+def snapshot_engine(filename):
+  """ Returns the name of the engine (see PointArrayIndex.snapshot_engine)
+      that saved the snapshot in the given file. """
+  
+  with open(filename, 'rb') as snapshot:
+    mapping = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+  try:
+    return str(read_snapshot_header(filename, mapping)[1]['engine'])
+  finally:
+    mapping.close()
+
+class SnapshotIndex:
+  """ Loads a PointArrayIndex from a file written by its save_snapshot, 
+      mixed in ahead of the class of the index (see SnapshotKDTree).
+  
+      The file is memory-mapped and every array of the index is a ctypes 
+      array pointing straight into the mapping, so loading doesn't depend on
+      the size of the index and nothing is read until a query touches it.
+      The mapping is copy-on-write, so processes that load the same file 
+      share its pages.
+      
+      There are no original data points. point() builds one from the 
+      arrays, with the id and linked records of the point in its value.
+  """
+  
+  # The highest number of unique linked records, as given when saving.
+  max_possible_records = 0
+  
+  def __init__(self, filename):
+    """ Maps the snapshot in the given file, which has to have been saved
+        by the same engine. """
+    
+    with open(filename, 'rb') as snapshot:
+      self.mapping = mmap.mmap(snapshot.fileno(), 0, 
+                               access=mmap.ACCESS_COPY)
+      
+    ((self.leaf_size, self.root, self.number_nodes, self.leaf_nodes, 
+      self.number_points, number_records, self.max_possible_records), 
+     names, offset) = read_snapshot_header(filename, self.mapping)
+    
+    if names['engine'] != self.snapshot_engine:
+      raise ValueError("{} is a snapshot of the {} engine, not {}.".
+                       format(filename, names['engine'], 
+                              self.snapshot_engine))
+      
+    self.dimensions = [str(dimension) for dimension in names['dimensions']]
+    if names['linked_key'] is not None:
+      self.linked_key = str(names['linked_key'])
+    for name, value in names['attributes'].items():
+      if isinstance(value, unicode):
+        value = str(value)
+      setattr(self, str(name), value)
+    
+    sizes = {'nodes': self.number_nodes, 
+             'node_offsets': self.number_nodes + 1,
+             'points': self.number_points, 
+             'point_offsets': self.number_points + 1,
+             'records': number_records}
+    lists = {}
+    for name, typecode, size in self.snapshot_sections():
+      offset += -offset % 8
+      section = (SNAPSHOT_CTYPES[typecode] * sizes[size]).from_buffer(
+        self.mapping, offset)
+      offset += ctypes.sizeof(section)
+      
+      if isinstance(name, tuple):
+        lists.setdefault(name[0], [None] * len(self.dimensions))
+        lists[name[0]][name[1]] = section
+      else:
+        setattr(self, name, section)
+        
+    for name, sections in lists.items():
+      setattr(self, name, sections)
+  
+  def point(self, position):
+    """ Returns a data point rebuilt from the arrays at the given position. 
+    """
+    
+    point = dict((dimension, self.coordinates[axis][position])
+                 for axis, dimension in enumerate(self.dimensions))
+    point['value'] = {'id': self.point_ids[position]}
+    
+    if self.linked_key is not None:
+      start = self.record_offsets[position]
+      end = self.record_offsets[position + 1]
+      point['value'][self.linked_key] = self.records[start:end]
+      
+    return point
+
+class SnapshotKDTree(SnapshotIndex, FlatKDTree):
+  """ A FlatKDTree loaded from a file written by its save_snapshot (see 
+      SnapshotIndex). """
@@ -10,12 +10,43 @@
     
     To use, pipe in an input file when running this file from the command line.
     If you pass the -log switch, progress will be logged to quora_nearby.log.
+    The -singlepass switch answers topic queries with a single traversal
+    using a bounded heap, instead of the radius-doubling passes described below.
+    Pass -engine flat to use the array-backed FlatKDTree instead of KDTree,
+    and -leafsize <n> to let tree leaves hold buckets of up to n points.
+    With -batch, all queries of each type are answered by one batch call.
+    -engine grid uses a gridindex.GridIndex, a uniform grid of buckets
+    searched ring by ring, which suits topics spread evenly over the plane.
+    -engine morton uses a mortonindex.MortonIndex, the topics sorted by
+    Morton code and searched as a quadtree with no pointers, and -engine
+    ball a balltree.BallTree, which bounds nodes by balls instead of boxes.
+    With -stream, queries are answered and printed one at a time as they
+    are read, instead of after the whole input has been parsed.
+    Output is written in chunks of -flushsize <n> bytes (64 KB by default).
+    -format ndjson or -format binary write the distances along with the
+    ids (see ResultWriter for the layouts).
+    -savesnapshot <file> saves the tree that was built (by the flat, grid,
+    morton or ball engine) to a file, and later runs with -snapshot <file>
+    map it into memory instead of building it (the topics and questions in
+    their input are skipped). The engine is then the one that saved the
+    snapshot.
+    -workers <n> builds the tree with n processes, then splits the queries
+    between n processes, which share the tree of the parent process.
+    -split midpoint or -split cost picks another rule than the median for 
+    where the kd-tree engines split nodes (see KDTree.choose_split).
+    -cache <n> keeps the answers for the last n query locations in a 
+    QueryCache, and -cachegrid <size> lets queries within the same size by
+    size square share an answer (so it's approximate).
+    With -store, topics and questions are parsed into the flat arrays of a
+    pointstore.PointStore instead of dictionaries, which the flat, grid,
+    morton and ball engines search directly.
     The results of queries are printed to stdout as lists of id's, one query
     per line.
     
-    To generate the query results, I parse the input and build two kd-trees
-    of topic points, one with all the topic points and one which only has
-    topic points with at least one associated question.
+    To generate the query results, I parse the input and build one kd-tree
+    of topic points, where every node also counts the questions linked to
+    the topics under it, so question queries can skip the parts of the tree
+    without any questions.
     
     To find the k nearest neighbors, I used the nearest neighbor algorithm
     while saving up to k previous estimates for the nearest neighbors.
@@ -29,10 +60,249 @@
 """
 
 import sys
+import math
 import time
+import json
+import struct
 import logging
+import itertools
+import multiprocessing
+from collections import OrderedDict, Counter
 import kdtree
+import balltree
+import gridindex
+import mortonindex
+import pointstore
+
+# Tree classes that can be picked with the -engine switch.
+ENGINES = {'kdtree': kdtree.KDTree,
+           'flat': kdtree.FlatKDTree,
+           'grid': gridindex.GridIndex,
+           'morton': mortonindex.MortonIndex,
+           'ball': balltree.BallTree}
+
+# Classes that map the snapshots saved by each engine that can save them.
+SNAPSHOT_ENGINES = {'flat': kdtree.SnapshotKDTree,
+                    'grid': gridindex.SnapshotGridIndex,
+                    'morton': mortonindex.SnapshotMortonIndex,
+                    'ball': balltree.SnapshotBallTree}
+
+# Output formats that can be picked with the -format switch.
+OUTPUT_FORMATS = ('text', 'ndjson', 'binary')
+
+class ResultWriter():
+  """ Collects the results of queries and writes them to a stream in large
+      chunks, instead of one write per query.
+      
+      The text format is the one the challenge asks for, a line of space
+      separated ids per query. The other formats include the distances too:
+      ndjson writes a line {"ids": [...], "distances": [...]} per query, and
+      binary writes, per query, the number of results as a little-endian
+      unsigned 32-bit integer followed by that many signed 64-bit ids and
+      then that many 64-bit float distances.
+  """
+  
+  def __init__(self, stream, output_format='text', flush_size=1 << 16):
+    """ Results are written to stream whenever at least flush_size bytes
+        have been collected, so a flush_size of 0 writes (and flushes the
+        stream) after every query. """
+    
+    if output_format not in OUTPUT_FORMATS:
+      raise ValueError("Unknown output format: {}".format(output_format))
+    
+    self.stream = stream
+    self.output_format = output_format
+    self.format_result = getattr(self, 'format_' + output_format)
+    self.flush_size = flush_size
+    self.chunks = []
+    self.size = 0
+    
+  @staticmethod
+  def format_text(ids, distances):
+    return ' '.join(map(str, ids)) + '\n'
+  
+  @staticmethod
+  def format_ndjson(ids, distances):
+    return json.dumps({'ids': ids, 'distances': distances}) + '\n'
+  
+  @staticmethod
+  def format_binary(ids, distances):
+    count = len(ids)
+    return (struct.pack('<I', count) + 
+            struct.pack('<{}q'.format(count), *ids) + 
+            struct.pack('<{}d'.format(count), *distances))
+    
+  def write(self, ids, distances):
+    """ Adds the results of one query, given as a list of ids and a list of
+        distances to match. """
+    
+    chunk = self.format_result(ids, distances)
+    self.chunks.append(chunk)
+    self.size += len(chunk)
+    if self.size >= self.flush_size:
+      self.flush()
+      
+  def flush(self):
+    """ Writes out everything collected so far and flushes the stream. """
+    
+    self.stream.write(''.join(self.chunks))
+    self.stream.flush()
+    self.chunks = []
+    self.size = 0
                                                                                  
+class QueryCache():
+  """ A bounded cache of query answers, keyed by the type and location of 
+      the query, which evicts the least recently used answer when it's full.
+      
+      Each location keeps the answer for the largest k asked there, which
+      also answers smaller k (see serve), and any k once it has fewer 
+      results than were asked for. Locations are exact unless a quantum is
+      given, in which case queries in the same quantum by quantum square 
+      share their answers, so they're only approximate.
+      
+      Answers belong to one version of one tree (see KDTree.version), and
+      the cache is emptied when it's used with any other.
+  """
+  
+  def __init__(self, size, quantum=0):
+    self.size = size
+    self.quantum = quantum
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.tree = None
+    self.version = None
+    
+  def key(self, query):
+    """ Returns the key for the location and type of a query. """
+    x = query['x']
+    y = query['y']
+    if self.quantum:
+      x = int(math.floor(x / self.quantum))
+      y = int(math.floor(y / self.quantum))
+    return (query['type'], x, y)
+  
+  def check_tree(self, tree):
+    """ Empties the cache if its answers aren't for the current version of 
+        tree. """
+    if tree is not self.tree or tree.version != self.version:
+      self.entries.clear()
+      self.tree = tree
+      self.version = tree.version
+  
+  def get(self, tree, query):
+    """ Returns the cached answer (ids, distances) to a query on tree, or 
+        None, counting the hit or miss. """
+    
+    self.check_tree(tree)
+    key = self.key(query)
+    entry = self.entries.pop(key, None)
+    
+    answer = None
+    if entry is not None:
+      # Put the entry back as the most recently used.
+      self.entries[key] = entry
+      answer = self.serve(entry, query)
+      
+    if answer is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+    return answer
+  
+  @staticmethod
+  def serve(entry, query):
+    """ Returns the answer to query from an entry (k, ids, distances) for
+        a query of the same type and location, or None if it can't be 
+        answered from it.
+        
+        Question results are found closest topic first, whatever k is, so
+        the answer for a smaller k is the start of the larger one. The order
+        of topics at the same distance can depend on k, so for topic queries
+        the start is only used if none of its distances are tied.
+    """
+    cached_k, ids, distances = entry
+    k = query['count']
+    
+    if k == cached_k or (k > cached_k and len(ids) < cached_k):
+      return ids, distances
+    if k > cached_k:
+      return None
+    
+    if query['type'] == 't':
+      for position in range(min(k, len(ids) - 1)):
+        if distances[position] >= distances[position + 1]:
+          return None
+    return ids[:k], distances[:k]
+  
+  def put(self, tree, query, answer):
+    """ Caches the answer (ids, distances) to a query on tree, unless there
+        is already one for a larger k. """
+    
+    self.check_tree(tree)
+    key = self.key(query)
+    entry = self.entries.pop(key, None)
+    if entry is None or entry[0] < query['count']:
+      entry = (query['count'],) + tuple(answer)
+    self.entries[key] = entry
+    
+    while len(self.entries) > self.size:
+      self.entries.popitem(last=False)
+
+class QueryStats():
+  """ The number of queries answered and the lowest, highest and total 
+      number of nodes visited and passes made by them, for the summary that
+      is logged at the end. Only running totals are kept, so any number of
+      queries (say from an endless stream) takes the same memory.
+      
+      For the median, each number is counted in a histogram of the values 
+      seen. A query can't visit more nodes than the tree has, so that stays
+      bounded by the size of the tree however many queries there are.
+  """
+  
+  def __init__(self):
+    self.count = 0
+    self.nodes = [0, None, None, Counter()]
+    self.passes = [0, None, None, Counter()]
+    
+  def add(self, nodes, passes):
+    """ Counts a query that visited the given numbers of nodes and passes. 
+    """
+    self.count += 1
+    for summary, value in ((self.nodes, nodes), (self.passes, passes)):
+      summary[0] += value
+      if summary[1] is None or value < summary[1]:
+        summary[1] = value
+      if summary[2] is None or value > summary[2]:
+        summary[2] = value
+      summary[3][value] += 1
+  
+  def median(self, histogram):
+    """ Returns the value at position count/2 of the values counted in
+        histogram, in sorted order. """
+    
+    seen = 0
+    for value in sorted(histogram):
+      seen += histogram[value]
+      if seen > self.count / 2:
+        return value
+  
+  def log_summary(self):
+    """ Logs the lowest, average, median and highest numbers of passes and
+        of nodes visited. """
+    
+    if not self.count:
+      return
+    
+    for name, (total, lowest, highest, histogram) in (
+        ('passes', self.passes), ('nodes visited', self.nodes)):
+      logging.info("In {} queries, the number {} was:".
+                   format(self.count, name))
+      logging.info("  {} -> min".format(lowest))
+      logging.info("  {} -> average".format(total / self.count))
+      logging.info("  {} -> median".format(self.median(histogram)))
+      logging.info("  {} -> max".format(highest))
+
 def read_input(source):
     """ Function which parses the given source according to the quora nearby
       challenge.
@@ -46,6 +316,20 @@ def read_input(source):
             ...            
     """      
     
+    data = read_points(source)
+    data['queries'] = list(read_queries(source))
+    
+    return data
+
+def read_points(source):
+    """ Same as read_input, but only reads the topic and question sections,
+      leaving the queries in source for read_queries. The 'queries' entry of
+      the result is an empty list.
+      
+      Lines are read one at a time with readline, so nothing past the 
+      questions is taken from the source.
+    """
+    
     # Pull out the numbers from the top of the file to set lengths.
     first_line = source.readline().strip()
     first_line = first_line.split(' ')
@@ -56,61 +340,178 @@ def read_input(source):
     # a fast way to determine links between them.
     topics = {}
     questions = {}
-    queries = []
     num_questions_without_topics = 0
     
-    # Loop through all the lines in the file, processing them as either
-    # a topic, question, or query
-    count = 0
-    for line in source:
+    for count in xrange(num_topics):
         
         # Trim whitespace and split into separate pieces
-        line = line.strip().split(' ')
-
-        if count < num_topics:
-            
-            topic_id = int(line[0])
-            
-            # Make a dictionary keyed on the topic_id where each entry points
-            # to a list of questions that are in the topic
-            topic = {'x': float(line[1]),
-                     'y': float(line[2]),
-                     'value': {'id': topic_id,
-                               'questions': []}}
-            topics[topic_id] = topic
-            
-        elif (count >= num_topics and count < (num_topics + num_questions)): 
-            
-            question_id = int(line[0])
-            questions[question_id] = []
-            linked_topics = int(line[1])
+        line = source.readline().strip().split(' ')
+        topic_id = int(line[0])
+        
+        # Make a dictionary keyed on the topic_id where each entry points
+        # to a list of questions that are in the topic
+        topic = {'x': float(line[1]),
+                 'y': float(line[2]),
+                 'value': {'id': topic_id,
+                           'questions': []}}
+        topics[topic_id] = topic
+        
+    for count in xrange(num_questions):
+        
+        line = source.readline().strip().split(' ')
+        question_id = int(line[0])
+        questions[question_id] = []
+        linked_topics = int(line[1])
+        
+        if linked_topics > 0:
+          # Make a dictionary keyed by question_id where each entry
+          # points to a list of topic_id's associated with the question.
+          for topic in line[2:]:
             
-            if linked_topics > 0:
-              # Make a dictionary keyed by question_id where each entry
-              # points to a list of topic_id's associated with the question.
-              for topic in line[2:]:
-                
-                topic_id = int(topic)
-                questions[question_id].append(topic_id)
-                # And put the id of the question in the list field of its topics.
-                topics[topic_id]['value']['questions'].append(question_id)
+            topic_id = int(topic)
+            questions[question_id].append(topic_id)
+            # And put the id of the question in the list field of its topics.
+            topics[topic_id]['value']['questions'].append(question_id)
 
-            else:
-               # This question has no associated topics, so it can never appear in
-               # any search results.
-               num_questions_without_topics += 1
+        else:
+           # This question has no associated topics, so it can never appear in
+           # any search results.
+           num_questions_without_topics += 1
+    
+    return summarize_input(topics, questions, [], 
+                           num_questions_without_topics)
 
+def skip_points(source):
+    """ Reads past the header, topic and question lines of source without
+      parsing them, for when the tree comes from a snapshot. The queries are
+      left in source for read_queries. """
+    
+    first_line = source.readline().split()
+    for count in xrange(int(first_line[0]) + int(first_line[1])):
+        source.readline()
+
+def read_queries(source):
+    """ Generator which parses the query lines left in source, yielding each
+      query as soon as its line is read. Blank lines are skipped. """
+    
+    for line in iter(source.readline, ''):
+        
+        line = line.split()
+        if not line:
+            continue
+        
+        yield {'type': line[0],
+               'count': int(line[1]),
+               'x': float(line[2]),
+               'y': float(line[3])}
+
+def read_input_bulk(source):
+    """ Same as read_input, but reads the whole source at once and splits it
+      into tokens in a single pass. The topic and query sections have a fixed
+      number of tokens per line, so they're converted a column at a time from
+      slices of the tokens instead of line by line.
+      
+      Returns the same dictionary as read_input.
+    """
+    
+    tokens = source.read().split()
+    num_topics = int(tokens[0])
+    num_questions = int(tokens[1])
+    position = 3
+    
+    # Topics are three tokens each: id, x and y.
+    end = position + 3 * num_topics
+    topic_ids = map(int, tokens[position:end:3])
+    topic_xs = map(float, tokens[position + 1:end:3])
+    topic_ys = map(float, tokens[position + 2:end:3])
+    position = end
+    
+    topics = {}
+    for topic_id, x, y in zip(topic_ids, topic_xs, topic_ys):
+        topics[topic_id] = {'x': x,
+                            'y': y,
+                            'value': {'id': topic_id,
+                                      'questions': []}}
+    
+    # Questions have a variable number of topics, which follow their count.
+    questions = {}
+    num_questions_without_topics = 0
+    for count in xrange(num_questions):
+        question_id = int(tokens[position])
+        linked_topics = int(tokens[position + 1])
+        position += 2
+        
+        linked_topic_ids = map(int, tokens[position:position + linked_topics])
+        position += linked_topics
+        questions[question_id] = linked_topic_ids
+        
+        if linked_topics > 0:
+            for topic_id in linked_topic_ids:
+                topics[topic_id]['value']['questions'].append(question_id)
         else:
-            # Just put the query into a dictionary
-            query = {'type': line[0],
-                     'count': int(line[1]),
-                     'x': float(line[2]),
-                     'y': float(line[3]) }
-            # And add it to the overall list of queries.
-            queries.append(query)    
-            
-        # And bump the counter that tracks the lines read so far
-        count += 1  
+            num_questions_without_topics += 1
+    
+    queries = parse_query_tokens(tokens, position)
+    
+    return summarize_input(topics, questions, queries, 
+                           num_questions_without_topics)
+
+def read_input_store(source):
+    """ Same as read_input_bulk, but keeps the topics and questions in a 
+      pointstore.PointStore, which links each topic to the questions in it.
+      
+      The dictionary returned has the store as 'topics', along with 
+      'num_topics_without_questions', 'num_questions_without_topics', 
+      'max_possible_questions' and 'queries' as in read_input. There are
+      no 'questions' or 'topics_with_questions' entries.
+    """
+    
+    tokens = source.read().split()
+    num_topics = int(tokens[0])
+    num_questions = int(tokens[1])
+    position = 3
+    
+    end = position + 3 * num_topics
+    topic_ids = map(int, tokens[position:end:3])
+    coordinates = {'x': map(float, tokens[position + 1:end:3]),
+                   'y': map(float, tokens[position + 2:end:3])}
+    position = end
+    
+    question_ids = []
+    question_topics = []
+    for count in xrange(num_questions):
+        linked_topics = int(tokens[position + 1])
+        question_ids.append(int(tokens[position]))
+        question_topics.append(map(int, tokens[position + 2:
+                                               position + 2 + linked_topics]))
+        position += 2 + linked_topics
+    
+    store = pointstore.PointStore(topic_ids, coordinates, ['x', 'y'], 
+                                  question_ids, question_topics, 'questions')
+    
+    num_topics_without_questions = sum(1 for index in xrange(num_topics)
+                                       if not store.record_count(index))
+    
+    return {'topics': store,
+            'num_topics_without_questions': num_topics_without_questions,
+            'num_questions_without_topics': store.records_without_points,
+            'max_possible_questions': store.max_possible_records(),
+            'queries': parse_query_tokens(tokens, position)}
+
+def parse_query_tokens(tokens, position):
+    """ Returns the list of queries in tokens, starting at position, which 
+      are four tokens each: type, count, x and y. """
+    
+    return [{'type': query_type, 'count': count, 'x': x, 'y': y} 
+            for query_type, count, x, y in 
+            zip(tokens[position::4],
+                map(int, tokens[position + 1::4]),
+                map(float, tokens[position + 2::4]),
+                map(float, tokens[position + 3::4]))]
+
+def summarize_input(topics, questions, queries, num_questions_without_topics):
+    """ Builds the dictionary returned by read_input from the parsed topics,
+      questions and queries. """
     
     # Calculate the number of topics that have no questions attached,
     # and set aside the topics that have at least one question for use 
@@ -136,117 +537,402 @@ def read_input(source):
             'questions': questions, 
             'queries': queries}
                    
-def process_queries(data, tree, pruned_tree, stat_list, pass_list):
- """ Function which does the actual work of processing queries by
-      searching in the two kd-trees. 
+def answer_query(data, tree, query, stats, single_pass=False, cache=None):
+ """ Function which does the actual work of answering a query by
+      searching in the kd-tree. 
       
-      Prints output to stdout as lists of ids (either question or topics,
-      depending on what the query requries).
+      Returns the results as a list of ids (either question or topics,
+      depending on what the query requries) and a list of distances, or 
+      None for an unknown type of query.
+      
+      If single_pass is True, topic queries use the single-pass k-nearest
+      search instead of widening the search radius over several passes.
+      
+      If a QueryCache is given, answers are looked up in it first, and 
+      stored in it after searching. A query answered from the cache visits
+      no nodes, and stats gets 'cache_hits' and 'cache_misses' with the
+      totals so far.
  """
  
- stats = {}
- for query in data['queries']:
+ if cache is not None:
+    answer = cache.get(tree, query)
+    stats['cache_hits'] = cache.hits
+    stats['cache_misses'] = cache.misses
+    if answer is not None:
+      stats['nodes'] = 0
+      stats['passes'] = 0
+      return answer
     
-    # Pull out the number of results desired for the query.
-    num_results = query['count']
+    answer = answer_query(data, tree, query, stats, single_pass)
+    if answer is not None:
+      cache.put(tree, query, answer)
+    return answer
+ 
+ # Pull out the number of results desired for the query.
+ num_results = query['count']
     
-    if query['type'] == 't':
-      
-      # Topic queries are straight up nearest neighbor queries.
-      nearest = tree.k_nearest(query, num_results, stats)
+ if query['type'] == 't':
       
-      # Re-format for output and print
-      results = [str(result['point'].point['value']['id']) 
-                 for result in nearest['list']]
-      print(' '.join(results))
+    # Topic queries are straight up nearest neighbor queries.
+    nearest = tree.k_nearest(query, num_results, stats, single_pass)
       
-      stat_list.append(stats['nodes'])
-      pass_list.append(stats['passes'])
+    # Re-format for output
+    return ([result['point'].point['value']['id'] 
+             for result in nearest['list']],
+            [result['distance'] for result in nearest['list']])
       
-    # Otherwise search is more complicated because we care about number of 
-    # records associated with the nearest point(s)
-    elif query['type'] == 'q':
+ # Otherwise search is more complicated because we care about number of 
+ # records associated with the nearest point(s)
+ elif query['type'] == 'q':
        
-        nearest = pruned_tree.k_nearest_linked_records(query, 
-                                                num_results, 
-                                                'questions', 
-                                                data['max_possible_questions'], 
-                                                stats)
-  
-        # Due to clustering of multiple questions per topic, we could
-        # have more question results than we wanted.
-        num_records = min(len(nearest['questions']), num_results)
-        results = []
-        for result in nearest['questions'][:num_records]:
-          results.append(str(result['id']) )
-        print(' '.join(results))
+    nearest = tree.k_nearest_linked_records(query, 
+                                            num_results, 
+                                            'questions', 
+                                            data['max_possible_questions'], 
+                                            stats)
+  
+    # Due to clustering of multiple questions per topic, we could
+    # have more question results than we wanted.
+    num_records = min(len(nearest['questions']), num_results)
+    results = nearest['questions'][:num_records]
+    return ([result['id'] for result in results],
+            [result['distance'] for result in results])
+
+def process_queries(data, tree, writer, query_stats, single_pass=False, 
+                    cache=None):
+ """ Answers each query with answer_query and passes the results to writer
+      (a ResultWriter), counting the nodes visited and passes of each in
+      query_stats (a QueryStats). cache is an optional QueryCache.
+      
+      data['queries'] can be any iterable of queries, including a generator
+      that reads them as they come in.
+ """
+ 
+ stats = {}
+ for query in data['queries']:
+    
+    answer = answer_query(data, tree, query, stats, single_pass, cache)
+    if answer is None:
+      continue
+    
+    writer.write(*answer)
+    query_stats.add(stats['nodes'], stats['passes'])
+
+# What the worker processes of process_queries_parallel need to answer 
+# queries. It's filled in before the workers are forked, so they share the
+# tree with the parent process (copy-on-write) instead of each getting a copy.
+worker_state = {}
+
+def process_chunk(queries):
+  """ Answers a chunk of queries in a worker process, returning a list of 
+      (ids, distances, nodes visited, passes) for each of them (or None
+      for an unknown type of query). """
+  
+  data = worker_state['data']
+  tree = worker_state['tree']
+  single_pass = worker_state['single_pass']
+  
+  results = []
+  stats = {}
+  for query in queries:
+    answer = answer_query(data, tree, query, stats, single_pass)
+    if answer is None:
+      results.append(None)
+    else:
+      results.append(answer + (stats['nodes'], stats['passes']))
+    
+  return results
+
+def process_queries_parallel(data, tree, writer, query_stats, workers, 
+                             single_pass=False, chunk_size=256):
+  """ Same as process_queries, but answers the queries in a pool of workers
+      processes, chunk_size queries at a time, and writes the results in the
+      original query order. 
+      
+      The workers are forked after the tree is built, so they all use the
+      parent's copy of it.
+  """
+  
+  worker_state['data'] = {'max_possible_questions': 
+                          data['max_possible_questions']}
+  worker_state['tree'] = tree
+  worker_state['single_pass'] = single_pass
+  
+  queries = iter(data['queries'])
+  chunks = iter(lambda: list(itertools.islice(queries, chunk_size)), [])
+  
+  pool = multiprocessing.Pool(workers)
+  try:
+    for results in pool.imap(process_chunk, chunks):
+      for result in results:
+        if result is None:
+          continue
         
-        stat_list.append(stats['nodes'])
-        pass_list.append(stats['passes'])      
+        ids, distances, nodes, passes = result
+        writer.write(ids, distances)
+        query_stats.add(nodes, passes)
+  finally:
+    pool.close()
+    pool.join()
+      
+def process_queries_batch(data, tree, writer, query_stats):
+  """ Same as process_queries, but answers all the topic queries with one 
+      call to k_nearest_batch and all the question queries with one call to
+      k_nearest_linked_records_batch, then writes the results in the 
+      original query order.
+  """
+  
+  # Split the queries by type, keeping track of where each one came from.
+  columns = {'t': ([], [], [], []),
+             'q': ([], [], [], [])}
+  for index, query in enumerate(data['queries']):
+    xs, ys, ks, indexes = columns[query['type']]
+    xs.append(query['x'])
+    ys.append(query['y'])
+    ks.append(query['count'])
+    indexes.append(index)
+  
+  results = [None] * len(data['queries'])
+  distances = [None] * len(data['queries'])
+  node_counts = [0] * len(data['queries'])
+  pass_counts = [0] * len(data['queries'])
+  
+  stats = {}
+  for query_type, (xs, ys, ks, indexes) in columns.iteritems():
+    
+    if not indexes:
+      continue
+    
+    if query_type == 't':
+      nearest = tree.k_nearest_batch(xs, ys, ks, stats)
+    else:
+      nearest = tree.k_nearest_linked_records_batch(
+                  xs, ys, ks, 'questions', data['max_possible_questions'], stats)
+    
+    for position, index in enumerate(indexes):
+      results[index] = nearest['ids'][position]
+      distances[index] = nearest['distances'][position]
+      node_counts[index] = stats['node_counts'][position]
+      pass_counts[index] = stats['pass_counts'][position]
+  
+  for ids, query_distances in zip(results, distances):
+    writer.write(ids, query_distances)
+  
+  for nodes, passes in zip(node_counts, pass_counts):
+    query_stats.add(nodes, passes)
       
-def space_partitioning():
+def space_partitioning(single_pass=False, engine=None, leaf_size=1, 
+                       batch=False, stream=False, output_format='text',
+                       flush_size=1 << 16, snapshot=None, save_snapshot=None,
+                       workers=1, store=False, cache_size=0, cache_grid=0,
+                       split_rule='median'):
   """ This is the main function for reading the input file, processing queries,
       and printing the results. It takes a space-partitioning approach with
-      two kd-trees.  
+      a kd-tree.  
+      
+      single_pass selects the single-pass k-nearest search for topic queries,
+      engine is the name of the tree class to use (a key of ENGINES, by 
+      default kdtree, or the engine that saved the snapshot), and 
+      leaf_size is the most points each leaf of the trees holds. If batch is
+      True the queries are answered by process_queries_batch.
+      
+      If stream is True only the topics and questions are read before the
+      tree is built. Queries are then read from stdin one line at a time and
+      each is answered as soon as it's read (so batch doesn't apply).
+      
+      Results are written to stdout by a ResultWriter in the given 
+      output_format, in chunks of at least flush_size bytes (or one query
+      at a time when streaming).
+      
+      If snapshot is the name of a file written by save_snapshot, the tree
+      is mapped from it instead of being built, and the topics and questions
+      in the input are skipped. If save_snapshot is given, the tree that was
+      built (which needs an engine of SNAPSHOT_ENGINES) is written to that 
+      file.
+      
+      With more than one worker, the tree is built by that many processes, 
+      and queries that would be answered one at a time (not streamed or 
+      batched) are split between them by process_queries_parallel.
+      
+      If store is True the input is parsed by read_input_store (unless it's
+      streamed or the tree comes from a snapshot).
+      
+      If cache_size is more than 0, queries answered one at a time in this
+      process (streamed, or with one worker and no batch) go through a 
+      QueryCache of that size, with a quantum of cache_grid.
+      
+      split_rule is how the kd-tree engines split nodes (one of 
+      kdtree.SPLIT_RULES). The depth and number of leaves of the tree it 
+      makes are logged, along with the nodes visited by the queries.
   """
+  # Check the engine against the snapshot before reading any input.
+  if snapshot:
+    snapshot_engine = kdtree.snapshot_engine(snapshot)
+    if engine is None:
+      engine = snapshot_engine
+    elif engine != snapshot_engine:
+      raise ValueError("{} was saved by -engine {}, which -engine {} can't "
+                       "search.".format(snapshot, snapshot_engine, engine))
+  elif engine is None:
+    engine = 'kdtree'
+  
+  if engine not in ENGINES:
+    raise ValueError("Unknown engine {}, expected one of {}.".
+                     format(engine, ', '.join(sorted(ENGINES))))
+  tree_class = ENGINES[engine]
+  
+  if save_snapshot and engine not in SNAPSHOT_ENGINES:
+    raise ValueError("Snapshots can only be saved with -engine {}.".
+                     format(', '.join(sorted(SNAPSHOT_ENGINES))))
    
   logging.info("Reading from sys.stdin...")
   
-  data = read_input(sys.stdin)
+  if snapshot:
+    skip_points(sys.stdin)
+    data = {'queries': read_queries(sys.stdin)}
+    if not stream:
+      data['queries'] = list(data['queries'])
+  elif stream:
+    data = read_points(sys.stdin)
+    data['queries'] = read_queries(sys.stdin)
+  elif store:
+    data = read_input_store(sys.stdin)
+  else:
+    data = read_input_bulk(sys.stdin)
   
-  logging.info("Building a tree from {} topic points.".format(len(data['topics'])))
-    
-  # Build the topics tree
   t0 = time.clock()
   dimensions = ['x', 'y']
-  tree = kdtree.KDTree(data['topics'], dimensions)
+  if snapshot:
+    logging.info("Mapping the tree from {}.".format(snapshot))
+    
+    tree = SNAPSHOT_ENGINES[snapshot_engine](snapshot)
+    data['max_possible_questions'] = tree.max_possible_records
+  else:
+    logging.info("Building a tree from {} topic points.".
+                 format(len(data['topics'])))
+    
+    # Build the topics tree, counting linked questions for question queries.
+    tree = tree_class(data['topics'], dimensions, leaf_size, 'questions', 
+                      workers, split_rule)
   t1 = time.clock()
   
   logging.info("Tree constructed, there are {} total nodes ({} s).".
           format(tree.number_nodes, t1 - t0))
-    
-  # Build another tree for questions queries, with empty topics excluded 
-  logging.info("Building a tree from {} topic points.".format(len(data['topics_with_questions'])))
-  t0 = time.clock()
-  dimensions = ['x', 'y']
-  pruned_tree = kdtree.KDTree(data['topics_with_questions'].values(), dimensions)
-  t1 = time.clock()
-  logging.info("Tree constructed, there are {} total nodes ({} s).".
-          format(tree.number_nodes, t1 - t0))  
+  if engine in ('kdtree', 'flat'):
+    logging.info("Split rule {}: depth {}, {} leaves.".
+                 format(tree.split_rule, tree.depth(), tree.leaf_nodes))
+  
+  if save_snapshot:
+    tree.save_snapshot(save_snapshot, data['max_possible_questions'])
+    logging.info("Tree saved to {}.".format(save_snapshot))
+  
+  cache = None
+  if cache_size > 0:
+    cache = QueryCache(cache_size, cache_grid)
   
   # Actually process the queries
-  logging.info("Starting {} queries...".format(len(data['queries'])))
-  stat_list = []
-  pass_list = []
+  query_stats = QueryStats()
   t0 = time.clock()
-  process_queries(data, tree, pruned_tree, stat_list, pass_list)              
+  if stream:
+    logging.info("Starting queries from sys.stdin...")
+    writer = ResultWriter(sys.stdout, output_format, flush_size=0)
+    process_queries(data, tree, writer, query_stats, single_pass, cache)
+  elif batch:
+    logging.info("Starting {} queries...".format(len(data['queries'])))
+    writer = ResultWriter(sys.stdout, output_format, flush_size)
+    process_queries_batch(data, tree, writer, query_stats)
+  elif workers > 1:
+    logging.info("Starting {} queries in {} processes...".
+                 format(len(data['queries']), workers))
+    writer = ResultWriter(sys.stdout, output_format, flush_size)
+    process_queries_parallel(data, tree, writer, query_stats, workers, 
+                             single_pass)
+  else:
+    logging.info("Starting {} queries...".format(len(data['queries'])))
+    writer = ResultWriter(sys.stdout, output_format, flush_size)
+    process_queries(data, tree, writer, query_stats, single_pass, cache)
+  writer.flush()
   t1 = time.clock()
   logging.info("Queries finished ({} s)".format(t1-t0))
+  
+  if cache is not None:
+    logging.info("Query cache: {} hits, {} misses.".
+                 format(cache.hits, cache.misses))
 
   # Pull together some analysis for debugging and optimization.
-  pass_list.sort()
-  logging.info("In {} queries, the number passes was:".
-        format(len(data['queries'])))
-  logging.info("  {} -> min".format(pass_list[0]))
-  logging.info("  {} -> average".format(sum(pass_list)/len(pass_list)))
-  logging.info("  {} -> median".format(pass_list[len(pass_list)/2]))
-  logging.info("  {} -> max".format(pass_list[-1]))  
-  
-  stat_list.sort()
-  logging.info("In {} queries, the number nodes visited was:".
-        format(len(data['queries'])))
-  logging.info("  {} -> min".format(stat_list[0]))
-  logging.info("  {} -> average".format(sum(stat_list)/len(stat_list)))
-  logging.info("  {} -> median".format(stat_list[len(stat_list)/2]))
-  logging.info("  {} -> max".format(stat_list[-1]))          
+  query_stats.log_summary()
 
 if __name__ == "__main__":
   
+  options = sys.argv[1:]
+  
   # Turn on logging with -log switch
-  if len(sys.argv) > 1:
-    if sys.argv[1] == "-log":
-      logging.basicConfig(filename='quora_nearby.log',level=logging.INFO)
+  if "-log" in options:
+    logging.basicConfig(filename='quora_nearby.log',level=logging.INFO)
+  
+  # Use the single-pass k-nearest search with the -singlepass switch
+  single_pass = "-singlepass" in options
+  
+  # Pick the tree implementation with -engine <name> (kdtree, unless a
+  # snapshot says otherwise)
+  engine = None
+  if "-engine" in options:
+    engine = options[options.index("-engine") + 1]
+    
+  # Set the number of points per leaf with -leafsize <n>
+  leaf_size = 1
+  if "-leafsize" in options:
+    leaf_size = int(options[options.index("-leafsize") + 1])
+  
+  # Answer all queries of each type at once with -batch
+  batch = "-batch" in options
+  
+  # Answer queries as they're read from stdin with -stream
+  stream = "-stream" in options
+  
+  # Pick the output format with -format <text, ndjson or binary>
+  output_format = 'text'
+  if "-format" in options:
+    output_format = options[options.index("-format") + 1]
+    
+  # Set how many bytes of output are collected per write with -flushsize <n>
+  flush_size = 1 << 16
+  if "-flushsize" in options:
+    flush_size = int(options[options.index("-flushsize") + 1])
+  
+  # Map the tree from a snapshot file with -snapshot <file>, or save the
+  # tree that was built to one with -savesnapshot <file>
+  snapshot = None
+  if "-snapshot" in options:
+    snapshot = options[options.index("-snapshot") + 1]
+  save_snapshot = None
+  if "-savesnapshot" in options:
+    save_snapshot = options[options.index("-savesnapshot") + 1]
+  
+  # Answer queries in several processes with -workers <n>
+  workers = 1
+  if "-workers" in options:
+    workers = int(options[options.index("-workers") + 1])
+  
+  # Parse topics and questions into a columnar store with -store
+  store = "-store" in options
+  
+  # Cache the answers for n query locations with -cache <n>, on a grid of
+  # squares of the given size with -cachegrid <size>
+  cache_size = 0
+  if "-cache" in options:
+    cache_size = int(options[options.index("-cache") + 1])
+  cache_grid = 0
+  if "-cachegrid" in options:
+    cache_grid = float(options[options.index("-cachegrid") + 1])
+  
+  # Pick how the kd-tree splits nodes with -split <median, midpoint or cost>
+  split_rule = 'median'
+  if "-split" in options:
+    split_rule = options[options.index("-split") + 1]
   
   # Invoke space partitioning 
-  space_partitioning()
+  space_partitioning(single_pass, engine, leaf_size, batch, stream, 
+                     output_format, flush_size, snapshot, save_snapshot,
+                     workers, store, cache_size, cache_grid, split_rule)
 
@@ -0,0 +1,273 @@
+#!/usr/bin/python
+
+"""
+  mortonindex.py: points sorted in Z-order, as an alternative to a kd-tree.
+
+  The bounding square of the points is divided into a 2^16 by 2^16 grid, and
+  each point gets the Morton code of its grid cell, which interleaves the
+  bits of the column and row (x in the even bits, y in the odd ones).
+  Sorting the points by code puts them in Z-order: every quadrant of the
+  square, and every quadrant of a quadrant and so on, is a contiguous range
+  of the sorted codes. So the sorted array is a quadtree with no pointers,
+  where a node is a range of codes and its children are found by binary
+  searching the three codes that split it into quarters.
+
+  The index is built with a single sort of the points by code, and is
+  nothing but flat arrays of numbers.
+"""
+
+import heapq
+import bisect
+import itertools
+from array import array
+import kdtree
+
+# The number of bits of a column or row, so codes have twice as many.
+CODE_BITS = 16
+
+# SPREAD[byte] has the bits of byte moved to the even bits of a 16 bit
+# number, with zeroes in between.
+SPREAD = array('l', (sum(((byte >> bit) & 1) << (2 * bit) for bit in range(8))
+                     for byte in range(256)))
+
+def morton_code(column, row):
+  """ Returns the Morton code of a grid cell, interleaving the bits of the
+      column (the even bits) and row (the odd bits), each of CODE_BITS. """
+
+  return (SPREAD[column & 255] | (SPREAD[column >> 8] << 16) |
+          (SPREAD[row & 255] << 1) | (SPREAD[row >> 8] << 17))
+
+class MortonIndex(kdtree.PointArrayIndex):
+  """ Points sorted by Morton code, with the same query methods as KDTree.
+
+      Points are stored like those of a FlatKDTree, in arrays ordered by
+      code, with their codes in the codes array. A node of the implicit
+      quadtree is (level, first code, start, end): the codes from first code
+      up to first code + 4^(CODE_BITS - level), which are at positions start
+      up to end. A node with no more than bucket_size points is a bucket,
+      compared with the query all at once. Quadtree nodes are the nodes in
+      the stats, and number_nodes is the number of distinct codes.
+  """
+
+  # The most points in a bucket, unless a larger leaf size is given.
+  bucket_points = 16
+
+  snapshot_engine = 'morton'
+  snapshot_attributes = kdtree.PointArrayIndex.snapshot_attributes + (
+    'bucket_size', 'min_x', 'min_y', 'side', 'scale')
+
+  def __init__(self, data, dimensions, leaf_size=1, linked_key=None,
+               workers=1, split_rule='median'):
+    """ Same arguments as KDTree. leaf_size is the most points in a bucket
+        if it's more than bucket_points, and workers and split_rule are
+        ignored. """
+
+    self.dimensions = dimensions
+    self.leaf_size = leaf_size
+    self.bucket_size = max(leaf_size, self.bucket_points)
+    self.set_points(data)
+    columns = kdtree.point_columns(data, dimensions)
+
+    self.number_points = len(data)
+    self.choose_square(columns)
+
+    # Sort the points by code, keeping the original order for equal codes.
+    codes = [self.code(columns[0][index], columns[1][index])
+             for index in range(self.number_points)]
+    order = sorted(range(self.number_points), key=codes.__getitem__)
+
+    self.codes = array('l', (codes[index] for index in order))
+    self.leaf_points = array('l', order)
+    self.coordinates = [array('d', (column[index] for index in order))
+                        for column in columns]
+
+    self.number_nodes = self.leaf_nodes = sum(
+      1 for position in range(self.number_points)
+      if position == 0 or self.codes[position] != self.codes[position - 1])
+
+    if linked_key is not None:
+      self.linked_key = linked_key
+      self.count_linked_records()
+
+    self.version += 1
+
+  def choose_square(self, columns):
+    """ Sets the origin and side of the square the grid covers, which is the
+        smallest one holding the points in columns (a sequence of x and one
+        of y coordinates) from their lowest x and y, and the scale from
+        coordinates to grid cells. """
+
+    if self.number_points:
+      self.min_x = min(columns[0])
+      self.min_y = min(columns[1])
+      self.side = max(max(columns[0]) - self.min_x,
+                      max(columns[1]) - self.min_y)
+    else:
+      self.min_x = self.min_y = self.side = 0
+
+    self.side = self.side or 1.0
+    self.scale = (1 << CODE_BITS) / self.side
+
+  def column_row(self, x, y):
+    """ Returns the column and row of the grid cell nearest to (x, y). """
+    last = (1 << CODE_BITS) - 1
+    column = int((x - self.min_x) * self.scale)
+    row = int((y - self.min_y) * self.scale)
+    return min(max(column, 0), last), min(max(row, 0), last)
+
+  def code(self, x, y):
+    """ Returns the Morton code of the grid cell nearest to (x, y). """
+    return morton_code(*self.column_row(x, y))
+
+  def count_node_records(self):
+    """ Same as PointArrayIndex.count_node_records for the implicit 
+        quadtree. The linked points before each position are summed up in
+        linked_before, so a node has linked points if the sums differ at 
+        its start and end. """
+
+    self.linked_before = array('l', [0]) * (self.number_points + 1)
+    for position, records in enumerate(self.point_records):
+      self.linked_before[position + 1] = (self.linked_before[position] +
+                                          (1 if records else 0))
+
+  def root_node(self):
+    """ Returns the root of the implicit quadtree and its box, (min x, min
+        y, max x, max y). """
+    return ((0, 0, 0, self.number_points),
+            (self.min_x, self.min_y, self.min_x + self.side,
+             self.min_y + self.side))
+
+  def children(self, node, box):
+    """ Returns the nodes of the implicit quadtree under the given one, and
+        their boxes, leaving out empty quarters. """
+
+    level, first_code, start, end = node
+    quarter = 1 << (2 * (CODE_BITS - level - 1))
+    half = (box[2] - box[0]) / 2
+
+    children = []
+    for child in range(4):
+      if child < 3:
+        child_end = bisect.bisect_left(self.codes,
+                                       first_code + (child + 1) * quarter,
+                                       start, end)
+      else:
+        child_end = end
+
+      if child_end > start:
+        min_x = box[0] + (child & 1) * half
+        min_y = box[1] + (child >> 1) * half
+        children.append(((level + 1, first_code + child * quarter, start,
+                          child_end),
+                         (min_x, min_y, min_x + half, min_y + half)))
+      start = child_end
+
+    return children
+
+  def is_bucket(self, node):
+    """ Returns True if the node is compared point by point. """
+    return node[3] - node[2] <= self.bucket_size or node[0] == CODE_BITS
+
+  def depth(self):
+    """ Same as KDTree.depth, for the implicit quadtree. """
+
+    depth = 0
+    stack = [self.root_node()] if self.number_points else []
+    while stack:
+      node, box = stack.pop()
+      depth = max(depth, node[0] + 1)
+      if not self.is_bucket(node):
+        stack.extend(self.children(node, box))
+
+    return depth
+
+  def find_k_nearest(self, node, query, mins_so_far, stats):
+    """ Same as FlatKDTree.find_k_nearest, searching the whole index (node
+        is ignored).
+
+        The points nearest the query's code along the curve are compared
+        first, found by binary search, for a first search radius. Then the
+        quadtree is walked depth first, nearest quarter first, skipping
+        nodes whose box is no closer than the farthest candidate. """
+
+    position = bisect.bisect_left(self.codes, self.code(query[0], query[1]))
+    reach = max(mins_so_far.k, self.bucket_size) // 2 + 1
+    self.compare_range(max(0, position - reach),
+                       min(self.number_points, position + reach),
+                       query, mins_so_far)
+
+    query_box = (query[0], query[1], query[0], query[1])
+    stack = [(0,) + self.root_node()]
+    while stack:
+
+      key, node, box = stack.pop()
+      if key >= mins_so_far.key_radius():
+        continue
+
+      stats['nodes'] += 1
+
+      if self.is_bucket(node):
+        self.compare_range(node[2], node[3], query, mins_so_far)
+        continue
+
+      # Push the nearest quarter last so it's searched first.
+      children = [(kdtree.box_key(child_box, query_box), child, child_box)
+                  for child, child_box in self.children(node, box)]
+      children.sort(reverse=True)
+      stack.extend(children)
+
+    return mins_so_far
+
+  def nearest_positions_iter(self, query, stats, linked_only=False):
+    """ Same as FlatKDTree.nearest_positions_iter, walking the quadtree
+        nearest node first. """
+
+    query_box = (query[0], query[1], query[0], query[1])
+    order = itertools.count()
+    leaf_points = self.leaf_points
+
+    # Entries are (key, is_point, order for a node or index for a point,
+    # node or position, box), as in kdtree.KDTreeNode.nearest_iter, with a
+    # box of None for points.
+    node, box = self.root_node()
+    queue = [(0, False, next(order), node, box)]
+    while queue:
+
+      key, is_point, rank, node, box = heapq.heappop(queue)
+
+      if is_point:
+        yield node, kdtree.key_distance(key)
+        continue
+
+      stats['nodes'] += 1
+
+      if self.is_bucket(node):
+        start = node[2]
+        end = node[3]
+        keys = kdtree.bucket_keys(self.coordinates[0][start:end],
+                                  self.coordinates[1][start:end],
+                                  query[0], query[1])
+        for position, key in enumerate(keys, start):
+          if linked_only and not self.point_records[position]:
+            continue
+          heapq.heappush(queue, (key if key > kdtree.ZERO_KEY else 0, True,
+                                 leaf_points[position], position, None))
+        continue
+
+      for child, child_box in self.children(node, box):
+        if linked_only and (self.linked_before[child[3]] ==
+                            self.linked_before[child[2]]):
+          continue
+        heapq.heappush(queue, (kdtree.box_key(child_box, query_box), False,
+                               next(order), child, child_box))
+
+  def snapshot_sections(self):
+    """ Same as PointArrayIndex.snapshot_sections, with the codes and
+        linked_before first. """
+    return ([('codes', 'l', 'points'),
+             ('linked_before', 'l', 'point_offsets')] +
+            kdtree.PointArrayIndex.snapshot_sections(self))
+
+class SnapshotMortonIndex(kdtree.SnapshotIndex, MortonIndex):
+  """ A MortonIndex loaded from a file written by its save_snapshot (see
+      kdtree.SnapshotIndex). """
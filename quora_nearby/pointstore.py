@@ -0,0 +1,147 @@
+#!/usr/bin/python
+
+"""
+  pointstore.py: a columnar store of points and the records linked to them.
+
+  Parsing the input into dictionaries makes every topic a dictionary of its
+  coordinates and a value dictionary with its id and a list of question ids,
+  several hundred bytes each before counting the questions. A PointStore
+  keeps the same information in a few flat arrays instead: the points are
+  numbered 0 to n - 1 in input order (their dense index), with their ids and
+  coordinates in one array each, and the records linked to them are stored
+  in compressed sparse row form.
+
+  Records are numbered in increasing order of their ids, and the links of
+  each point are sorted once when the store is made, so a search can take
+  them in order without sorting or hashing anything. record_offsets[index]
+  up to record_offsets[index + 1] is the range of the records array holding
+  the record numbers of the point with that index, and record_ids maps a
+  record number back to its id. Since the records are numbered densely, a
+  VisitedSet of record numbers can skip the duplicates found by a search
+  without hashing them.
+"""
+
+from array import array
+
+class PointStore():
+  """ Points with ids, coordinates and linked records, stored in arrays.
+
+      Indexing the store gives the point with that index in the same form
+      as the parsed input ({'x': x, 'y': y, 'value': {'id': id, linked_key:
+      [record ids]}}), built on demand, so any tree can be built from it.
+      FlatKDTree uses the arrays directly instead.
+  """
+
+  def __init__(self, ids, coordinates, dimensions, record_ids=(),
+               record_points=(), linked_key='questions'):
+    """ ids is the id of each point, coordinates a dictionary holding the
+        sequence of the points' coordinates for each of the dimensions,
+        record_ids the id of each record and record_points the ids of the
+        points linked to each record, in the same order. The links are
+        listed under linked_key in the points built by indexing the store.
+    """
+
+    self.dimensions = dimensions
+    self.linked_key = linked_key
+
+    self.ids = array('l', ids)
+    self.coordinates = dict((dimension, array('d', coordinates[dimension]))
+                            for dimension in dimensions)
+
+    # The id to index map is only needed to read the links.
+    indexes = dict((point_id, index) for index, point_id in enumerate(self.ids))
+
+    # Number the records in order of their ids.
+    order = sorted(range(len(record_ids)), key=record_ids.__getitem__)
+    self.record_ids = array('l', (record_ids[record] for record in order))
+
+    # Count the links of each point to find where its range starts, then
+    # fill the ranges in record order so each one comes out sorted.
+    counts = array('l', [0]) * (len(self.ids) + 1)
+    for record_points_ids in record_points:
+      for point_id in record_points_ids:
+        counts[indexes[point_id] + 1] += 1
+
+    self.record_offsets = counts
+    for index in range(len(self.ids)):
+      self.record_offsets[index + 1] += self.record_offsets[index]
+
+    self.records = array('l', [0]) * self.record_offsets[-1]
+    next_slots = self.record_offsets[:-1]
+    for number, record in enumerate(order):
+      for point_id in record_points[record]:
+        index = indexes[point_id]
+        self.records[next_slots[index]] = number
+        next_slots[index] += 1
+
+    # Records without any points can never be found.
+    self.records_without_points = sum(1 for points in record_points
+                                      if not points)
+
+  def __len__(self):
+    return len(self.ids)
+
+  def __getitem__(self, index):
+    """ Returns the point with the given index as a dictionary. """
+
+    if not 0 <= index < len(self.ids):
+      raise IndexError("PointStore index out of range")
+
+    point = dict((dimension, self.coordinates[dimension][index])
+                 for dimension in self.dimensions)
+    point['value'] = {'id': self.ids[index],
+                      self.linked_key: [self.record_ids[record] for record in
+                                        self.point_records(index)]}
+    return point
+
+  def point_records(self, index):
+    """ Returns the record numbers linked to the point with the given index,
+        in increasing order. """
+    return self.records[self.record_offsets[index]:
+                        self.record_offsets[index + 1]]
+
+  def record_count(self, index):
+    """ Returns the number of records linked to the point with the given
+        index. """
+    return self.record_offsets[index + 1] - self.record_offsets[index]
+
+  def max_possible_records(self):
+    """ Returns the number of records linked to at least one point, the most
+        that a search for linked records can find. """
+    return len(self.record_ids) - self.records_without_points
+
+  def memory_size(self):
+    """ Returns the number of bytes taken by the arrays of the store. """
+    arrays = ([self.ids, self.record_ids, self.record_offsets, self.records] +
+              self.coordinates.values())
+    return sum(len(values) * values.itemsize for values in arrays)
+
+class VisitedSet():
+  """ A set of the numbers 0 to size - 1, such as the record numbers of a
+      PointStore, for skipping duplicates in a search.
+
+      Each number has a stamp in a list, and is in the set when its stamp
+      is the current generation. So checking and adding a number is one
+      list lookup with no hashing, and clear() empties the set in O(1) by
+      starting a new generation instead of touching the stamps. A search
+      can keep one set and clear it for every query. The stamps are a list
+      rather than an array so reading one doesn't make a new int.
+  """
+
+  def __init__(self, size):
+    self.stamps = [0] * size
+    self.generation = 1
+
+  def __contains__(self, number):
+    return self.stamps[number] == self.generation
+
+  def add(self, number):
+    """ Adds number to the set, returning False if it was already in it. """
+    if self.stamps[number] == self.generation:
+      return False
+    self.stamps[number] = self.generation
+    return True
+
+  def clear(self):
+    """ Empties the set. """
+    self.generation += 1
@@ -6,9 +6,11 @@
 from operator import itemgetter
 from collections import Counter
 import time
+import math
 import random
 import sys
 import kdtree
+import main
 
 def sample_square(bottom_left, side_length, quantity):
   """ Returns a list of points (each as a dictionary with 'x' and 'y' keys)
@@ -36,6 +38,30 @@ def sample_square(bottom_left, side_length, quantity):
     
   return points
 
+def sample_clusters(bottom_left, side_length, quantity, centers, spread):
+  """ Returns a list of points like sample_square, clustered around the 
+      given centers (points in the square) like the cities of a map. Each
+      point picks a center at random and is normally distributed around it 
+      with a standard deviation of spread times side_length, clipped to the
+      square. """
+  
+  points = []
+  
+  for point in range(quantity):
+    
+    center = random.choice(centers)
+    coordinates = []
+    for dimension in ('x', 'y'):
+      coordinate = random.gauss(center[dimension], spread * side_length)
+      coordinates.append(min(max(coordinate, bottom_left[dimension]), 
+                             bottom_left[dimension] + side_length))
+    
+    points.append({'x': coordinates[0],
+                   'y': coordinates[1],
+                   'value': "Hulk {}".format(point)})
+    
+  return points
+
 def partitions_to_file(tree, target, 
                        min_point, max_point, 
                        output_filename="kdtree_parts.out"):
@@ -158,6 +184,25 @@ def stress_test():
   print("  {} -> median".format(stat_list[len(stat_list)/2]))
   print("  {} -> max".format(stat_list[-1]))  
 
+  print("Starting single-pass {}-nearest-neighbor queries...".format(k))
+  t0 = time.clock()
+  stat_list = []
+  for death in test_points:
+    
+    # Same query, but with one traversal and a bounded heap
+    result = tree.k_nearest(death, k, stats, single_pass=True)
+    stat_list.append(stats['nodes'])
+
+  time_elapsed = time.clock() - t0
+  print("Queries finished ({} s)".format(time_elapsed))
+  
+  stat_list.sort()
+  print("In {} single-pass {}NN queries, the number nodes visited was:".format(queries, k))
+  print("  {} -> min".format(stat_list[0]))
+  print("  {} -> average".format(sum(stat_list)/len(stat_list)))
+  print("  {} -> median".format(stat_list[len(stat_list)/2]))
+  print("  {} -> max".format(stat_list[-1]))  
+
 def check_nearest_accuracy():
   """ This is a function for verifying the accuracy of results by
       calculating the actual nearest neighbors by brute force.
@@ -271,8 +316,10 @@ def check_k_nearest_accuracy():
   stats = {}
   for test_point in test_points:
     
-    # Find the k nearest neighborsto the query point
-    k_nearest = tree.k_nearest(test_point, k, stats)
+    # Find the k nearest neighborsto the query point, alternating between
+    # the multi-pass and single-pass searches so both get checked.
+    single_pass = len(result_list) % 2 == 1
+    k_nearest = tree.k_nearest(test_point, k, stats, single_pass)
     
     # Now calculate the actual distances of each point from the target
     # for the purpose of testing accuracy
@@ -326,6 +373,621 @@ def check_k_nearest_accuracy():
   print("In {} queries, {} were correct and {} were incorrect.".
         format(queries, frequencies[True], frequencies[False]))
   
+def tree_memory(node):
+  """ Returns the number of bytes used by the KDTreeNode objects in the tree
+      rooted at node, not counting the data points they refer to. """
+  
+  size = sys.getsizeof(node) + sys.getsizeof(node.__dict__)
+  for child in (node.left_child, node.right_child):
+    if child:
+      size += tree_memory(child)
+      
+  return size
+
+def flat_tree_memory(tree):
+  """ Returns the number of bytes used by the arrays of a FlatKDTree, 
+      not counting the data points they refer to. """
+  
+  arrays = [tree.axes, tree.values, tree.left_children, tree.right_children, 
+            tree.bucket_starts, tree.bucket_ends, tree.leaf_points] 
+  arrays += tree.coordinates
+  return sum(sys.getsizeof(item) for item in arrays)
+
+def check_flat_tree():
+  """ Compares the FlatKDTree to the KDTree it mirrors, checking that the 
+      k nearest neighbors match and reporting memory use and query time. """
+  
+  origin = {'x': 0, 'y': 0}
+  size = 1000000
+  number = 10000
+  k = 10
+  data = sample_square(origin, size, number)
+  dimensions = ['x', 'y']
+  
+  print("Building both trees from {} points...".format(number))
+  t0 = time.clock()
+  tree = kdtree.KDTree(data, dimensions)
+  t1 = time.clock()
+  flat_tree = kdtree.FlatKDTree(data, dimensions)
+  t2 = time.clock()
+  print("  KDTree: {} nodes, {} bytes ({} s)".
+        format(tree.number_nodes, tree_memory(tree.root), t1 - t0))
+  print("  FlatKDTree: {} nodes, {} bytes ({} s)".
+        format(flat_tree.number_nodes, flat_tree_memory(flat_tree), t2 - t1))
+  
+  queries = 1000
+  test_points = sample_square(origin, size, queries)
+  stats = {}
+  
+  t0 = time.clock()
+  expected = [tree.k_nearest(point, k, stats, single_pass=True) 
+              for point in test_points]
+  t1 = time.clock()
+  results = [flat_tree.k_nearest(point, k, stats) for point in test_points]
+  t2 = time.clock()
+  print("{} {}NN queries: KDTree {} s, FlatKDTree {} s".
+        format(queries, k, t1 - t0, t2 - t1))
+  
+  result_list = []
+  for tree_result, flat_result in zip(expected, results):
+    tree_points = [result['point'].point for result in tree_result['list']]
+    flat_points = [result['point'].point for result in flat_result['list']]
+    result_list.append(tree_points == flat_points)
+    
+  frequencies = Counter(result_list)
+  print("In {} queries, {} matched and {} did not match.".
+        format(queries, frequencies[True], frequencies[False]))
+
+def check_leaf_sizes(leaf_sizes=(1, 2, 4, 8, 16, 32, 64)):
+  """ Sweeps the leaf size of both tree types, timing k-nearest queries 
+      and checking that the results match the tree with one point per leaf. """
+  
+  origin = {'x': 0, 'y': 0}
+  size = 1000000
+  number = 10000
+  k = 10
+  queries = 1000
+  data = sample_square(origin, size, number)
+  test_points = sample_square(origin, size, queries)
+  dimensions = ['x', 'y']
+  stats = {}
+  
+  print("Sweeping leaf sizes for {} {}NN queries on {} points...".
+        format(queries, k, number))
+  
+  expected = None
+  for tree_class in (kdtree.KDTree, kdtree.FlatKDTree):
+    for leaf_size in leaf_sizes:
+      
+      t0 = time.clock()
+      tree = tree_class(data, dimensions, leaf_size)
+      build_time = time.clock() - t0
+      
+      t0 = time.clock()
+      stat_list = []
+      results = []
+      for point in test_points:
+        nearest = tree.k_nearest(point, k, stats, single_pass=True)
+        results.append([result['point'].point for result in nearest['list']])
+        stat_list.append(stats['nodes'])
+      query_time = time.clock() - t0
+      
+      if expected is None:
+        expected = results
+        
+      print("  {} leaf size {}: {} nodes, build {:0.3f} s, queries {:0.3f} s, "
+            "{} nodes visited on average, {} mismatches".
+            format(tree_class.__name__, leaf_size, tree.number_nodes, 
+                   build_time, query_time, sum(stat_list)/len(stat_list),
+                   sum(1 for a, b in zip(expected, results) if a != b)))
+
+def check_batch():
+  """ Compares k_nearest_batch (and k_nearest_dual_tree) against one 
+      k_nearest call per query, for both tree types, checking the results
+      match and timing them. """
+  
+  origin = {'x': 0, 'y': 0}
+  size = 1000000
+  number = 10000
+  queries = 10000
+  data = sample_square(origin, size, number)
+  for index, point in enumerate(data):
+    point['value'] = {'id': index}
+  test_points = sample_square(origin, size, queries)
+  xs = [point['x'] for point in test_points]
+  ys = [point['y'] for point in test_points]
+  ks = [random.randint(1, 10) for point in test_points]
+  dimensions = ['x', 'y']
+  
+  for tree_class in (kdtree.KDTree, kdtree.FlatKDTree):
+    tree = tree_class(data, dimensions)
+    stats = {}
+    
+    t0 = time.clock()
+    expected = []
+    nodes = 0
+    for point, k in zip(test_points, ks):
+      nearest = tree.k_nearest(point, k, stats, single_pass=True)
+      expected.append([result['point'].point['value']['id'] 
+                       for result in nearest['list']])
+      nodes += stats['nodes']
+    single_time = time.clock() - t0
+    
+    t0 = time.clock()
+    results = tree.k_nearest_batch(xs, ys, ks, stats)
+    batch_time = time.clock() - t0
+    
+    mismatches = sum(1 for a, b in zip(expected, results['ids']) if a != b)
+    print("{}: {} queries one at a time {:0.3f} s ({} nodes), batch {:0.3f} s "
+          "({} nodes), {} mismatches".
+          format(tree_class.__name__, queries, single_time, nodes, 
+                 batch_time, stats['nodes'], mismatches))
+    
+    t0 = time.clock()
+    results = tree.k_nearest_dual_tree(xs, ys, ks, stats)
+    dual_time = time.clock() - t0
+    
+    mismatches = sum(1 for a, b in zip(expected, results['ids']) if a != b)
+    print("{}: dual-tree {:0.3f} s ({} node pairs), {} mismatches".
+          format(tree_class.__name__, dual_time, stats['nodes'], mismatches))
+
+def check_linked_counts(share_with_records=0.1):
+  """ Compares nearest linked record queries on one tree built with a 
+      linked_key against the old approach of a second tree holding only the
+      points with linked records, for both tree types. Only about 
+      share_with_records of the points have any records. """
+  
+  origin = {'x': 0, 'y': 0}
+  size = 1000000
+  number = 10000
+  queries = 2000
+  data = sample_square(origin, size, number)
+  next_record = 0
+  for index, point in enumerate(data):
+    records = []
+    if random.random() < share_with_records:
+      records = range(next_record, next_record + random.randint(1, 3))
+      next_record += len(records)
+    point['value'] = {'id': index, 'records': records}
+  linked_data = [point for point in data if point['value']['records']]
+  test_points = sample_square(origin, size, queries)
+  ks = [random.randint(1, 100) for point in test_points]
+  dimensions = ['x', 'y']
+  
+  for tree_class in (kdtree.KDTree, kdtree.FlatKDTree):
+    
+    t0 = time.clock()
+    tree = tree_class(data, dimensions)
+    pruned_tree = tree_class(linked_data, dimensions)
+    two_trees_time = time.clock() - t0
+    
+    t0 = time.clock()
+    linked_tree = tree_class(data, dimensions, linked_key='records')
+    one_tree_time = time.clock() - t0
+    
+    mismatches = 0
+    pruned_nodes = 0
+    linked_nodes = 0
+    stats = {}
+    for point, k in zip(test_points, ks):
+      expected = pruned_tree.k_nearest_linked_records(point, k, 'records', 
+                                                      next_record, stats)
+      pruned_nodes += stats['nodes']
+      result = linked_tree.k_nearest_linked_records(point, k, 'records', 
+                                                    next_record, stats)
+      linked_nodes += stats['nodes']
+      if expected != result:
+        mismatches += 1
+        
+    print("{}: build two trees {:0.3f} s, one counted tree {:0.3f} s; "
+          "{} nodes visited on average with the pruned tree, {} with the "
+          "counted tree, {} mismatches".
+          format(tree_class.__name__, two_trees_time, one_tree_time,
+                 pruned_nodes/queries, linked_nodes/queries, mismatches))
+
+def tree_shape(node):
+  """ Returns the structure of the tree under node as nested tuples, with 
+      the ids of the data points (the python object ids, so two trees only
+      match if they hold the very same points) in the leaves. """
+  
+  if not node:
+    return None
+  elif node.is_leaf() and node.bucket:
+    return tuple(id(leaf.point) for leaf in node.bucket)
+  elif node.is_leaf():
+    return id(node.point)
+  
+  return (node.axis, node.value, 
+          tree_shape(node.left_child), tree_shape(node.right_child))
+
+def flat_tree_shape(tree):
+  """ Same as tree_shape, for a FlatKDTree. """
+  
+  return (tree.root, list(tree.axes), list(tree.values), 
+          list(tree.left_children), list(tree.right_children), 
+          list(tree.bucket_starts), list(tree.bucket_ends), 
+          list(tree.leaf_points), [list(axis) for axis in tree.coordinates])
+
+def check_parallel_build(worker_counts=(1, 2, 4, 8), leaf_size=8,
+                         split_rules=('median', 'midpoint')):
+  """ Times building both tree types with different numbers of worker 
+      processes, checking each tree is the same as the one built by a 
+      single process, for each split rule. """
+  
+  origin = {'x': 0, 'y': 0}
+  size = 1000000
+  number = 200000
+  data = sample_square(origin, size, number)
+  dimensions = ['x', 'y']
+  
+  print("Building trees of {} points with a leaf size of {}:".
+        format(number, leaf_size))
+  for tree_class, shape in ((kdtree.KDTree, lambda tree: tree_shape(tree.root)),
+                            (kdtree.FlatKDTree, flat_tree_shape)):
+    for split_rule in split_rules:
+      expected = None
+      for workers in worker_counts:
+        # Wall clock time, since the work is spread over several processes.
+        start = time.time()
+        tree = tree_class(data, dimensions, leaf_size, workers=workers,
+                          split_rule=split_rule)
+        build_time = time.time() - start
+        
+        counts = (tree.number_nodes, tree.leaf_nodes, tree.number_points)
+        if expected is None:
+          expected = (shape(tree), counts)
+          
+        print("  {} ({} rule) with {} workers: {:0.3f} s, same tree: {}".
+              format(tree_class.__name__, split_rule, workers, build_time, 
+                     (shape(tree), counts) == expected))
+
+def check_partition_build(number=100000, leaf_sizes=(1, 8)):
+  """ Times building both tree types with build_by_partition (the default)
+      and with build_by_sublists, checking the trees are the same. The 
+      coordinates are rounded so there are plenty of duplicates. """
+  
+  origin = {'x': 0, 'y': 0}
+  size = 1000
+  data = sample_square(origin, size, number)
+  for point in data:
+    point['x'] = round(point['x'])
+    point['y'] = round(point['y'])
+  dimensions = ['x', 'y']
+  
+  for tree_class, shape in ((kdtree.KDTree, lambda tree: tree_shape(tree.root)),
+                            (kdtree.FlatKDTree, flat_tree_shape)):
+    for leaf_size in leaf_sizes:
+      tree = tree_class([], dimensions, leaf_size)
+      t0 = time.clock()
+      tree.build_by_partition(data)
+      partition_time = time.clock() - t0
+      
+      sublists_tree = tree_class([], dimensions, leaf_size)
+      t0 = time.clock()
+      sublists_tree.build_by_sublists(data)
+      sublists_time = time.clock() - t0
+      
+      same = (shape(tree) == shape(sublists_tree) and 
+              tree.number_nodes == sublists_tree.number_nodes and
+              tree.number_points == sublists_tree.number_points)
+      print("{} of {} points, leaf size {}: partition {:0.3f} s, sublists "
+            "{:0.3f} s, same tree: {}".
+            format(tree_class.__name__, number, leaf_size, partition_time, 
+                   sublists_time, same))
+
+def check_split_rules(number=10000, queries=2000, k=10, leaf_size=8):
+  """ Builds a FlatKDTree with each split rule on uniform, clustered, 
+      duplicate heavy and skewed points (on a line, at a power of two apart
+      from the next, so the midpoint rule makes a tree over a thousand 
+      levels deep), and reports the build time, depth and number of leaves
+      of each tree, and the average number of nodes visited by 
+      k-nearest queries drawn like the points. The distances found are 
+      checked against the median tree (the points themselves can differ 
+      among duplicates). """
+  
+  origin = {'x': 0, 'y': 0}
+  size = 1000000
+  dimensions = ['x', 'y']
+  
+  random.seed(24)
+  centers = sample_square(origin, size, 50)
+  locations = sample_square(origin, size, number / 20)
+  samplers = (('uniform', lambda quantity: sample_square(origin, size, 
+                                                         quantity)),
+              ('clustered', lambda quantity: sample_clusters(origin, size, 
+                                                             quantity, centers,
+                                                             0.005)),
+              ('duplicates', lambda quantity: [dict(random.choice(locations)) 
+                                               for point in range(quantity)]),
+              ('skewed', lambda quantity: 
+               [{'x': size * 2.0 ** -random.randint(0, 1500), 'y': 0} 
+                for point in range(quantity)]))
+  
+  for name, sample in samplers:
+    data = sample(number)
+    test_points = [(point['x'], point['y']) for point in sample(queries)]
+    print("{} {} points, {} {}-nearest queries, leaf size {}:".
+          format(number, name, queries, k, leaf_size))
+    
+    expected = None
+    for split_rule in kdtree.SPLIT_RULES:
+      t0 = time.clock()
+      tree = kdtree.FlatKDTree(data, dimensions, leaf_size, 
+                               split_rule=split_rule)
+      build_time = time.clock() - t0
+      
+      nodes = 0
+      distances = []
+      t0 = time.clock()
+      for query in test_points:
+        stats = {'nodes': 0, 'passes': 0}
+        mins_so_far = tree.find_k_nearest_positions(query, k, stats)
+        distances.append([result['distance'] 
+                          for result in mins_so_far.sorted_list()])
+        nodes += stats['nodes']
+      query_time = time.clock() - t0
+      
+      if expected is None:
+        expected = distances
+      print("  {}: build {:0.3f} s, depth {}, {} leaves, {:0.1f} nodes per "
+            "query, queries {:0.3f} s, same distances: {}".
+            format(split_rule, build_time, tree.depth(), tree.leaf_nodes,
+                   nodes / float(queries), query_time, distances == expected))
+
+def search_recursive(node, query):
+  """ Recursive version of KDTreeNode.search, to compare against. """
+
+  # When we reach a leaf it's either equal to the target or
+  # equal to the place the target would go. For a bucket, return
+  # the closest point in it.
+  if node.is_leaf() and node.bucket:
+    closest = min(((member, key if key > kdtree.ZERO_KEY else 0)
+                   for member, key in node.bucket_keys(query)),
+                  key=itemgetter(1))
+    return closest[0]
+
+  if node.is_leaf():
+    return node
+
+  # Otherwise the node defines a splitting line and it's got to have at
+  # least one child. If there's no subtree on the query's side, try the
+  # other one.
+  if query[node.axis] <= node.value:
+    return search_recursive(node.left_child or node.right_child, query)
+  else:
+    return search_recursive(node.right_child or node.left_child, query)
+
+def find_nearest_recursive(node, query, min_so_far, stats):
+  """ Recursive version of KDTreeNode.find_nearest, pruning on splitting
+      lines instead of bounding boxes, to compare against. """
+
+  stats['nodes'] += 1
+
+  # Base case: node is a leaf so just compare it.
+  if node.is_leaf() and node.bucket:
+    for member, key in node.bucket_keys(query):
+      if key < min_so_far['key']:
+        min_so_far['point'] = member
+        min_so_far['key'] = key if key > kdtree.ZERO_KEY else 0
+        min_so_far['distance'] = kdtree.key_distance(key)
+
+  elif node.is_leaf():
+    key = node.distance_key(node.point, query)
+    if key < min_so_far['key']:
+      min_so_far['point'] = node
+      min_so_far['key'] = key
+      min_so_far['distance'] = kdtree.key_distance(key)
+
+  # Search the branch on the query's side first, then the other one if
+  # it's still within the minimum distance.
+  elif query[node.axis] <= node.value:
+    if node.left_child:
+      find_nearest_recursive(node.left_child, query, min_so_far, stats)
+    if (node.right_child and
+        (query[node.axis] + min_so_far['distance']) > node.value):
+      find_nearest_recursive(node.right_child, query, min_so_far, stats)
+
+  else:
+    if node.right_child:
+      find_nearest_recursive(node.right_child, query, min_so_far, stats)
+    if (node.left_child and
+        (query[node.axis] - min_so_far['distance']) <= node.value):
+      find_nearest_recursive(node.left_child, query, min_so_far, stats)
+
+def find_k_nearest_recursive(node, query, mins_so_far, stats):
+  """ Recursive version of KDTreeNode.find_k_nearest, pruning on splitting
+      lines instead of bounding boxes, to compare against. """
+
+  stats['nodes'] += 1
+
+  # Base case: node is a leaf so just compare it.
+  if node.is_leaf() and node.bucket:
+    for member, key in node.bucket_keys(query):
+      if key < mins_so_far.key_radius():
+        mins_so_far.insert(member, key, member.index)
+
+  elif node.is_leaf():
+    key = node.distance_key(node.point, query)
+    if key < mins_so_far.key_radius():
+      mins_so_far.insert(node, key, node.index)
+
+  # Search the branch on the query's side first, then the other one if
+  # it's still within the search radius, which the first one may have
+  # shrunk.
+  elif query[node.axis] <= node.value:
+    if (node.left_child and
+        (query[node.axis] - mins_so_far.radius()) <= node.value):
+      find_k_nearest_recursive(node.left_child, query, mins_so_far, stats)
+    if (node.right_child and
+        (query[node.axis] + mins_so_far.radius()) > node.value):
+      find_k_nearest_recursive(node.right_child, query, mins_so_far, stats)
+
+  else:
+    if (node.right_child and
+        (query[node.axis] + mins_so_far.radius()) > node.value):
+      find_k_nearest_recursive(node.right_child, query, mins_so_far, stats)
+    if (node.left_child and
+        (query[node.axis] - mins_so_far.radius()) <= node.value):
+      find_k_nearest_recursive(node.left_child, query, mins_so_far, stats)
+
+def flat_find_k_nearest_recursive(tree, node, query, mins_so_far, stats):
+  """ Recursive version of FlatKDTree.find_k_nearest, pruning on splitting
+      lines instead of bounding boxes, to compare against. """
+
+  stats['nodes'] += 1
+
+  axis = tree.axes[node]
+  if axis < 0:
+    tree.compare_bucket(node, query, mins_so_far)
+    return
+
+  value = tree.values[node]
+  left = tree.left_children[node]
+  right = tree.right_children[node]
+
+  if query[axis] <= value:
+    if left >= 0 and (query[axis] - mins_so_far.radius()) <= value:
+      flat_find_k_nearest_recursive(tree, left, query, mins_so_far, stats)
+    if right >= 0 and (query[axis] + mins_so_far.radius()) > value:
+      flat_find_k_nearest_recursive(tree, right, query, mins_so_far, stats)
+
+  else:
+    if right >= 0 and (query[axis] + mins_so_far.radius()) > value:
+      flat_find_k_nearest_recursive(tree, right, query, mins_so_far, stats)
+    if left >= 0 and (query[axis] - mins_so_far.radius()) <= value:
+      flat_find_k_nearest_recursive(tree, left, query, mins_so_far, stats)
+
+def check_iterative(filenames=('datasets/test_1000.in',
+                                'datasets/test_10000.in'),
+                    leaf_sizes=(1, 8)):
+  """ Times the iterative search, find_nearest and find_k_nearest against
+      the recursive versions above on the topic queries of the given input
+      files, checking they find the same points. The iterative searches
+      prune on node bounding boxes and the recursive ones on splitting
+      lines, so the nodes each visits are shown too. """
+  
+  for filename in filenames:
+    with open(filename) as source:
+      data = main.read_input_bulk(source)
+    queries = [query for query in data['queries'] if query['type'] == 't']
+    
+    for leaf_size in leaf_sizes:
+      tree = kdtree.KDTree(data['topics'], ['x', 'y'], leaf_size)
+      flat_tree = kdtree.FlatKDTree(data['topics'], ['x', 'y'], leaf_size)
+      root = tree.root
+      
+      def search(method):
+        return [method(query) for query in queries], None
+      
+      def nearest(method):
+        results = []
+        stats = {'nodes': 0}
+        for query in queries:
+          min_so_far = {'point': None, 'distance': float('inf'),
+                        'key': float('inf')}
+          method(query, min_so_far, stats)
+          results.append(min_so_far['point'])
+        return results, stats['nodes']
+      
+      def k_nearest(method):
+        results = []
+        stats = {'nodes': 0}
+        for query in queries:
+          mins_so_far = kdtree.KNearestHeap(query['count'])
+          method(query, mins_so_far, stats)
+          results.append([result['point'] 
+                          for result in mins_so_far.sorted_list()])
+        return results, stats['nodes']
+      
+      def flat_k_nearest(method):
+        results = []
+        stats = {'nodes': 0}
+        for query in queries:
+          mins_so_far = kdtree.KNearestHeap(query['count'])
+          method(flat_tree.root, (query['x'], query['y']), mins_so_far, stats)
+          results.append([result['point'] 
+                          for result in mins_so_far.sorted_list()])
+        return results, stats['nodes']
+        
+      print("{}, {} topic queries, leaf size {}:".
+            format(filename, len(queries), leaf_size))
+      for name, run, iterative, recursive in (
+          ('search', search, root.search,
+           lambda query: search_recursive(root, query)),
+          ('find_nearest', nearest, root.find_nearest,
+           lambda *args: find_nearest_recursive(root, *args)),
+          ('find_k_nearest', k_nearest, root.find_k_nearest,
+           lambda *args: find_k_nearest_recursive(root, *args)),
+          ('FlatKDTree.find_k_nearest', flat_k_nearest,
+           flat_tree.find_k_nearest,
+           lambda *args: flat_find_k_nearest_recursive(flat_tree, *args))):
+        
+        # Take the best of a few runs, alternating between the two.
+        iterative_time = recursive_time = float('inf')
+        for repeat in range(3):
+          t0 = time.clock()
+          iterative_results = run(iterative)
+          iterative_time = min(iterative_time, time.clock() - t0)
+          
+          t0 = time.clock()
+          recursive_results = run(recursive)
+          recursive_time = min(recursive_time, time.clock() - t0)
+        
+        print("  {}: iterative {:0.3f} s, recursive {:0.3f} s, same: {}".
+              format(name, iterative_time, recursive_time,
+                     iterative_results[0] == recursive_results[0]))
+        if iterative_results[1] is not None:
+          print("    nodes: iterative {}, recursive {}".
+                format(iterative_results[1], recursive_results[1]))
+
+def check_distance_keys(number=200000, bucket_size=8):
+  """ Checks that distance keys order random pairs of points (many of them
+      equal or within EPSILON of the query) the same way as their distances,
+      ties included, and times the bucket kernel against computing the 
+      distances. """
+  
+  random.seed(17)
+  query = {'x': 0.5, 'y': 0.5}
+  offsets = [0, kdtree.EPSILON / 2, kdtree.EPSILON, 0.25, 0.5]
+  
+  def random_point():
+    return {'x': query['x'] + random.choice(offsets) * random.choice((-1, 1)),
+            'y': query['y'] + random.choice(offsets + [random.random()])}
+  
+  mismatches = 0
+  for i in range(number):
+    first = random_point()
+    second = random_point()
+    distances = (kdtree.KDTreeNode.distance(first, query), 
+                 kdtree.KDTreeNode.distance(second, query))
+    keys = (kdtree.KDTreeNode.distance_key(first, query),
+            kdtree.KDTreeNode.distance_key(second, query))
+    if cmp(*distances) != cmp(*keys) or \
+       kdtree.key_distance(keys[0]) != distances[0]:
+      mismatches += 1
+  
+  print("{} pairs of points, {} ordered differently by their keys".
+        format(number, mismatches))
+  
+  xs = [random.random() for i in range(bucket_size)]
+  ys = [random.random() for i in range(bucket_size)]
+  repeats = number / bucket_size
+  
+  t0 = time.clock()
+  for i in range(repeats):
+    [max(0, math.sqrt((x - query['x']) * (x - query['x']) + 
+                      (y - query['y']) * (y - query['y'])) - kdtree.EPSILON)
+     for x, y in zip(xs, ys)]
+  distance_time = time.clock() - t0
+  
+  t0 = time.clock()
+  for i in range(repeats):
+    kdtree.bucket_keys(xs, ys, query['x'], query['y'])
+  key_time = time.clock() - t0
+  
+  print("{} buckets of {} points: distances {:0.3f} s, keys {:0.3f} s".
+        format(repeats, bucket_size, distance_time, key_time))
+
 def check_tree():
   """ This is a function for testing the accuracy of results. """
   
@@ -421,6 +1083,9 @@ def check_tree():
 
 if __name__ == "__main__":  
   
+  usage = ("Use one of showtree, accuracy, flat, batch, linked, "
+           "parallelbuild, partitionbuild, iterative, splitrules, keys, "
+           "leafsize or stresstest.")
   if len(sys.argv) > 1:
     choice = sys.argv[1]
     if choice == "showtree":
@@ -428,13 +1093,32 @@ if __name__ == "__main__":
     elif choice == "accuracy":
       check_nearest_accuracy()
       check_k_nearest_accuracy()
+    elif choice == "flat":
+      check_flat_tree()
+    elif choice == "batch":
+      check_batch()
+    elif choice == "linked":
+      check_linked_counts()
+    elif choice == "parallelbuild":
+      check_parallel_build()
+    elif choice == "partitionbuild":
+      check_partition_build()
+    elif choice == "iterative":
+      check_iterative()
+    elif choice == "splitrules":
+      check_split_rules()
+    elif choice == "keys":
+      check_distance_keys()
+    elif choice == "leafsize":
+      check_leaf_sizes()
     elif choice == "stresstest":
       print("hmm?")
       stress_test()
     else:
-      "Command line argument not recognized."
+      print("Command line argument not recognized: {}. {}".
+            format(choice, usage))
   else:
-    print("Command line argument required: either showtree, accuracy, or stresstest.")
+    print("Command line argument required. {}".format(usage))
     
   
   
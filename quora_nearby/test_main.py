@@ -7,9 +7,12 @@
 import sys
 import random
 import time
+from StringIO import StringIO
 import logging
 from operator import itemgetter
 import kdtree
+import balltree
+import pointstore
 import test_kdtree
 from main import *
 
@@ -124,6 +127,11 @@ def generate_data(config, output_filename="stress_test.in"):
   """ Function to generate random test data based on the parameters
       in config. It dumps this data to a file in the format 
       expected by main.
+      
+      Topics and queries are spread evenly over the square, unless config
+      has a 'clusters' count, in which case they're clustered around that
+      many random centers with a spread of config['cluster_spread'] (see
+      test_kdtree.sample_clusters).
   """
   
   num_topics = config['num_topics']
@@ -143,7 +151,16 @@ def generate_data(config, output_filename="stress_test.in"):
   output.write("{} {} {}\n".format(num_topics, num_questions, num_queries))
   
   # Randomly generate topic locations
-  topics = test_kdtree.sample_square(origin, side_length, num_topics)         
+  if config.get('clusters'):
+    centers = test_kdtree.sample_square(origin, side_length, 
+                                        config['clusters'])
+    def sample(quantity):
+      return test_kdtree.sample_clusters(origin, side_length, quantity, 
+                                         centers, config['cluster_spread'])
+  else:
+    def sample(quantity):
+      return test_kdtree.sample_square(origin, side_length, quantity)
+  topics = sample(num_topics)
   
   # Reformat the sample list to have index as topic id
   all_topics = ["{0} {1[x]} {1[y]}\n".format(index, topic) 
@@ -170,7 +187,7 @@ def generate_data(config, output_filename="stress_test.in"):
   
   commands = ['q', 't']
   queries = []
-  query_points = test_kdtree.sample_square(origin, side_length, num_queries)  
+  query_points = sample(num_queries)
   for point in query_points:
     
     # Randomly query on either questions or topics
@@ -200,6 +217,30 @@ def generate_max_test_data():
   output_name = "test_{0[num_topics]}_{0[num_questions]}_{0[num_queries]}.in".format(config)         
   generate_data(config, output_name)
   
+def benchmark_clusters(clusters=50, cluster_spread=0.005, 
+                       output_filename="test_clustered.in"):
+  """ Generates an input at quora's limits with topics and queries in 
+      clusters (see generate_data), and compares the kd-trees with the ball
+      tree on it and on the bundled uniform input with benchmark_engines, 
+      all with the ball tree's leaf size. """
+  
+  config = {'num_topics': 10000,
+            'num_questions': 1000,
+            'num_queries': 10000,
+            'max_topics_per_question': 10,
+            'max_results': 10,
+            'side_length': 1000000,
+            'origin': {'x': 0,
+                       'y': 0},
+            'clusters': clusters,
+            'cluster_spread': cluster_spread}
+  
+  random.seed(23)
+  generate_data(config, output_filename)
+  benchmark_engines(('datasets/test_10000.in', output_filename),
+                    ('kdtree', 'flat', 'ball'), 
+                    leaf_size=balltree.BallTree.bucket_points)
+  
 def test_bruteforce_verbose():
   """ Processes the queries and displays output for checking accuracy, instead
       of just printing out query results. Very verbose, so running this on 
@@ -274,10 +315,18 @@ def process_queries_brute_force(data):
  """ Function which finds the ids of the nearest neighbors using brute force.
      Used to check accuracy of kd-tree results.
       
-      Prints output to stdout as lists of ids (either question or topics,
-      depending on what the query requries).
+      data is parsed by read_input_store. Prints output to stdout as lists 
+      of ids (either question or topics, depending on what the query 
+      requries).
  """
- stats = {}
+ store = data['topics']
+ points = [store[index] for index in xrange(len(store))]
+ topics_with_questions = [index for index in xrange(len(store)) 
+                          if store.record_count(index)]
+ 
+ # The questions seen so far by a query, by their number in the store.
+ visited = pointstore.VisitedSet(len(store.record_ids))
+ 
  for query in data['queries']:
     
     # Pull out the number of results desired for the query.
@@ -286,43 +335,36 @@ def process_queries_brute_force(data):
     # Topic search is just a straightforward nearest neighbors query.
     if query['type'] == 't':
       
-      # Just pull the values from the topics dictionary and sort by distance
+      # Just sort the indexes of the topics by the distance of the topic
       # from the query point.
-      nearest = data['topics'].values()
-      nearest.sort(key=lambda k: kdtree.KDTreeNode.distance(k, query) )
-      
-      
+      nearest = sorted(xrange(len(store)), key=lambda index: 
+                       kdtree.KDTreeNode.distance(points[index], query))
       
       # Re-format for output and print to stdout
-      results = [str(result['value']['id']) for result in nearest]
-      print(' '.join(results[:num_results]))
+      results = [str(store.ids[index]) for index in nearest[:num_results]]
+      print(' '.join(results))
       
     # Otherwise search is more complicated because we care about number of 
     # records associated with the nearest point(s)
     elif query['type'] == 'q':
       
-      # We're sorting the dictionary of topics with 1 or more questions, so
-      # we know every topic will yield at least one question.
-      nearest = data['topics_with_questions'].values()
-      nearest.sort(key=lambda k: kdtree.KDTreeNode.distance(k, query) )
+      # We're sorting the topics with 1 or more questions, so we know every
+      # topic will yield at least one question.
+      nearest = sorted(topics_with_questions, key=lambda index:
+                       kdtree.KDTreeNode.distance(points[index], query))
       
       # Now all we have to do is aggregate question id's, ignoring duplicates.
-      num_questions = 0
-      # Keep a separate dictionary for checking duplicates because it doesn't
-      # preserve the sorted order.
-      dupes = {}
+      # The questions of each topic are already sorted in the store.
+      visited.clear()
       questions = []
-      for topic in nearest:
-        
-        topic['value']['questions'].sort()
+      for index in nearest:
         
         # Go through the list of question's associated with each topic,
         # adding to the results only if it hasn't previously appeared.
-        for question in topic['value']['questions']:
+        for question in store.point_records(index):
           
-          if question not in dupes:
-            dupes[question] = True
-            questions.append(str(question))
+          if visited.add(question):
+            questions.append(str(store.record_ids[question]))
             
         # Break early if we have enough topics
         if len(questions) >= num_results:
@@ -342,7 +384,7 @@ def brute_force():
    
   logging.info("Reading from sys.stdin...")
   
-  data = read_input(sys.stdin)
+  data = read_input_store(sys.stdin)
   
   # Actually process the queries
   logging.info("Starting {} brute-force queries...".format(len(data['queries'])))
@@ -351,7 +393,162 @@ def brute_force():
   t1 = time.clock()
   logging.info("Queries finished ({} s)".format(t1-t0))
 
+def benchmark_parsers(filename='datasets/test_10000.in', repeats=5):
+  """ Times read_input against read_input_bulk on the given input file, 
+      which is read into memory first so only the parsing is timed, and
+      checks they return the same data. """
+  
+  with open(filename) as input_file:
+    text = input_file.read()
+  
+  times = {}
+  results = {}
+  for parser in (read_input, read_input_bulk):
+    best = float('inf')
+    for repeat in range(repeats):
+      t0 = time.clock()
+      results[parser] = parser(StringIO(text))
+      best = min(best, time.clock() - t0)
+    times[parser] = best
+    
+  print("Parsing {} (best of {}): read_input {:0.3f} s, read_input_bulk "
+        "{:0.3f} s ({:0.1f}x), same data: {}".
+        format(filename, repeats, times[read_input], times[read_input_bulk],
+               times[read_input] / times[read_input_bulk],
+               results[read_input] == results[read_input_bulk]))
+
+def topic_memory(topics):
+  """ Returns the number of bytes taken by the dictionaries of parsed 
+      topics, including their question lists and the ints in them. """
+  
+  size = sys.getsizeof(topics)
+  for topic_id, topic in topics.iteritems():
+    size += sys.getsizeof(topic_id) + sys.getsizeof(topic)
+    size += sum(sys.getsizeof(topic[key]) for key in ('x', 'y'))
+    size += sys.getsizeof(topic['value']) + sys.getsizeof(topic['value']['id'])
+    questions = topic['value']['questions']
+    size += sys.getsizeof(questions) + sum(sys.getsizeof(question_id) 
+                                           for question_id in questions)
+  return size
+
+def benchmark_store(filename='datasets/test_10000.in', repeats=3):
+  """ Compares the topics parsed by read_input_bulk with the PointStore 
+      parsed by read_input_store: the memory they take per topic, and the
+      time FlatKDTree takes to answer the question queries of the given
+      input file from each, checking the answers are the same. """
+  
+  with open(filename) as input_file:
+    text = input_file.read()
+  
+  data = read_input_bulk(StringIO(text))
+  store_data = read_input_store(StringIO(text))
+  number = len(data['topics'])
+  print("{} topics: {:0.0f} bytes per topic as dictionaries, {:0.0f} in a "
+        "PointStore".format(number, topic_memory(data['topics']) / float(number),
+                            store_data['topics'].memory_size() / float(number)))
+  
+  answers = {}
+  for name, parsed in (('dictionaries', data), ('PointStore', store_data)):
+    tree = kdtree.FlatKDTree(parsed['topics'], ['x', 'y'], 1, 'questions')
+    queries = [query for query in parsed['queries'] if query['type'] == 'q']
+    
+    best = float('inf')
+    for repeat in range(repeats):
+      t0 = time.clock()
+      answers[name] = [answer_query(parsed, tree, query, {}) 
+                       for query in queries]
+      best = min(best, time.clock() - t0)
+    print("  {} question queries from {}: {:0.3f} s".
+          format(len(queries), name, best))
+    
+  print("  same answers: {}".format(answers['dictionaries'] == 
+                                     answers['PointStore']))
+
+def benchmark_cache(filename='datasets/test_10000.in', hot_locations=200,
+                    number=5000, cache_size=1000):
+  """ Times answering queries at a few hot locations, with random counts, 
+      with and without a QueryCache, on the topics of the given input file,
+      and checks the answers are the same. The locations are taken from the
+      queries of the file. """
+  
+  with open(filename) as input_file:
+    data = read_input_bulk(input_file)
+  tree = kdtree.KDTree(data['topics'], ['x', 'y'], 1, 'questions')
+  
+  random.seed(20)
+  hot = random.sample(data['queries'], hot_locations)
+  queries = []
+  for count in xrange(number):
+    query = dict(random.choice(hot))
+    query['count'] = random.randint(1, 100)
+    queries.append(query)
+  
+  answers = {}
+  times = {}
+  cache = QueryCache(cache_size)
+  for name, query_cache in (('no cache', None), ('cache', cache)):
+    stats = {}
+    t0 = time.clock()
+    answers[name] = [answer_query(data, tree, query, stats, False, query_cache)
+                     for query in queries]
+    times[name] = time.clock() - t0
+    
+  print("{} queries at {} locations: {:0.3f} s without a cache, {:0.3f} s "
+        "with one ({} hits, {} misses), same answers: {}".
+        format(number, hot_locations, times['no cache'], times['cache'], 
+               cache.hits, cache.misses, 
+               answers['no cache'] == answers['cache']))
+
+def benchmark_engines(filenames=('datasets/test_1000.in', 
+                                  'datasets/test_10000.in'), 
+                      engines=('kdtree', 'flat', 'grid', 'morton', 'ball'), 
+                      single_pass=True, leaf_size=1):
+  """ Times building each engine (with the given leaf size) on the topics
+      of the given input files, and answering their queries with it, 
+      checking the answers are the same as those of the first engine. """
+  
+  for filename in filenames:
+    with open(filename) as input_file:
+      data = read_input_bulk(input_file)
+    print("{}: {} topics, {} queries".format(filename, len(data['topics']),
+                                             len(data['queries'])))
+    
+    answers = {}
+    for engine in engines:
+      t0 = time.clock()
+      tree = ENGINES[engine](data['topics'], ['x', 'y'], leaf_size, 
+                             'questions')
+      t1 = time.clock()
+      
+      nodes = 0
+      answers[engine] = []
+      for query in data['queries']:
+        stats = {}
+        answers[engine].append(answer_query(data, tree, query, stats, 
+                                            single_pass))
+        nodes += stats['nodes']
+      t2 = time.clock()
+      
+      print("  {}: build {:0.3f} s, queries {:0.3f} s, {:0.1f} nodes per "
+            "query, same answers: {}".
+            format(engine, t1 - t0, t2 - t1, 
+                   nodes / float(len(data['queries'])),
+                   answers[engine] == answers[engines[0]]))
+
 # Log some timing for comparison
 logging.basicConfig(filename='quora_nearby_test.log',level=logging.INFO)
-# Run on the input to produce results in the same format as main.py, for comparison.
-brute_force()
\ No newline at end of file
+
+if len(sys.argv) > 1 and sys.argv[1] == "parsebench":
+  benchmark_parsers(*sys.argv[2:3])
+elif len(sys.argv) > 1 and sys.argv[1] == "storebench":
+  benchmark_store(*sys.argv[2:3])
+elif len(sys.argv) > 1 and sys.argv[1] == "cachebench":
+  benchmark_cache(*sys.argv[2:3])
+elif len(sys.argv) > 1 and sys.argv[1] == "clusterbench":
+  benchmark_clusters()
+elif len(sys.argv) > 1 and sys.argv[1] == "enginebench":
+  benchmark_engines(sys.argv[2:] or ('datasets/test_1000.in', 
+                                     'datasets/test_10000.in'))
+else:
+  # Run on the input to produce results in the same format as main.py, for comparison.
+  brute_force()
\ No newline at end of file